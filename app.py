@@ -6,7 +6,7 @@ import time
 import subprocess
 from datetime import datetime, timedelta
 import xml.etree.ElementTree as ET
-import xml.dom.minidom as minidom
+from xml.sax.saxutils import escape, quoteattr
 import threading
 from threading import Thread
 import logging
@@ -58,12 +58,26 @@ from flask import (
     send_file,
 )
 from datetime import datetime, timezone
+from werkzeug.datastructures import MultiDict
 from functools import wraps
 import secrets
 import waitress
 import sqlite3
 import tempfile
 import atexit
+import base64
+import hashlib
+import re
+import asyncio
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import gzip
+
+try:
+    import brotli
+except ImportError:  # Optional, only used to pre-compress served artifacts
+    brotli = None
 
 app = Flask(__name__)
 app.secret_key = secrets.token_urlsafe(32)
@@ -99,13 +113,46 @@ else:
 
 logger.info(f"Using database file: {dbPath}")
 
+# XMLTV guide cache file
+if os.getenv("XMLTV_PATH"):
+    xmltvPath = os.getenv("XMLTV_PATH")
+else:
+    xmltvPath = os.path.join(basePath, "Evilvir.us", "MacReplayEPG.xml")
+
 occupied = {}
 config = {}
-cached_lineup = []
+lineup_artifact = None
+lineup_lock = threading.Lock()
 cached_playlist = None
-last_playlist_host = None
+playlist_artifact = None
+playlist_lock = threading.Lock()
 cached_xmltv = None
 last_updated = 0
+xmltv_refresh_lock = threading.Lock()
+xmltv_refresh_pending = False
+
+# Portals fetched at once during bulk refreshes by default, and the most the setting accepts
+PORTAL_CONCURRENCY = 4
+PORTAL_MAX_CONCURRENCY = 32
+
+# Seconds one portal's EPG download may take before the guide is built without it
+EPG_PORTAL_TIMEOUT = 120
+
+# Longest EPG lookahead the setting accepts, and the default
+EPG_MAX_LOOKAHEAD = 336
+EPG_DEFAULT_LOOKAHEAD = 24
+
+# Hours re-fetched on every refresh, and how far stored coverage may run
+# short of the lookahead before the whole lookahead is fetched again
+EPG_NEAR_TERM_HOURS = 6
+EPG_FAR_REFRESH_HOURS = 6
+
+# Seconds before the guide is stale, and how far ahead of that the scheduler rebuilds it
+XMLTV_MAX_AGE = 900
+XMLTV_REFRESH_AHEAD = 120
+
+# Seconds before the scheduler retries a failed rebuild, doubled per consecutive failure up to XMLTV_MAX_AGE
+XMLTV_RETRY_DELAY = 60
 
 
 d_ffmpegcmd = [
@@ -155,6 +202,8 @@ defaultSettings = {
     "hdhr name": "MacReplay",
     "hdhr id": str(uuid.uuid4().hex),
     "hdhr tuners": "10",
+    "epg lookahead": "24",
+    "portal concurrency": "4",
 }
 
 defaultPortal = {
@@ -579,6 +628,220 @@ class HLSStreamManager:
 hls_manager = HLSStreamManager(max_streams=10, inactive_timeout=30)
 
 
+# MPEG-TS packets are 188 bytes; reading whole packets keeps every chunk aligned
+TS_PACKET_SIZE = 188
+SHARED_STREAM_READ_SIZE = TS_PACKET_SIZE * 7
+# Chunks of recent output kept for late joiners and slow clients (~5MB)
+SHARED_STREAM_BUFFER_CHUNKS = 4096
+
+
+def is_video_keyframe(data, offset):
+    """Whether the TS packet at offset is a random access point that starts a video PES.
+    
+    Audio packets carry the random access indicator on every frame, so only
+    packets starting a PES with a video stream_id (0xE0-0xEF) count.
+    """
+    if not data[offset + 1] & 0x40 or not data[offset + 3] & 0x20:
+        return False  # No PES starts here, or no adaptation field
+    adaptation_length = data[offset + 4]
+    if adaptation_length == 0 or not data[offset + 5] & 0x40:
+        return False  # Random access indicator not set
+    payload = offset + 5 + adaptation_length
+    if payload + 4 > offset + TS_PACKET_SIZE:
+        return False
+    return data[payload:payload + 3] == b"\x00\x00\x01" and 0xE0 <= data[payload + 3] <= 0xEF
+
+
+class SharedStream:
+    """One upstream ffmpeg for a channel, fanned out to every client watching it.
+    
+    A reader thread appends ffmpeg's output to a ring buffer of recent
+    chunks and each subscriber follows it at its own pace. Late joiners, and
+    subscribers that fall out of the buffer, start at the last PAT before a
+    keyframe so their player can decode from the first byte it gets. The MAC
+    is occupied once for the upstream, not once per viewer.
+    """
+    
+    def __init__(self, key, command, occupancy, on_error):
+        self.key = key
+        self.command = command
+        self.occupancy = occupancy
+        self.on_error = on_error
+        self.chunks = deque(maxlen=SHARED_STREAM_BUFFER_CHUNKS)  # (seq, data)
+        self.next_seq = 0
+        self.join_point = None  # (seq, offset) a late joiner starts from
+        self.last_pat = None
+        self.subscribers = 0
+        self.finished = False
+        self.stopped = False
+        self.process = None
+        self.condition = threading.Condition()
+    
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+    
+    def _run(self):
+        portal_id, channel_id = self.key
+        occupied.setdefault(portal_id, []).append(self.occupancy)
+        logger.info("Occupied Portal({}):MAC({})".format(portal_id, self.occupancy["mac"]))
+        returncode = 0
+        try:
+            with subprocess.Popen(
+                self.command,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            ) as process:
+                with self.condition:
+                    self.process = process
+                    stopped = self.stopped
+                if stopped:
+                    process.kill()
+                while True:
+                    data = process.stdout.read(SHARED_STREAM_READ_SIZE)
+                    if len(data) == 0:
+                        returncode = process.poll()
+                        break
+                    self._publish(data)
+        except Exception as e:
+            logger.error(f"Shared stream for Portal({portal_id}):Channel({channel_id}) failed: {e}")
+        finally:
+            with self.condition:
+                self.finished = True
+                # Viewers leaving after this saw the failure, they didn't cause it
+                stopped = self.stopped
+                self.condition.notify_all()
+            occupied.get(portal_id, []).remove(self.occupancy)
+            logger.info("Unoccupied Portal({}):MAC({})".format(portal_id, self.occupancy["mac"]))
+            shared_streams.discard(self.key, self)
+        
+        # Being stopped because nobody is watching is not the MAC's fault
+        if returncode != 0 and not stopped:
+            self.on_error(returncode)
+    
+    def _publish(self, data):
+        """Buffer a chunk, noting any PAT that precedes a keyframe as the new join point."""
+        with self.condition:
+            seq = self.next_seq
+            for offset in range(0, len(data) - TS_PACKET_SIZE + 1, TS_PACKET_SIZE):
+                if data[offset] != 0x47:
+                    break  # Not MPEG-TS, or not packet aligned
+                pid = ((data[offset + 1] & 0x1F) << 8) | data[offset + 2]
+                if pid == 0 and data[offset + 1] & 0x40:
+                    self.last_pat = (seq, offset)
+                elif self.last_pat is not None and is_video_keyframe(data, offset):
+                    self.join_point = self.last_pat
+            
+            self.chunks.append((seq, data))
+            self.next_seq += 1
+            self.condition.notify_all()
+    
+    def _start_position(self):
+        """Where a new or lagging subscriber starts: the join point if still buffered, else the live edge."""
+        if self.join_point is not None and self.chunks and self.join_point[0] >= self.chunks[0][0]:
+            return self.join_point
+        return (self.next_seq, 0)
+    
+    def subscribe(self):
+        """A new subscriber, or None if the upstream has already stopped."""
+        with self.condition:
+            if self.finished:
+                return None
+            self.subscribers += 1
+            return StreamSubscriber(self, self._start_position())
+    
+    def read(self, position):
+        """Chunks from position on, and the position after them. Blocks until there is data or the stream ends."""
+        with self.condition:
+            while self.next_seq <= position[0] and not self.finished:
+                self.condition.wait(1)
+            
+            if self.chunks and position[0] < self.chunks[0][0]:
+                logger.info(f"Subscriber fell behind the buffer for {self.key}, skipping ahead")
+                position = self._start_position()
+            
+            seq, offset = position
+            new = []
+            for chunk_seq, data in reversed(self.chunks):
+                if chunk_seq < seq:
+                    break
+                new.append(data[offset:] if chunk_seq == seq else data)
+            new.reverse()
+            return new, (self.next_seq, 0)
+    
+    def leave(self):
+        """Drop a subscriber, stopping the upstream when it was the last one."""
+        with self.condition:
+            self.subscribers -= 1
+            if self.subscribers > 0:
+                return
+            self.finished = True
+            self.stopped = True
+            process = self.process
+            self.condition.notify_all()
+        logger.info(f"Last viewer left {self.key}, stopping upstream")
+        if process is not None:
+            process.kill()
+
+
+class StreamSubscriber:
+    """A client's view of a SharedStream, used as the response body."""
+    
+    def __init__(self, stream, position):
+        self.stream = stream
+        self.position = position
+        self.closed = False
+    
+    def __iter__(self):
+        try:
+            while not self.closed:
+                chunks, self.position = self.stream.read(self.position)
+                if not chunks:
+                    if self.stream.finished:
+                        break
+                    continue
+                yield b"".join(chunks)
+        finally:
+            self.close()
+    
+    def close(self):
+        """Called by the server when the client goes away, even if the body was never read."""
+        if not self.closed:
+            self.closed = True
+            self.stream.leave()
+
+
+class SharedStreams:
+    """The running SharedStream for each (portal, channel)."""
+    
+    def __init__(self):
+        self.streams = {}
+        self.lock = threading.Lock()
+    
+    def join(self, key, create=None):
+        """Subscribe to the channel's upstream, starting one with create() if none is running.
+        
+        Returns None when nothing is running and no create was given.
+        """
+        with self.lock:
+            stream = self.streams.get(key)
+            subscriber = stream.subscribe() if stream is not None else None
+            if subscriber is None and create is not None:
+                stream = create()
+                self.streams[key] = stream
+                subscriber = stream.subscribe()
+                stream.start()
+            return subscriber
+    
+    def discard(self, key, stream):
+        with self.lock:
+            if self.streams.get(key) is stream:
+                del self.streams[key]
+
+
+shared_streams = SharedStreams()
+
+
 def loadConfig():
     try:
         with open(configFile) as f:
@@ -640,15 +903,330 @@ def saveSettings(settings):
         json.dump(config, f, indent=4)
 
 
+def getProfiles():
+    return config.setdefault("profiles", {})
+
+
+def saveProfiles(profiles):
+    with open(configFile, "w") as f:
+        config["profiles"] = profiles
+        json.dump(config, f, indent=4)
+
+
+class PooledConnection(sqlite3.Connection):
+    """SQLite connection whose close() hands it back to its pool."""
+    
+    pool = None
+    db_path = None
+    
+    def close(self):
+        if self.pool is None:
+            super().close()
+        else:
+            self.pool.release(self)
+
+
+class ConnectionPool:
+    """Reuses tuned SQLite connections instead of opening one per request.
+    
+    Connections are opened in WAL mode so readers (editor, playlist, lineup)
+    are not blocked while a cache refresh is writing.
+    """
+    
+    def __init__(self, max_idle=8, busy_timeout=10):
+        self.max_idle = max_idle
+        self.busy_timeout = busy_timeout
+        self.idle = []
+        self.lock = threading.Lock()
+    
+    def _connect(self, path):
+        conn = sqlite3.connect(
+            path,
+            timeout=self.busy_timeout,
+            check_same_thread=False,
+            factory=PooledConnection,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("PRAGMA cache_size = -32000")  # 32 MB page cache
+        conn.execute("PRAGMA mmap_size = 268435456")  # 256 MB memory-mapped I/O
+        conn.execute("PRAGMA temp_store = MEMORY")
+        conn.execute(f"PRAGMA busy_timeout = {self.busy_timeout * 1000}")
+        conn.db_path = path
+        conn.pool = self
+        return conn
+    
+    def acquire(self, path):
+        with self.lock:
+            while self.idle:
+                conn = self.idle.pop()
+                if conn.db_path == path:
+                    return conn
+                sqlite3.Connection.close(conn)
+        return self._connect(path)
+    
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            conn.row_factory = sqlite3.Row
+        except sqlite3.Error:
+            sqlite3.Connection.close(conn)
+            return
+        
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(conn)
+                return
+        sqlite3.Connection.close(conn)
+    
+    def close_all(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            sqlite3.Connection.close(conn)
+
+
+# Global SQLite connection pool
+db_pool = ConnectionPool(max_idle=16)
+
+
 def get_db_connection():
-    """Get a database connection."""
-    conn = sqlite3.connect(dbPath)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """Get a pooled database connection. Calling close() returns it to the pool."""
+    return db_pool.acquire(dbPath)
+
+
+# Bumped after every committed write to the channels table so caches derived
+# from it (editor counts, playlists) know to rebuild
+channels_version = 0
+channels_version_lock = threading.Lock()
+
+
+def mark_channels_changed():
+    """Record that the channels table changed."""
+    global channels_version
+    with channels_version_lock:
+        channels_version += 1
+
+
+def add_missing_columns(cursor, table, columns):
+    """Add (name, definition) columns that an older database doesn't have yet."""
+    # table_xinfo also lists generated columns, which table_info hides
+    cursor.execute(f"PRAGMA table_xinfo({table})")
+    existing_columns = {row['name'] for row in cursor.fetchall()}
+    for column, definition in columns:
+        if column not in existing_columns:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+            logger.info(f"Added {column} column to {table} table")
+
+
+def migrate_channel_lookup_columns(cursor):
+    """Stream cmd, content hash and tombstone columns."""
+    add_missing_columns(cursor, "channels", (
+        ("cmd", "TEXT"),
+        ("content_hash", "TEXT"),
+        ("removed", "INTEGER DEFAULT 0"),
+    ))
+
+
+def migrate_effective_columns(cursor):
+    """Generated custom-or-portal value columns and the indexes built on them."""
+    add_missing_columns(cursor, "channels", (
+        ("effective_name",
+         "TEXT GENERATED ALWAYS AS (COALESCE(NULLIF(custom_name, ''), name, '')) VIRTUAL"),
+        ("effective_number",
+         "INTEGER GENERATED ALWAYS AS "
+         "(CAST(COALESCE(NULLIF(custom_number, ''), number, 0) AS INTEGER)) VIRTUAL"),
+        ("effective_genre",
+         "TEXT GENERATED ALWAYS AS (COALESCE(NULLIF(custom_genre, ''), genre, '')) VIRTUAL"),
+    ))
+    
+    # Superseded by the composite indexes below
+    cursor.execute("DROP INDEX IF EXISTS idx_channels_enabled")
+    
+    # Playlist/lineup ordering and duplicate detection over enabled channels
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_channels_enabled_number
+        ON channels(enabled, removed, effective_number)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_channels_enabled_name
+        ON channels(enabled, removed, effective_name)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_channels_enabled_genre
+        ON channels(enabled, removed, effective_genre)
+    ''')
+    
+    # Editor sorting, genre filter/dropdown and portal filter/dropdown
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_channels_effective_name
+        ON channels(effective_name)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_channels_effective_number
+        ON channels(effective_number)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_channels_effective_genre
+        ON channels(effective_genre, removed)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_channels_portal_name
+        ON channels(portal_name, removed)
+    ''')
+
+
+CHANNEL_SEARCH_COLUMNS = (
+    "name", "custom_name", "genre", "custom_genre", "number", "custom_number", "portal_name",
+)
+
+
+def migrate_channel_search_index(cursor):
+    """FTS5 index over the searchable channel columns, kept in sync by triggers."""
+    columns = ", ".join(CHANNEL_SEARCH_COLUMNS)
+    new_values = ", ".join(f"new.{column}" for column in CHANNEL_SEARCH_COLUMNS)
+    old_values = ", ".join(f"old.{column}" for column in CHANNEL_SEARCH_COLUMNS)
+    
+    # External-content table: the index stores tokens only and reads the
+    # column values back from channels by rowid
+    cursor.execute(f'''
+        CREATE VIRTUAL TABLE IF NOT EXISTS channels_fts USING fts5(
+            {columns},
+            content='channels',
+            content_rowid='rowid',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='1 2 3'
+        )
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS channels_fts_insert AFTER INSERT ON channels BEGIN
+            INSERT INTO channels_fts(rowid, {columns}) VALUES (new.rowid, {new_values});
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS channels_fts_delete AFTER DELETE ON channels BEGIN
+            INSERT INTO channels_fts(channels_fts, rowid, {columns}) VALUES ('delete', old.rowid, {old_values});
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS channels_fts_update AFTER UPDATE OF {columns} ON channels BEGIN
+            INSERT INTO channels_fts(channels_fts, rowid, {columns}) VALUES ('delete', old.rowid, {old_values});
+            INSERT INTO channels_fts(rowid, {columns}) VALUES (new.rowid, {new_values});
+        END
+    ''')
+    
+    # Index whatever is already cached
+    cursor.execute("INSERT INTO channels_fts(channels_fts) VALUES ('rebuild')")
+
+
+def migrate_channel_name_counts(cursor):
+    """Per-name count of enabled channels, kept up to date by triggers."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS channel_name_counts (
+            name TEXT PRIMARY KEY,
+            count INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_channel_name_counts_count
+        ON channel_name_counts(count)
+    ''')
+    
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS channel_name_counts_insert AFTER INSERT ON channels
+        WHEN new.enabled = 1 AND new.removed = 0 BEGIN
+            INSERT INTO channel_name_counts (name, count) VALUES (new.effective_name, 1)
+            ON CONFLICT(name) DO UPDATE SET count = count + 1;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS channel_name_counts_delete AFTER DELETE ON channels
+        WHEN old.enabled = 1 AND old.removed = 0 BEGIN
+            UPDATE channel_name_counts SET count = count - 1 WHERE name = old.effective_name;
+            DELETE FROM channel_name_counts WHERE name = old.effective_name AND count <= 0;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS channel_name_counts_update
+        AFTER UPDATE OF enabled, removed, name, custom_name ON channels
+        WHEN (old.enabled = 1 AND old.removed = 0) OR (new.enabled = 1 AND new.removed = 0) BEGIN
+            UPDATE channel_name_counts SET count = count - 1
+            WHERE name = old.effective_name AND old.enabled = 1 AND old.removed = 0;
+            DELETE FROM channel_name_counts WHERE name = old.effective_name AND count <= 0;
+            INSERT INTO channel_name_counts (name, count)
+            SELECT new.effective_name, 1 WHERE new.enabled = 1 AND new.removed = 0
+            ON CONFLICT(name) DO UPDATE SET count = count + 1;
+        END
+    ''')
+    
+    # Seed from whatever is already cached
+    cursor.execute("DELETE FROM channel_name_counts")
+    cursor.execute('''
+        INSERT INTO channel_name_counts (name, count)
+        SELECT effective_name, COUNT(*)
+        FROM channels
+        WHERE enabled = 1 AND removed = 0
+        GROUP BY effective_name
+    ''')
+
+
+def build_search_query(search_value):
+    """Turn free text from the search box into an FTS5 prefix query.
+    
+    Each word becomes a quoted prefix term and all terms must match, so
+    "bbc on" finds "BBC One". Returns None if there is nothing to search for.
+    """
+    terms = re.findall(r"\w+", search_value)
+    if not terms:
+        return None
+    return " ".join(f'"{term}"*' for term in terms)
+
+
+def migrate_epg_programmes(cursor):
+    """Guide programmes, so refreshes upsert into a store instead of re-parsing the last guide."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS epg_programmes (
+            channel TEXT NOT NULL,
+            start TEXT NOT NULL,
+            stop TEXT NOT NULL,
+            title TEXT,
+            description TEXT,
+            PRIMARY KEY (channel, start)
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_epg_programmes_stop
+        ON epg_programmes(stop)
+    ''')
+
+
+def migrate_epg_coverage(cursor):
+    """How far ahead each portal's EPG is stored, so refreshes only fetch what is missing."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS epg_coverage (
+            portal TEXT PRIMARY KEY,
+            covered_until TEXT NOT NULL,
+            fetched_at TEXT NOT NULL
+        )
+    ''')
+
+
+# Schema migrations, applied in order. The database's user_version records
+# how many have run, so each one only runs once per database.
+SCHEMA_MIGRATIONS = [
+    migrate_channel_lookup_columns,
+    migrate_effective_columns,
+    migrate_channel_search_index,
+    migrate_channel_name_counts,
+    migrate_epg_programmes,
+    migrate_epg_coverage,
+]
 
 
 def init_db():
-    """Initialize the database and create tables if they don't exist."""
+    """Initialize the database, create tables and apply pending migrations."""
     conn = get_db_connection()
     cursor = conn.cursor()
     
@@ -672,11 +1250,6 @@ def init_db():
     ''')
     
     # Create indexes for better query performance
-    cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_channels_enabled 
-        ON channels(enabled)
-    ''')
-    
     cursor.execute('''
         CREATE INDEX IF NOT EXISTS idx_channels_name 
         ON channels(name)
@@ -688,105 +1261,337 @@ def init_db():
     ''')
     
     conn.commit()
+    
+    schema_version = cursor.execute("PRAGMA user_version").fetchone()[0]
+    for version, migration in enumerate(SCHEMA_MIGRATIONS, start=1):
+        if version <= schema_version:
+            continue
+        try:
+            migration(cursor)
+            cursor.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+            logger.info(f"Applied database migration {version}: {migration.__name__}")
+        except Exception:
+            conn.rollback()
+            conn.close()
+            raise
+    
     conn.close()
     logger.info("Database initialized successfully")
 
 
-def refresh_channels_cache():
-    """Refresh the channels cache from STB portals."""
-    logger.info("Starting channel cache refresh...")
-    portals = getPortals()
+async def fetch_portal_channels(portal):
+    """Fetch a portal's channel list and genres, trying each MAC until one works."""
+    url = portal["url"]
+    proxy = portal["proxy"]
+    logger.info(f"Fetching channels for portal: {portal['name']}")
+    
+    for mac in portal["macs"]:
+        logger.info(f"Trying MAC: {mac}")
+        try:
+            def fetch(token):
+                all_channels = stb.getAllChannels(url, mac, token, proxy)
+                genres = stb.getGenreNames(url, mac, token, proxy)
+                if all_channels and genres:
+                    return all_channels, genres
+            
+            result = await stb.withSessionTokenAsync(url, mac, proxy, fetch)
+            if result:
+                return result
+        except Exception as e:
+            logger.error(f"Error fetching from MAC {mac}: {e}")
+    
+    return None, None
+
+
+# Portal-provided channel fields; a change to any of these rewrites the row
+PORTAL_CHANNEL_FIELDS = ("portal_name", "name", "number", "genre", "logo", "cmd")
+
+
+def build_channel_rows(portal_id, portal, all_channels, genres):
+    """Turn a portal's channel list into rows for the channels table."""
+    portal_name = portal["name"]
+    
+    # Get existing settings from JSON config for migration
+    enabled_channels = portal.get("enabled channels", [])
+    custom_channel_names = portal.get("custom channel names", {})
+    custom_genres = portal.get("custom genres", {})
+    custom_channel_numbers = portal.get("custom channel numbers", {})
+    custom_epg_ids = portal.get("custom epg ids", {})
+    fallback_channels = portal.get("fallback channels", {})
+    
+    rows = []
+    for channel in all_channels:
+        channel_id = str(channel["id"])
+        genre_id = str(channel.get("tv_genre_id", ""))
+        row = {
+            "portal": portal_id,
+            "channel_id": channel_id,
+            "portal_name": portal_name,
+            "name": str(channel["name"]),
+            "number": str(channel["number"]),
+            "genre": str(genres.get(genre_id, "")),
+            "logo": str(channel.get("logo", "")),
+            "cmd": str(channel.get("cmd", "")),
+            "enabled": 1 if channel_id in enabled_channels else 0,
+            "custom_name": custom_channel_names.get(channel_id, ""),
+            "custom_number": custom_channel_numbers.get(channel_id, ""),
+            "custom_genre": custom_genres.get(channel_id, ""),
+            "custom_epg_id": custom_epg_ids.get(channel_id, ""),
+            "fallback_channel": fallback_channels.get(channel_id, ""),
+        }
+        row["content_hash"] = hashlib.sha1(
+            "\x1f".join(row[field] for field in PORTAL_CHANNEL_FIELDS).encode("utf-8")
+        ).hexdigest()
+        rows.append(row)
+    return rows
+
+
+def apply_channel_rows(cursor, portal_id, rows):
+    """Diff a portal's fetched rows against the cache and write only the changes.
+    
+    New channels are inserted, channels whose content hash changed (or that
+    come back after being removed) are updated, and cached channels missing
+    from the fetch are tombstoned. Returns (added, changed, removed) counts.
+    """
+    cursor.execute(
+        "SELECT channel_id, content_hash, removed FROM channels WHERE portal = ?",
+        (portal_id,),
+    )
+    existing = {row["channel_id"]: (row["content_hash"], row["removed"]) for row in cursor.fetchall()}
+    
+    added = []
+    changed = []
+    for row in rows:
+        cached = existing.get(row["channel_id"])
+        if cached is None:
+            added.append(row)
+        elif cached != (row["content_hash"], 0):
+            changed.append(row)
+    
+    fetched_ids = {row["channel_id"] for row in rows}
+    removed = [
+        (portal_id, channel_id)
+        for channel_id, (_, is_removed) in existing.items()
+        if channel_id not in fetched_ids and not is_removed
+    ]
+    
+    cursor.executemany('''
+        INSERT INTO channels (
+            portal, channel_id, portal_name, name, number, genre, logo,
+            enabled, custom_name, custom_number, custom_genre, 
+            custom_epg_id, fallback_channel, cmd, content_hash, removed
+        ) VALUES (
+            :portal, :channel_id, :portal_name, :name, :number, :genre, :logo,
+            :enabled, :custom_name, :custom_number, :custom_genre,
+            :custom_epg_id, :fallback_channel, :cmd, :content_hash, 0
+        )
+    ''', added)
+    
+    cursor.executemany('''
+        UPDATE channels SET
+            portal_name = :portal_name,
+            name = :name,
+            number = :number,
+            genre = :genre,
+            logo = :logo,
+            cmd = :cmd,
+            content_hash = :content_hash,
+            removed = 0
+        WHERE portal = :portal AND channel_id = :channel_id
+    ''', changed)
+    
+    cursor.executemany(
+        "UPDATE channels SET removed = 1 WHERE portal = ? AND channel_id = ?",
+        removed,
+    )
+    
+    return len(added), len(changed), len(removed)
+
+
+def write_channel_cache(write_queue, portals, refresh_stats):
+    """Single writer for a cache refresh: stores each fetched portal in one transaction.
+    
+    Reads (portal_id, all_channels, genres) items from write_queue until it
+    gets None, and records per-portal totals and added/changed/removed counts
+    in refresh_stats.
+    """
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    total_channels = 0
-    
-    for portal_id in portals:
-        portal = portals[portal_id]
-        if portal["enabled"] == "true":
-            portal_name = portal["name"]
-            url = portal["url"]
-            macs = list(portal["macs"].keys())
-            proxy = portal["proxy"]
-            
-            # Get existing settings from JSON config for migration
-            enabled_channels = portal.get("enabled channels", [])
-            custom_channel_names = portal.get("custom channel names", {})
-            custom_genres = portal.get("custom genres", {})
-            custom_channel_numbers = portal.get("custom channel numbers", {})
-            custom_epg_ids = portal.get("custom epg ids", {})
-            fallback_channels = portal.get("fallback channels", {})
-            
-            logger.info(f"Fetching channels for portal: {portal_name}")
+    try:
+        while True:
+            item = write_queue.get()
+            if item is None:
+                break
             
-            # Try each MAC until we get channel data
-            all_channels = None
-            genres = None
-            for mac in macs:
-                logger.info(f"Trying MAC: {mac}")
-                try:
-                    token = stb.getToken(url, mac, proxy)
-                    if token:
-                        stb.getProfile(url, mac, token, proxy)
-                        all_channels = stb.getAllChannels(url, mac, token, proxy)
-                        genres = stb.getGenreNames(url, mac, token, proxy)
-                        if all_channels and genres:
-                            break
-                except Exception as e:
-                    logger.error(f"Error fetching from MAC {mac}: {e}")
-                    all_channels = None
-                    genres = None
+            portal_id, all_channels, genres = item
+            portal_name = portals[portal_id]["name"]
+            if not (all_channels and genres):
+                logger.error(f"Failed to fetch channels for portal: {portal_name}")
+                continue
             
-            if all_channels and genres:
-                logger.info(f"Processing {len(all_channels)} channels for {portal_name}")
-                
-                for channel in all_channels:
-                    channel_id = str(channel["id"])
-                    channel_name = str(channel["name"])
-                    channel_number = str(channel["number"])
-                    genre_id = str(channel.get("tv_genre_id", ""))
-                    genre = str(genres.get(genre_id, ""))
-                    logo = str(channel.get("logo", ""))
-                    
-                    # Check if enabled (from JSON config)
-                    enabled = 1 if channel_id in enabled_channels else 0
-                    
-                    # Get custom values (from JSON config)
-                    custom_name = custom_channel_names.get(channel_id, "")
-                    custom_number = custom_channel_numbers.get(channel_id, "")
-                    custom_genre = custom_genres.get(channel_id, "")
-                    custom_epg_id = custom_epg_ids.get(channel_id, "")
-                    fallback_channel = fallback_channels.get(channel_id, "")
-                    
-                    # Upsert into database
-                    cursor.execute('''
-                        INSERT INTO channels (
-                            portal, channel_id, portal_name, name, number, genre, logo,
-                            enabled, custom_name, custom_number, custom_genre, 
-                            custom_epg_id, fallback_channel
-                        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                        ON CONFLICT(portal, channel_id) DO UPDATE SET
-                            portal_name = excluded.portal_name,
-                            name = excluded.name,
-                            number = excluded.number,
-                            genre = excluded.genre,
-                            logo = excluded.logo
-                    ''', (
-                        portal_id, channel_id, portal_name, channel_name, channel_number,
-                        genre, logo, enabled, custom_name, custom_number, custom_genre,
-                        custom_epg_id, fallback_channel
-                    ))
-                    
-                    total_channels += 1
-                
+            logger.info(f"Processing {len(all_channels)} channels for {portal_name}")
+            try:
+                rows = build_channel_rows(portal_id, portals[portal_id], all_channels, genres)
+                added, changed, removed = apply_channel_rows(cursor, portal_id, rows)
                 conn.commit()
-                logger.info(f"Successfully cached {len(all_channels)} channels for {portal_name}")
-            else:
-                logger.error(f"Failed to fetch channels for portal: {portal_name}")
+                if added or changed or removed:
+                    mark_channels_changed()
+            except Exception as e:
+                conn.rollback()
+                logger.error(f"Error caching channels for portal {portal_name}: {e}")
+                continue
+            
+            refresh_stats[portal_id] = {
+                "total": len(rows),
+                "added": added,
+                "changed": changed,
+                "removed": removed,
+            }
+            logger.info(
+                f"Successfully cached {len(rows)} channels for {portal_name} "
+                f"(added {added}, changed {changed}, removed {removed})"
+            )
+    finally:
+        conn.close()
+
+
+def portal_concurrency(settings):
+    """How many portals bulk refreshes fetch at once, from the 'portal concurrency' setting."""
+    try:
+        limit = int(settings.get("portal concurrency", PORTAL_CONCURRENCY))
+    except ValueError:
+        return PORTAL_CONCURRENCY
+    return min(max(limit, 1), PORTAL_MAX_CONCURRENCY)
+
+
+def refresh_channels_cache():
+    """Refresh the channels cache from STB portals.
     
-    conn.close()
-    logger.info(f"Channel cache refresh complete. Total channels: {total_channels}")
-    return total_channels
+    Up to 'portal concurrency' portals are fetched at once, each trying its
+    MACs in turn, and handed to a single writer thread as they arrive. With
+    at least as many slots as enabled portals the refresh takes as long as
+    the slowest portal. Returns the total number of channels fetched and how
+    many were added, changed and removed.
+    """
+    logger.info("Starting channel cache refresh...")
+    portals = getPortals()
+    enabled_portals = [
+        portal_id for portal_id in portals if portals[portal_id]["enabled"] == "true"
+    ]
+    
+    write_queue = queue.Queue()
+    refresh_stats = {}
+    writer = threading.Thread(
+        target=write_channel_cache, args=(write_queue, portals, refresh_stats), daemon=True
+    )
+    writer.start()
+    
+    async def fetch_portal(portal_id):
+        all_channels, genres = await fetch_portal_channels(portals[portal_id])
+        write_queue.put((portal_id, all_channels, genres))
+    
+    try:
+        asyncio.run(stb.gatherLimited(
+            [fetch_portal(portal_id) for portal_id in enabled_portals],
+            portal_concurrency(getSettings()),
+        ))
+    finally:
+        write_queue.put(None)
+        writer.join()
+    
+    summary = {
+        key: sum(stats[key] for stats in refresh_stats.values())
+        for key in ("total", "added", "changed", "removed")
+    }
+    logger.info(
+        f"Channel cache refresh complete. Total channels: {summary['total']} "
+        f"(added {summary['added']}, changed {summary['changed']}, removed {summary['removed']})"
+    )
+    return summary
+
+def get_cached_channel(portal_id, channel_id):
+    """Look up a single channel in the cache by (portal, channel_id)."""
+    try:
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT name, custom_name, cmd
+                FROM channels
+                WHERE portal = ? AND channel_id = ? AND removed = 0
+            ''', (portal_id, channel_id))
+            return cursor.fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logger.debug(f"Channel cache lookup failed for {portal_id}/{channel_id}: {e}")
+        return None
+
+
+def update_cached_cmd(portal_id, channel_id, cmd):
+    """Store a freshly looked up cmd, so the next tune doesn't start from a stale one."""
+    try:
+        conn = get_db_connection()
+        try:
+            conn.execute(
+                "UPDATE channels SET cmd = ? WHERE portal = ? AND channel_id = ? AND cmd IS NOT ?",
+                (cmd, portal_id, channel_id, cmd),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logger.debug(f"Channel cache cmd update failed for {portal_id}/{channel_id}: {e}")
+
+
+def fetch_channel_cmd(url, mac, token, proxy, channel_id, portal_id=None):
+    """Find a channel's (cmd, name) in the portal's full channel list, updating the cache when portal_id is given."""
+    for c in stb.getAllChannels(url, mac, token, proxy) or []:
+        if str(c["id"]) == channel_id:
+            if portal_id is not None:
+                update_cached_cmd(portal_id, channel_id, c["cmd"])
+            return c["cmd"], c["name"]
+    return None, None
+
+
+def resolve_channel_link(url, mac, proxy, channel_id, cmd=None, portal_id=None):
+    """Resolve a playable link for a channel using the given MAC.
+
+    With a cached cmd the portal is only contacted when the cmd needs a
+    create_link call. Without one, or when a link can't be made from the
+    cached one, the full channel list is fetched to find it and the cache is
+    updated. A cached token the portal has dropped is replaced and the
+    lookup retried before the MAC is given up on. Returns a
+    (link, channel_name) tuple; channel_name is only set when the channel
+    list had to be fetched.
+    """
+    if cmd and "http://localhost/" not in cmd:
+        return cmd.split(" ")[1], None
+
+    channel_name = None
+
+    def resolve(token):
+        nonlocal channel_name
+        if cmd:
+            link = stb.getLink(url, mac, token, cmd, proxy)
+            if link:
+                return link
+            # A stale cached cmd (e.g. a changed localhost id) is not the MAC's fault
+            logger.info(f"Cached cmd for channel {channel_id} gave no link, looking it up again")
+        fresh_cmd, channel_name = fetch_channel_cmd(url, mac, token, proxy, channel_id, portal_id)
+        if fresh_cmd:
+            return cmd_link(url, mac, token, fresh_cmd, proxy)
+
+    return stb.withSessionToken(url, mac, proxy, resolve), channel_name
+
+
+def cmd_link(url, mac, token, cmd, proxy):
+    """The playable link for a channel cmd, asking the portal to create one for localhost cmds."""
+    if "http://localhost/" in cmd:
+        return stb.getLink(url, mac, token, cmd, proxy)
+    return cmd.split(" ")[1]
 
 
 def authorise(f):
@@ -824,9 +1629,118 @@ def moveMac(portalId, mac):
     savePortals(portals)
 
 
-@app.route("/api/portals", methods=["GET"])
-@authorise
-def portals():
+def check_mac(url, mac, proxy, portal_name):
+    """Handshake with a MAC and read its expiry. Returns the expiry or None."""
+    logger.info(f"Testing MAC({mac}) for Portal({portal_name})...")
+    token = stb.getToken(url, mac, proxy)
+    if not token:
+        logger.error(f"Failed to get token for MAC({mac}) for Portal({portal_name})")
+        return None
+    logger.debug(f"Got token for MAC({mac}), getting profile and expiry...")
+    stb.getProfile(url, mac, token, proxy)
+    expiry = stb.getExpires(url, mac, token, proxy)
+    if not expiry:
+        logger.error(f"Failed to get expiry for MAC({mac}) for Portal({portal_name})")
+    return expiry
+
+
+class MacTestJobs:
+    """Runs MAC validation in the background and tracks progress per job."""
+    
+    def __init__(self, max_workers=8, per_portal=4, keep_finished=3600):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="MacTest")
+        self.per_portal = per_portal
+        self.keep_finished = keep_finished
+        self.jobs = {}  # Key: job id, Value: job status dict
+        self.portal_slots = {}  # Key: portal url, Value: semaphore capping in-flight tests
+        self.lock = threading.Lock()
+    
+    def start(self, portal_name, url, macs, proxy, on_complete=None):
+        """Queue MAC tests for a portal and return the job id.
+        
+        on_complete is called with {mac: expiry or None} once every MAC has
+        been tested; its return value becomes the job's message.
+        """
+        job_id = uuid.uuid4().hex
+        job = {
+            "id": job_id,
+            "portal": portal_name,
+            "status": "running",
+            "total": len(macs),
+            "results": [],
+            "message": None,
+            "started": time.time(),
+            "finished": None,
+        }
+        
+        with self.lock:
+            self._purge_finished()
+            self.jobs[job_id] = job
+            slots = self.portal_slots.setdefault(url, threading.BoundedSemaphore(self.per_portal))
+        
+        threading.Thread(
+            target=self._run, args=(job, url, macs, proxy, slots, on_complete), daemon=True
+        ).start()
+        logger.info(f"Started MAC test job {job_id} for Portal({portal_name}) with {len(macs)} MAC(s)")
+        return job_id
+    
+    def get(self, job_id):
+        """Return a snapshot of a job, or None if it is unknown or expired."""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            return dict(job, results=list(job["results"]))
+    
+    def _run(self, job, url, macs, proxy, slots, on_complete):
+        futures = []
+        for mac in macs:
+            # Wait for a free slot so one portal can't take over the whole pool
+            slots.acquire()
+            futures.append(self.executor.submit(self._test, job, url, mac, proxy, slots))
+        
+        expiries = {mac: future.result() for mac, future in zip(macs, futures)}
+        
+        message = None
+        if on_complete:
+            try:
+                message = on_complete(expiries)
+            except Exception as e:
+                logger.error(f"Error completing MAC test job {job['id']}: {e}")
+                message = f"Error: {e}"
+        
+        with self.lock:
+            job["message"] = message
+            job["status"] = "done"
+            job["finished"] = time.time()
+        logger.info(f"MAC test job {job['id']} finished: {message}")
+    
+    def _test(self, job, url, mac, proxy, slots):
+        try:
+            expiry = check_mac(url, mac, proxy, job["portal"])
+        except Exception as e:
+            logger.error(f"Error testing MAC({mac}) for Portal({job['portal']}): {e}")
+            expiry = None
+        finally:
+            slots.release()
+        
+        with self.lock:
+            job["results"].append({"mac": mac, "expiry": expiry, "ok": bool(expiry)})
+        return expiry
+    
+    def _purge_finished(self):
+        cutoff = time.time() - self.keep_finished
+        for job_id in [k for k, v in self.jobs.items() if v["finished"] and v["finished"] < cutoff]:
+            del self.jobs[job_id]
+
+
+# Global MAC test job runner
+mac_test_jobs = MacTestJobs(max_workers=8, per_portal=4)
+
+
+@app.route("/api/portals", methods=["GET"])
+@authorise
+def portals():
     """Legacy template route"""
     return render_template("portals.html", portals=getPortals())
 
@@ -841,8 +1755,6 @@ def portals_data():
 @app.route("/portal/add", methods=["POST"])
 @authorise
 def portalsAdd():
-    global cached_xmltv
-    cached_xmltv = None
     id = uuid.uuid4().hex
     enabled = "true"
     name = request.form["name"]
@@ -859,34 +1771,18 @@ def portalsAdd():
             flash("Error getting URL for Portal({})".format(name), "danger")
             return redirect("/portals", code=302)
 
-    macsd = {}
+    def addPortal(expiries):
+        global cached_xmltv
+        macsd = {mac: expiry for mac, expiry in expiries.items() if expiry}
 
-    for mac in macs:
-        logger.info(f"Testing MAC({mac}) for Portal({name})...")
-        token = stb.getToken(url, mac, proxy)
-        if token:
-            logger.debug(f"Got token for MAC({mac}), getting profile and expiry...")
-            stb.getProfile(url, mac, token, proxy)
-            expiry = stb.getExpires(url, mac, token, proxy)
-            if expiry:
-                macsd[mac] = expiry
-                logger.info(
-                    "Successfully tested MAC({}) for Portal({})".format(mac, name)
-                )
-                flash(
-                    "Successfully tested MAC({}) for Portal({})".format(mac, name),
-                    "success",
+        if len(macsd) == 0:
+            logger.error(
+                "None of the MACs tested OK for Portal({}). Adding not successfull".format(
+                    name
                 )
-                continue
-            else:
-                logger.error(f"Failed to get expiry for MAC({mac}) for Portal({name})")
-        else:
-            logger.error(f"Failed to get token for MAC({mac}) for Portal({name})")
-
-        logger.error("Error testing MAC({}) for Portal({})".format(mac, name))
-        flash("Error testing MAC({}) for Portal({})".format(mac, name), "danger")
+            )
+            return "None of the MACs tested OK for Portal({})".format(name)
 
-    if len(macsd) > 0:
         portal = {
             "enabled": enabled,
             "name": name,
@@ -904,23 +1800,17 @@ def portalsAdd():
         portals = getPortals()
         portals[id] = portal
         savePortals(portals)
+        cached_xmltv = None  # Rebuild the guide with the new portal on the next request
         logger.info("Portal({}) added!".format(portal["name"]))
+        return "Portal({}) added!".format(portal["name"])
 
-    else:
-        logger.error(
-            "None of the MACs tested OK for Portal({}). Adding not successfull".format(
-                name
-            )
-        )
-
-    return redirect("/portals", code=302)
+    jobId = mac_test_jobs.start(name, url, macs, proxy, addPortal)
+    return mac_test_response(jobId, name, len(macs))
 
 
 @app.route("/portal/update", methods=["POST"])
 @authorise
 def portalUpdate():
-    global cached_xmltv
-    cached_xmltv = None
     id = request.form["id"]
     enabled = request.form.get("enabled", "false")
     name = request.form["name"]
@@ -938,44 +1828,32 @@ def portalUpdate():
             flash("Error getting URL for Portal({})".format(name), "danger")
             return redirect("/portals", code=302)
 
-    portals = getPortals()
-    oldmacs = portals[id]["macs"]
-    macsout = {}
-    deadmacs = []
-
-    for mac in newmacs:
-        if retest or mac not in oldmacs.keys():
-            logger.info(f"Testing MAC({mac}) for Portal({name})...")
-            token = stb.getToken(url, mac, proxy)
-            if token:
-                logger.debug(f"Got token for MAC({mac}), getting profile and expiry...")
-                stb.getProfile(url, mac, token, proxy)
-                expiry = stb.getExpires(url, mac, token, proxy)
-                if expiry:
-                    macsout[mac] = expiry
-                    logger.info(
-                        "Successfully tested MAC({}) for Portal({})".format(mac, name)
-                    )
-                    flash(
-                        "Successfully tested MAC({}) for Portal({})".format(mac, name),
-                        "success",
-                    )
-                else:
-                    logger.error(f"Failed to get expiry for MAC({mac}) for Portal({name})")
-            else:
-                logger.error(f"Failed to get token for MAC({mac}) for Portal({name})")
-
-            if mac not in list(macsout.keys()):
-                deadmacs.append(mac)
+    oldmacs = getPortals()[id]["macs"]
+    testmacs = [mac for mac in newmacs if retest or mac not in oldmacs.keys()]
 
-        if mac in oldmacs.keys() and mac not in deadmacs:
-            macsout[mac] = oldmacs[mac]
-
-        if mac not in macsout.keys():
-            logger.error("Error testing MAC({}) for Portal({})".format(mac, name))
-            flash("Error testing MAC({}) for Portal({})".format(mac, name), "danger")
+    def updatePortal(expiries):
+        global cached_xmltv
+        portals = getPortals()
+        if id not in portals:
+            return "Portal({}) no longer exists".format(name)
+
+        oldmacs = portals[id]["macs"]
+        macsout = {}
+        for mac in newmacs:
+            if mac in expiries:
+                if expiries[mac]:
+                    macsout[mac] = expiries[mac]
+            elif mac in oldmacs.keys():
+                macsout[mac] = oldmacs[mac]
+
+        if len(macsout) == 0:
+            logger.error(
+                "None of the MACs tested OK for Portal({}). Adding not successfull".format(
+                    name
+                )
+            )
+            return "None of the MACs tested OK for Portal({})".format(name)
 
-    if len(macsout) > 0:
         portals[id]["enabled"] = enabled
         portals[id]["name"] = name
         portals[id]["url"] = url
@@ -984,17 +1862,34 @@ def portalUpdate():
         portals[id]["epg offset"] = epgOffset
         portals[id]["proxy"] = proxy
         savePortals(portals)
+        cached_xmltv = None  # Rebuild the guide with the changed portal on the next request
         logger.info("Portal({}) updated!".format(name))
-        flash("Portal({}) updated!".format(name), "success")
+        return "Portal({}) updated!".format(name)
 
-    else:
-        logger.error(
-            "None of the MACs tested OK for Portal({}). Adding not successfull".format(
-                name
-            )
-        )
+    jobId = mac_test_jobs.start(name, url, testmacs, proxy, updatePortal)
+    return mac_test_response(jobId, name, len(testmacs))
 
-    return redirect("/portals", code=302)
+
+def mac_test_response(job_id, portal_name, count):
+    """Answer a portal add/update with the MAC test job that is now running."""
+    if "application/json" in request.headers.get("Accept", ""):
+        return jsonify({"job": job_id, "status": f"/api/portal/jobs/{job_id}"}), 202
+
+    flash(
+        "Testing {} MAC(s) for Portal({}) in the background".format(count, portal_name),
+        "success",
+    )
+    return redirect(f"/api/portals?job={job_id}", code=302)
+
+
+@app.route("/api/portal/jobs/<job_id>", methods=["GET"])
+@authorise
+def portal_job_status(job_id):
+    """Progress and per-MAC results of a MAC test job."""
+    job = mac_test_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
 
 
 @app.route("/portal/remove", methods=["POST"])
@@ -1033,6 +1928,197 @@ def editor():
     
 
 
+class ChannelCountCache:
+    """COUNT(*) results for editor queries, dropped whenever the channels change."""
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.counts = {}
+        self.version = None
+        self.lock = threading.Lock()
+
+    def count(self, cursor, query, params=()):
+        key = (dbPath, query, tuple(params))
+        version = channels_version
+        with self.lock:
+            if self.version != version:
+                self.counts.clear()
+                self.version = version
+            if key in self.counts:
+                return self.counts[key]
+        
+        cursor.execute(query, params)
+        count = cursor.fetchone()[0]
+        
+        with self.lock:
+            # Only keep the result if no write landed while it was counted
+            if self.version == version == channels_version:
+                if len(self.counts) >= self.max_entries:
+                    self.counts.clear()
+                self.counts[key] = count
+        return count
+
+
+editor_counts = ChannelCountCache()
+
+# Sort expressions for the editor's DataTables columns
+EDITOR_SORT_COLUMNS = {
+    0: "enabled",
+    1: "channel_id",  # Play button, not sortable but needs a column
+    2: "effective_name",
+    3: "effective_genre",
+    4: "effective_number",
+    5: "COALESCE(NULLIF(custom_epg_id, ''), portal || channel_id)",
+    6: "fallback_channel",
+    7: "portal_name",
+}
+
+
+def keyset_condition(sort_keys, values):
+    """SQL condition selecting the rows that sort after the given key values.
+    
+    sort_keys is a list of (expression, direction) pairs ending in a unique
+    tiebreak. NULLs sort first in ascending order, as SQLite orders them.
+    Returns (sql, params).
+    """
+    levels = []
+    params = []
+    for i, (expression, direction) in enumerate(sort_keys):
+        terms = []
+        for (previous, _), value in zip(sort_keys[:i], values[:i]):
+            terms.append(f"{previous} IS ?")
+            params.append(value)
+        if direction == "asc":
+            terms.append(f"({expression} > ? OR (? IS NULL AND {expression} IS NOT NULL))")
+        else:
+            terms.append(f"({expression} < ? OR ({expression} IS NULL AND ? IS NOT NULL))")
+        params.extend([values[i], values[i]])
+        levels.append("(" + " AND ".join(terms) + ")")
+    
+    condition = "(" + " OR ".join(levels) + ")"
+    
+    # Redundant bound on the leading key so SQLite can seek into its index
+    # instead of scanning from the first row. NULLs sort last when descending.
+    leading, direction = sort_keys[0]
+    if values[0] is not None:
+        if direction == "asc":
+            condition = f"{leading} >= ? AND {condition}"
+        else:
+            condition = f"({leading} <= ? OR {leading} IS NULL) AND {condition}"
+        params.insert(0, values[0])
+    
+    return condition, params
+
+
+def encode_page_cursor(fingerprint, values):
+    payload = json.dumps({"q": fingerprint, "v": values}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+
+def decode_page_cursor(cursor, fingerprint, key_count):
+    """Sort-key values from a cursor, or None if it doesn't belong to this query."""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(payload, dict) or payload.get("q") != fingerprint:
+        return None
+    values = payload.get("v")
+    if not isinstance(values, list) or len(values) != key_count:
+        return None
+    return values
+
+
+def build_editor_filters(args):
+    """FROM/WHERE clause and parameters for the editor's filter parameters.
+    
+    Understands portal, genre, duplicates and search[value], as sent by the
+    editor table. Returns (base_query, params, search_query), where
+    search_query is None when there is no search.
+    """
+    search_value = args.get('search[value]', default='')
+    portal_filter = args.get('portal', default='')
+    genre_filter = args.get('genre', default='')
+    duplicate_filter = args.get('duplicates', default='')
+    
+    # Base query
+    base_query = "FROM channels"
+    params = []
+    
+    # Full-text search via the FTS5 index, ranked by bm25 with channel
+    # names weighted above genre, number and portal matches
+    search_query = build_search_query(search_value)
+    if search_query:
+        base_query += """
+            JOIN (
+                SELECT rowid AS fts_rowid,
+                    bm25(channels_fts, 10.0, 10.0, 2.0, 2.0, 1.0, 1.0, 1.0) AS search_rank
+                FROM channels_fts
+                WHERE channels_fts MATCH ?
+            ) AS search ON search.fts_rowid = channels.rowid"""
+        params.append(search_query)
+    
+    base_query += " WHERE removed = 0"
+    
+    # Add portal filter
+    if portal_filter:
+        base_query += " AND portal_name = ?"
+        params.append(portal_filter)
+    
+    # Add genre filter (check both custom_genre and genre)
+    if genre_filter:
+        base_query += " AND effective_genre = ?"
+        params.append(genre_filter)
+    
+    # Add duplicate filter (only for enabled channels)
+    if duplicate_filter == 'enabled_only':
+        # Show only channels where the name appears multiple times among enabled channels
+        base_query += """ AND enabled = 1 AND effective_name IN (
+            SELECT name FROM channel_name_counts WHERE count > 1
+        )"""
+    elif duplicate_filter == 'unique_only':
+        # Show only channels where the name appears once among enabled channels
+        base_query += """ AND effective_name IN (
+            SELECT name FROM channel_name_counts WHERE count = 1
+        )"""
+    
+    return base_query, params, search_query
+
+
+def build_editor_sort_keys(args, search_query=None):
+    """(expression, direction) pairs for the DataTables order[] parameters.
+    
+    The list always ends with the primary key, so every row has a unique position.
+    """
+    # Build the sort keys handling multiple columns
+    sort_keys = []
+    i = 0
+    while True:
+        col_idx_key = f'order[{i}][column]'
+        dir_key = f'order[{i}][dir]'
+        
+        if col_idx_key not in args:
+            break
+            
+        col_idx = args.get(col_idx_key, type=int)
+        direction = 'desc' if args.get(dir_key, default='asc').lower() == 'desc' else 'asc'
+        sort_keys.append((EDITOR_SORT_COLUMNS.get(col_idx, 'effective_name'), direction))
+        i += 1
+        
+    # Best matches first unless the user picked a sort column, in which
+    # case relevance only breaks ties
+    if search_query:
+        sort_keys.append(('search_rank', 'asc'))
+    
+    if not sort_keys:
+        sort_keys.append(('effective_name', 'asc'))
+    
+    # The primary key makes every position unique, which keyset paging needs
+    sort_keys.extend([('portal', 'asc'), ('channel_id', 'asc')])
+    
+    return sort_keys
+
+
 @app.route("/api/editor_data", methods=["GET"])
 @app.route("/editor_data", methods=["GET"])  # Keep old route for backward compatibility
 @authorise
@@ -1043,145 +2129,76 @@ def editor_data():
         draw = request.args.get('draw', type=int, default=1)
         start = request.args.get('start', type=int, default=0)
         length = request.args.get('length', type=int, default=250)
-        search_value = request.args.get('search[value]', default='')
-        
-        # Get custom filter parameters
-        portal_filter = request.args.get('portal', default='')
-        genre_filter = request.args.get('genre', default='')
-        duplicate_filter = request.args.get('duplicates', default='')
-        
-        # Map column indices to database columns
-        column_map = {
-            0: 'enabled',
-            1: 'channel_id',  # Play button, not sortable but needs a column
-            2: 'name',  # Channel name
-            3: 'genre',
-            4: 'number',
-            5: 'epg_id',  # EPG ID - Special handling
-            6: 'fallback_channel',
-            7: 'portal_name'
-        }
         
         # Build the SQL query
         conn = get_db_connection()
         cursor = conn.cursor()
         
-        # Base query
-        base_query = "FROM channels WHERE 1=1"
-        params = []
-        
-        # Add portal filter
-        if portal_filter:
-            base_query += " AND portal_name = ?"
-            params.append(portal_filter)
+        base_query, params, search_query = build_editor_filters(request.args)
         
-        # Add genre filter (check both custom_genre and genre)
-        if genre_filter:
-            base_query += " AND (COALESCE(NULLIF(custom_genre, ''), genre) = ?)"
-            params.append(genre_filter)
-        
-        # Add duplicate filter (only for enabled channels)
-        if duplicate_filter == 'enabled_only':
-            # Show only channels where the name appears multiple times among enabled channels
-            base_query += """ AND enabled = 1 AND COALESCE(NULLIF(custom_name, ''), name) IN (
-                SELECT COALESCE(NULLIF(custom_name, ''), name)
-                FROM channels
-                WHERE enabled = 1
-                GROUP BY COALESCE(NULLIF(custom_name, ''), name)
-                HAVING COUNT(*) > 1
-            )"""
-        elif duplicate_filter == 'unique_only':
-            # Show only channels where the name appears once among enabled channels
-            base_query += """ AND COALESCE(NULLIF(custom_name, ''), name) IN (
-                SELECT COALESCE(NULLIF(custom_name, ''), name)
-                FROM channels
-                WHERE enabled = 1
-                GROUP BY COALESCE(NULLIF(custom_name, ''), name)
-                HAVING COUNT(*) = 1
-            )"""
-        
-        # Add search filter if provided
-        if search_value:
-            base_query += """ AND (
-                name LIKE ? OR 
-                custom_name LIKE ? OR 
-                genre LIKE ? OR 
-                custom_genre LIKE ? OR
-                number LIKE ? OR
-                custom_number LIKE ? OR
-                portal_name LIKE ?
-            )"""
-            search_param = f"%{search_value}%"
-            params.extend([search_param] * 7)
+        # Counts are cached until the next write to the channels table
+        records_total = editor_counts.count(cursor, "SELECT COUNT(*) FROM channels WHERE removed = 0")
+        if base_query == "FROM channels WHERE removed = 0":
+            records_filtered = records_total
+        else:
+            records_filtered = editor_counts.count(cursor, f"SELECT COUNT(*) {base_query}", params)
         
-        # Get total count (without filters)
-        cursor.execute("SELECT COUNT(*) FROM channels")
-        records_total = cursor.fetchone()[0]
+        sort_keys = build_editor_sort_keys(request.args, search_query)
+        order_clause = "ORDER BY " + ", ".join(f"{expression} {direction}" for expression, direction in sort_keys)
+        sort_columns = ", ".join(f"{expression} AS sort_key_{n}" for n, (expression, _) in enumerate(sort_keys))
         
-        # Get filtered count
-        count_query = f"SELECT COUNT(*) {base_query}"
-        cursor.execute(count_query, params)
-        records_filtered = cursor.fetchone()[0]
+        # Keyset paging: a cursor from the previous page seeks straight to the
+        # rows after it instead of walking past `start` rows with OFFSET
+        fingerprint = hashlib.sha1(
+            json.dumps([base_query, params, order_clause]).encode()
+        ).hexdigest()[:16]
+        after = request.args.get('after', default='')
+        after_values = decode_page_cursor(after, fingerprint, len(sort_keys)) if after else None
         
-        # Build the ORDER BY clause handling multiple columns
-        order_clauses = []
-        i = 0
-        while True:
-            col_idx_key = f'order[{i}][column]'
-            dir_key = f'order[{i}][dir]'
-            
-            if col_idx_key not in request.args:
-                break
-                
-            col_idx = request.args.get(col_idx_key, type=int)
-            direction = request.args.get(dir_key, default='asc')
-            col_name = column_map.get(col_idx, 'name')
-            
-            if col_name == 'name':
-                order_clauses.append(f"COALESCE(NULLIF(custom_name, ''), name) {direction}")
-            elif col_name == 'genre':
-                order_clauses.append(f"COALESCE(NULLIF(custom_genre, ''), genre) {direction}")
-            elif col_name == 'number':
-                order_clauses.append(f"CAST(COALESCE(NULLIF(custom_number, ''), number) AS INTEGER) {direction}")
-            elif col_name == 'epg_id':
-                order_clauses.append(f"COALESCE(NULLIF(custom_epg_id, ''), portal || channel_id) {direction}")
-            else:
-                order_clauses.append(f"{col_name} {direction}")
-            i += 1
-            
-        if not order_clauses:
-            order_clauses.append("COALESCE(NULLIF(custom_name, ''), name) ASC")
-            
-        order_clause = "ORDER BY " + ", ".join(order_clauses)
+        page_query = base_query
+        page_params = list(params)
+        if after_values is not None:
+            condition, condition_params = keyset_condition(sort_keys, after_values)
+            page_query += f" AND {condition}"
+            page_params.extend(condition_params)
+            page_params.extend([length, 0])
+        else:
+            page_params.extend([length, start])
         
         data_query = f"""
             SELECT 
                 portal, channel_id, portal_name, name, number, genre, logo,
                 enabled, custom_name, custom_number, custom_genre, 
-                custom_epg_id, fallback_channel
-            {base_query}
+                custom_epg_id, fallback_channel, {sort_columns}
+            {page_query}
             {order_clause}
             LIMIT ? OFFSET ?
         """
         
-        params.extend([length, start])
-        cursor.execute(data_query, params)
+        cursor.execute(data_query, page_params)
         
         # Store the channel data results first
         channel_rows = cursor.fetchall()
         
-        # Get duplicate counts for enabled channels
-        duplicate_counts_query = """
-            SELECT 
-                COALESCE(NULLIF(custom_name, ''), name) as channel_name,
-                COUNT(*) as count
-            FROM channels
-            WHERE enabled = 1
-            GROUP BY COALESCE(NULLIF(custom_name, ''), name)
-            HAVING COUNT(*) > 1
-        """
-        cursor.execute(duplicate_counts_query)
-        duplicate_counts = {row['channel_name']: row['count'] for row in cursor.fetchall()}
+        # A full page may have more rows after it
+        next_cursor = None
+        if channel_rows and len(channel_rows) == length:
+            last_row = channel_rows[-1]
+            next_cursor = encode_page_cursor(
+                fingerprint, [last_row[f"sort_key_{n}"] for n in range(len(sort_keys))]
+            )
+        
+        # Get duplicate counts for the enabled channels on this page
+        page_names = list({row['custom_name'] or row['name'] or '' for row in channel_rows if row['enabled']})
+        duplicate_counts = {}
+        if page_names:
+            placeholders = ", ".join("?" * len(page_names))
+            cursor.execute(f"""
+                SELECT name as channel_name, count
+                FROM channel_name_counts
+                WHERE name IN ({placeholders}) AND count > 1
+            """, page_names)
+            duplicate_counts = {row['channel_name']: row['count'] for row in cursor.fetchall()}
         
         # Format the results for DataTables
         channels = []
@@ -1215,7 +2232,8 @@ def editor_data():
             "draw": draw,
             "recordsTotal": records_total,
             "recordsFiltered": records_filtered,
-            "data": channels
+            "data": channels,
+            "nextCursor": next_cursor
         })
         
     except Exception as e:
@@ -1241,7 +2259,7 @@ def editor_portals():
         cursor.execute("""
             SELECT DISTINCT portal_name
             FROM channels
-            WHERE portal_name IS NOT NULL AND portal_name != ''
+            WHERE removed = 0 AND portal_name IS NOT NULL AND portal_name != ''
             ORDER BY portal_name
         """)
         
@@ -1264,11 +2282,11 @@ def editor_genres():
         cursor = conn.cursor()
         
         cursor.execute("""
-            SELECT DISTINCT COALESCE(NULLIF(custom_genre, ''), genre) as genre
+            SELECT DISTINCT effective_genre as genre
             FROM channels
-            WHERE COALESCE(NULLIF(custom_genre, ''), genre) IS NOT NULL 
-                AND COALESCE(NULLIF(custom_genre, ''), genre) != ''
-                AND COALESCE(NULLIF(custom_genre, ''), genre) != 'None'
+            WHERE removed = 0
+                AND effective_genre != ''
+                AND effective_genre != 'None'
             ORDER BY genre
         """)
         
@@ -1291,12 +2309,8 @@ def editor_duplicate_counts():
         cursor = conn.cursor()
         
         cursor.execute("""
-            SELECT 
-                COALESCE(NULLIF(custom_name, ''), name) as channel_name,
-                COUNT(*) as count
-            FROM channels
-            WHERE enabled = 1
-            GROUP BY COALESCE(NULLIF(custom_name, ''), name)
+            SELECT name as channel_name, count
+            FROM channel_name_counts
             ORDER BY count DESC, channel_name
         """)
         
@@ -1319,52 +2333,37 @@ def editor_deactivate_duplicates():
         conn = get_db_connection()
         cursor = conn.cursor()
         
-        # Find all duplicate channels (using ROW_NUMBER to identify which to keep)
-        find_duplicates_query = """
+        # Disable every enabled duplicate except the first of each name in a
+        # single statement (ROW_NUMBER picks which one to keep)
+        cursor.execute("""
             WITH ranked_channels AS (
                 SELECT 
                     portal,
                     channel_id,
-                    COALESCE(NULLIF(custom_name, ''), name) as effective_name,
                     ROW_NUMBER() OVER (
-                        PARTITION BY COALESCE(NULLIF(custom_name, ''), name) 
+                        PARTITION BY effective_name 
                         ORDER BY portal, channel_id
                     ) as row_num
                 FROM channels
-                WHERE enabled = 1
+                WHERE enabled = 1 AND removed = 0 AND effective_name IN (
+                    SELECT name FROM channel_name_counts WHERE count > 1
+                )
             )
-            SELECT portal, channel_id, effective_name, row_num
-            FROM ranked_channels
-            WHERE effective_name IN (
-                SELECT effective_name
-                FROM ranked_channels
-                GROUP BY effective_name
-                HAVING COUNT(*) > 1
+            UPDATE channels
+            SET enabled = 0
+            WHERE (portal, channel_id) IN (
+                SELECT portal, channel_id FROM ranked_channels WHERE row_num > 1
             )
-            AND row_num > 1
-            ORDER BY effective_name, row_num
-        """
-        
-        cursor.execute(find_duplicates_query)
-        duplicates_to_deactivate = cursor.fetchall()
-        
-        # Deactivate the duplicate channels
-        deactivated_count = 0
-        for dup in duplicates_to_deactivate:
-            cursor.execute("""
-                UPDATE channels
-                SET enabled = 0
-                WHERE portal = ? AND channel_id = ?
-            """, (dup['portal'], dup['channel_id']))
-            deactivated_count += 1
+            RETURNING portal, channel_id
+        """)
+        deactivated = cursor.fetchall()
+        deactivated_count = len(deactivated)
+        reset_epg_coverage(cursor, [row["portal"] for row in deactivated])
         
         conn.commit()
+        mark_channels_changed()
         conn.close()
         
-        # Reset playlist cache to force regeneration
-        global last_playlist_host
-        last_playlist_host = None
-        
         logger.info(f"Deactivated {deactivated_count} duplicate channels")
         
         return flask.jsonify({
@@ -1382,103 +2381,123 @@ def editor_deactivate_duplicates():
         }), 500
 
 
+@app.route("/api/editor/bulk", methods=["POST"])
+@app.route("/editor/bulk", methods=["POST"])
+@authorise
+def editor_bulk():
+    """Apply an action to every channel matching the editor's current filters.
+    
+    Takes the same portal/genre/duplicates/search[value] parameters as
+    editor_data plus action: enable, disable, set_genre (with value) or
+    renumber (numbers channels from start, default 1, in the order[] sort).
+    """
+    action = request.values.get('action', default='')
+    if action not in ('enable', 'disable', 'set_genre', 'renumber'):
+        return flask.jsonify({"success": False, "error": f"Unknown action: {action}"}), 400
+    
+    base_query, params, search_query = build_editor_filters(request.values)
+    matching = f"SELECT channels.rowid {base_query}"
+    
+    if action in ('enable', 'disable'):
+        query = f"UPDATE channels SET enabled = ? WHERE rowid IN ({matching})"
+        params = [1 if action == 'enable' else 0] + params
+    elif action == 'set_genre':
+        query = f"UPDATE channels SET custom_genre = ? WHERE rowid IN ({matching})"
+        params = [request.values.get('value', default='')] + params
+    else:
+        start_number = request.values.get('start', type=int, default=1)
+        sort_keys = build_editor_sort_keys(request.values, search_query)
+        order_clause = ", ".join(f"{expression} {direction}" for expression, direction in sort_keys)
+        query = f"""
+            UPDATE channels
+            SET custom_number = CAST(numbered.number AS TEXT)
+            FROM (
+                SELECT channels.rowid AS channel_rowid,
+                    ROW_NUMBER() OVER (ORDER BY {order_clause}) + ? - 1 AS number
+                {base_query}
+            ) AS numbered
+            WHERE channels.rowid = numbered.channel_rowid
+        """
+        params = [start_number] + params
+    query += " RETURNING portal"
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(query, params)
+        updated_portals = [row["portal"] for row in cursor.fetchall()]
+        updated = len(updated_portals)
+        if action != 'set_genre':
+            # Enabling, disabling and renumbering change what the guide stores
+            reset_epg_coverage(cursor, updated_portals)
+        conn.commit()
+        mark_channels_changed()
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error in editor_bulk ({action}): {e}")
+        return flask.jsonify({"success": False, "updated": 0, "error": str(e)}), 500
+    finally:
+        conn.close()
+    
+    logger.info(f"Bulk {action} updated {updated} channels")
+    
+    threading.Thread(target=refresh_xmltv, daemon=True).start()
+    Thread(target=refresh_lineup).start()
+    
+    return flask.jsonify({"success": True, "action": action, "updated": updated})
+
+
+# Editor form field, key holding the new value in each edit, channels column
+EDITOR_EDIT_FIELDS = (
+    ("enabledEdits", "enabled", "enabled"),
+    ("numberEdits", "custom number", "custom_number"),
+    ("nameEdits", "custom name", "custom_name"),
+    ("genreEdits", "custom genre", "custom_genre"),
+    ("epgEdits", "custom epg id", "custom_epg_id"),
+    ("fallbackEdits", "channel name", "fallback_channel"),
+)
+
+
 @app.route("/api/editor/save", methods=["POST"])
 @app.route("/editor/save", methods=["POST"])  # Keep old route for backward compatibility
 @authorise
 def editorSave():
-    global cached_xmltv, last_playlist_host
-    #cached_xmltv = None # The tv guide will be updated next time its downloaded
-    threading.Thread(target=refresh_xmltv, daemon=True).start() #Force update in a seperate thread
-    last_playlist_host = None     # The playlist will be updated next time it is downloaded
-    Thread(target=refresh_lineup).start() # Update the channel lineup for plex.
-    
-    enabledEdits = json.loads(request.form["enabledEdits"])
-    numberEdits = json.loads(request.form["numberEdits"])
-    nameEdits = json.loads(request.form["nameEdits"])
-    genreEdits = json.loads(request.form["genreEdits"])
-    epgEdits = json.loads(request.form["epgEdits"])
-    fallbackEdits = json.loads(request.form["fallbackEdits"])
+    global cached_xmltv
     
     # Update SQLite database
     conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
-        # Process enabled/disabled edits
-        for edit in enabledEdits:
-            portal = edit["portal"]
-            channel_id = edit["channel id"]
-            enabled = 1 if edit["enabled"] else 0
-            
-            cursor.execute('''
-                UPDATE channels 
-                SET enabled = ? 
-                WHERE portal = ? AND channel_id = ?
-            ''', (enabled, portal, channel_id))
-        
-        # Process custom number edits
-        for edit in numberEdits:
-            portal = edit["portal"]
-            channel_id = edit["channel id"]
-            custom_number = edit["custom number"]
-            
-            cursor.execute('''
-                UPDATE channels 
-                SET custom_number = ? 
-                WHERE portal = ? AND channel_id = ?
-            ''', (custom_number, portal, channel_id))
-        
-        # Process custom name edits
-        for edit in nameEdits:
-            portal = edit["portal"]
-            channel_id = edit["channel id"]
-            custom_name = edit["custom name"]
-            
-            cursor.execute('''
-                UPDATE channels 
-                SET custom_name = ? 
-                WHERE portal = ? AND channel_id = ?
-            ''', (custom_name, portal, channel_id))
-        
-        # Process custom genre edits
-        for edit in genreEdits:
-            portal = edit["portal"]
-            channel_id = edit["channel id"]
-            custom_genre = edit["custom genre"]
-            
-            cursor.execute('''
-                UPDATE channels 
-                SET custom_genre = ? 
-                WHERE portal = ? AND channel_id = ?
-            ''', (custom_genre, portal, channel_id))
-        
-        # Process custom EPG ID edits
-        for edit in epgEdits:
-            portal = edit["portal"]
-            channel_id = edit["channel id"]
-            custom_epg_id = edit["custom epg id"]
-            
-            cursor.execute('''
-                UPDATE channels 
-                SET custom_epg_id = ? 
-                WHERE portal = ? AND channel_id = ?
-            ''', (custom_epg_id, portal, channel_id))
-        
-        # Process fallback channel edits
-        for edit in fallbackEdits:
-            portal = edit["portal"]
-            channel_id = edit["channel id"]
-            fallback_channel = edit["channel name"]
+        # One executemany per field, all in a single transaction. The editor
+        # records every change, so only the last edit of each channel is kept.
+        guide_portals = set()
+        for form_field, edit_key, column in EDITOR_EDIT_FIELDS:
+            latest = {}
+            for edit in json.loads(request.form[form_field]):
+                value = edit[edit_key]
+                if column == "enabled":
+                    value = 1 if value else 0
+                latest[(edit["portal"], edit["channel id"])] = value
             
-            cursor.execute('''
-                UPDATE channels 
-                SET fallback_channel = ? 
-                WHERE portal = ? AND channel_id = ?
-            ''', (fallback_channel, portal, channel_id))
+            if latest:
+                cursor.executemany(
+                    f"UPDATE channels SET {column} = ? WHERE portal = ? AND channel_id = ?",
+                    [(value, portal, channel_id) for (portal, channel_id), value in latest.items()],
+                )
+                if column in ("enabled", "custom_number", "custom_epg_id"):
+                    guide_portals.update(portal for portal, _ in latest)
         
+        reset_epg_coverage(cursor, guide_portals)
         conn.commit()
+        mark_channels_changed()
         logger.info("Channel edits saved to database!")
         
+        # Rebuild derived data once the edits are visible to other connections
+        #cached_xmltv = None # The tv guide will be updated next time its downloaded
+        threading.Thread(target=refresh_xmltv, daemon=True).start() #Force update in a seperate thread
+        Thread(target=refresh_lineup).start() # Update the channel lineup for plex.
+        
     except Exception as e:
         conn.rollback()
         logger.error(f"Error saving channel edits: {e}")
@@ -1509,8 +2528,10 @@ def editorReset():
                 custom_epg_id = '',
                 fallback_channel = ''
         ''')
+        reset_epg_coverage(cursor)
         
         conn.commit()
+        mark_channels_changed()
         logger.info("All channel customizations reset!")
         flash("Playlist reset!", "success")
         
@@ -1530,9 +2551,9 @@ def editorReset():
 def editorRefresh():
     """Manually trigger a refresh of the channel cache."""
     try:
-        total = refresh_channels_cache()
-        logger.info(f"Channel cache refreshed: {total} channels")
-        return flask.jsonify({"status": "success", "total": total})
+        summary = refresh_channels_cache()
+        logger.info(f"Channel cache refreshed: {summary['total']} channels")
+        return flask.jsonify({"status": "success", **summary})
     except Exception as e:
         logger.error(f"Error refreshing channel cache: {e}")
         return flask.jsonify({"status": "error", "message": str(e)}), 500
@@ -1570,267 +2591,706 @@ def save():
     flash("Settings saved!", "success")
     return redirect("/settings", code=302)
 
+# Settings that change the generated playlist
+PLAYLIST_SETTINGS = (
+    "sort playlist by channel name",
+    "use channel numbers",
+    "sort playlist by channel number",
+    "use channel genres",
+    "sort playlist by channel genre",
+    "output format",
+)
+
+
+class CachedArtifact:
+    """A generated playlist or lineup with its validators and pre-compressed bodies."""
+    
+    def __init__(self, key, text, last_modified=None):
+        self.key = key
+        self.text = text
+        self.body = text.encode("utf-8")
+        self.etag = hashlib.sha1(self.body).hexdigest()
+        self.last_modified = last_modified or datetime.now(timezone.utc).replace(microsecond=0)
+        self.encoded = {"gzip": gzip.compress(self.body, compresslevel=6)}
+        if brotli is not None:
+            self.encoded["br"] = brotli.compress(self.body)
+
+
+def playlist_key(settings):
+    """Everything the playlist depends on: channel data, host and playlist settings."""
+    return (channels_version, host) + tuple(settings.get(setting) for setting in PLAYLIST_SETTINGS)
+
+
+def get_playlist_artifact():
+    """The current playlist, rebuilt only when its channels, settings or host changed."""
+    artifact = playlist_artifact
+    if artifact is not None and artifact.key == playlist_key(getSettings()):
+        return artifact
+    
+    with playlist_lock:
+        artifact = playlist_artifact
+        if artifact is None or artifact.key != playlist_key(getSettings()):
+            artifact = generate_playlist()
+        return artifact
+
+
+def send_artifact(artifact, mimetype):
+    """Serve a pre-built artifact with ETag/Last-Modified and the best encoding the client accepts."""
+    encoding = None
+    for candidate in ("br", "gzip"):
+        if candidate in artifact.encoded and request.accept_encodings[candidate]:
+            encoding = candidate
+            break
+    
+    response = Response(artifact.encoded[encoding] if encoding else artifact.body, mimetype=mimetype)
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    response.headers["Vary"] = "Accept-Encoding"
+    # Each encoding is a different representation, so it gets its own ETag
+    response.set_etag(f"{artifact.etag}-{encoding}" if encoding else artifact.etag)
+    response.last_modified = artifact.last_modified
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def build_channel_filters(args):
+    """WHERE clause for the playlist and lineup filters.
+    
+    portal matches a portal id or name, genre (or group, its M3U name)
+    matches the channel's effective genre. Each may be given more than
+    once to match any of the values. Only enabled channels are listed.
+    Returns (where, params).
+    """
+    clauses = ["enabled = 1", "removed = 0"]
+    params = []
+    
+    portals = [portal for portal in args.getlist("portal") if portal]
+    if portals:
+        placeholders = ", ".join("?" * len(portals))
+        clauses.append(f"(portal IN ({placeholders}) OR portal_name IN ({placeholders}))")
+        params.extend(portals + portals)
+    
+    genres = [genre for genre in args.getlist("genre") + args.getlist("group") if genre]
+    if genres:
+        clauses.append(f"effective_genre IN ({', '.join('?' * len(genres))})")
+        params.extend(genres)
+    
+    return " AND ".join(clauses), params
+
+
+def iter_channel_rows(query, params, batch_size=500):
+    """Yield batches of rows straight from a cursor, closing the connection when done."""
+    conn = get_db_connection()
+    try:
+        cursor = conn.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        conn.close()
+
+
 # Route to serve the cached playlist.m3u
 @app.route("/playlist.m3u", methods=["GET"])
 @authorise
 def playlist():
-    global cached_playlist, last_playlist_host
-    
     logger.info("Playlist Requested")
     
-    # Detect the current host dynamically
-    current_host = host
+    # Filtered playlists are streamed straight from the database
+    where, params = build_channel_filters(request.args)
+    if params:
+        return Response(iter_playlist(getSettings(), where, params), mimetype="text/plain")
     
-    # Regenerate the playlist if it is empty or the host has changed
-    if cached_playlist is None or len(cached_playlist) == 0 or last_playlist_host != current_host:
-        logger.info(f"Regenerating playlist due to host change: {last_playlist_host} -> {current_host}")
-        last_playlist_host = current_host
-        generate_playlist()
-
-    return Response(cached_playlist, mimetype="text/plain")
+    return send_artifact(get_playlist_artifact(), "text/plain")
 
 # Function to manually trigger playlist update
 @app.route("/update_playlistm3u", methods=["POST"])
 def update_playlistm3u():
-    generate_playlist()
+    with playlist_lock:
+        generate_playlist()
     return Response("Playlist updated successfully", status=200)
 
-def generate_playlist():
-    global cached_playlist
-    logger.info("Generating playlist.m3u from database...")
+def iter_playlist(settings, where="enabled = 1 AND removed = 0", params=()):
+    """Generate playlist.m3u text in chunks for the channels matching where."""
+    use_numbers = settings.get("use channel numbers", "true") == "true"
+    use_genres = settings.get("use channel genres", "true") == "true"
+    use_hls = settings.get("output format", "mpegts") == "hls"
 
     # Detect the host dynamically from the request
     playlist_host = host
     
-    channels = []
-    
-    # Read enabled channels from database
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     # Build order clause based on settings
     order_clause = ""
-    if getSettings().get("sort playlist by channel name", "true") == "true":
-        order_clause = "ORDER BY COALESCE(NULLIF(custom_name, ''), name)"
-    elif getSettings().get("use channel numbers", "true") == "true":
-        if getSettings().get("sort playlist by channel number", "false") == "true":
-            order_clause = "ORDER BY CAST(COALESCE(NULLIF(custom_number, ''), number) AS INTEGER)"
-    elif getSettings().get("use channel genres", "true") == "true":
-        if getSettings().get("sort playlist by channel genre", "false") == "true":
-            order_clause = "ORDER BY COALESCE(NULLIF(custom_genre, ''), genre)"
+    if settings.get("sort playlist by channel name", "true") == "true":
+        order_clause = "ORDER BY effective_name"
+    elif use_numbers:
+        if settings.get("sort playlist by channel number", "false") == "true":
+            order_clause = "ORDER BY effective_number"
+    elif use_genres:
+        if settings.get("sort playlist by channel genre", "false") == "true":
+            order_clause = "ORDER BY effective_genre"
     
-    cursor.execute(f'''
+    query = f'''
         SELECT 
             portal, channel_id, name, number, genre,
             custom_name, custom_number, custom_genre, custom_epg_id
         FROM channels
-        WHERE enabled = 1
+        WHERE {where}
         {order_clause}
-    ''')
+    '''
     
-    for row in cursor.fetchall():
-        portal = row['portal']
-        channel_id = row['channel_id']
-        
-        # Use custom values if available, otherwise use defaults
-        channel_name = row['custom_name'] if row['custom_name'] else row['name']
-        channel_number = row['custom_number'] if row['custom_number'] else row['number']
-        genre = row['custom_genre'] if row['custom_genre'] else row['genre']
-        epg_id = row['custom_epg_id'] if row['custom_epg_id'] else channel_name
-        
-        channel_entry = "#EXTINF:-1" + ' tvg-id="' + epg_id
-        
-        if getSettings().get("use channel numbers", "true") == "true":
-            channel_entry += '" tvg-chno="' + str(channel_number)
-        
-        if getSettings().get("use channel genres", "true") == "true":
-            channel_entry += '" group-title="' + str(genre)
-        
-        channel_entry += '",' + channel_name + "\n"
-        
-        # Use HLS URL if output format is set to HLS, otherwise use MPEG-TS
-        if getSettings().get("output format", "mpegts") == "hls":
-            channel_entry += f"http://{playlist_host}/hls/{portal}/{channel_id}/master.m3u8"
-        else:
-            channel_entry += f"http://{playlist_host}/play/{portal}/{channel_id}"
+    yield "#EXTM3U \n"
+    separator = ""
+    for rows in iter_channel_rows(query, params):
+        channels = []
+        for row in rows:
+            portal = row['portal']
+            channel_id = row['channel_id']
+            
+            # Use custom values if available, otherwise use defaults
+            channel_name = row['custom_name'] if row['custom_name'] else row['name']
+            channel_number = row['custom_number'] if row['custom_number'] else row['number']
+            genre = row['custom_genre'] if row['custom_genre'] else row['genre']
+            epg_id = row['custom_epg_id'] if row['custom_epg_id'] else channel_name
+            
+            channel_entry = "#EXTINF:-1" + ' tvg-id="' + epg_id
+            
+            if use_numbers:
+                channel_entry += '" tvg-chno="' + str(channel_number)
+            
+            if use_genres:
+                channel_entry += '" group-title="' + str(genre)
+            
+            channel_entry += '",' + channel_name + "\n"
+            
+            # Use HLS URL if output format is set to HLS, otherwise use MPEG-TS
+            if use_hls:
+                channel_entry += f"http://{playlist_host}/hls/{portal}/{channel_id}/master.m3u8"
+            else:
+                channel_entry += f"http://{playlist_host}/play/{portal}/{channel_id}"
+            
+            channels.append(channel_entry)
         
-        channels.append(channel_entry)
+        yield separator + "\n".join(channels)
+        separator = "\n"
+
+def generate_playlist():
+    global cached_playlist, playlist_artifact
+    logger.info("Generating playlist.m3u from database...")
     
-    conn.close()
+    # Taken before reading so a write that lands mid-build triggers another rebuild
+    settings = getSettings()
+    key = playlist_key(settings)
+    
+    playlist = "".join(iter_playlist(settings))
+
+    # Update the cache, keeping Last-Modified if nothing visible changed
+    artifact = CachedArtifact(key, playlist)
+    previous = playlist_artifact
+    if previous is not None and previous.etag == artifact.etag:
+        artifact.last_modified = previous.last_modified
+    playlist_artifact = artifact
+    cached_playlist = playlist
+    logger.info("Playlist generated and cached.")
+    return artifact
+    
+async def fetch_portal_epg(portal, period=24):
+    """Fetch `period` hours of a portal's EPG using the first MAC that responds."""
+    url = portal["url"]
+    proxy = portal["proxy"]
+    epg = None
+    for mac in portal["macs"]:
+        try:
+            epg = await stb.withSessionTokenAsync(
+                url, mac, proxy, lambda token: stb.getEpg(url, mac, token, period, proxy)
+            )
+            if epg:
+                break
+        except Exception as e:
+            epg = None
+            logger.error(f"Error fetching data for MAC {mac}: {e}")
+    return epg
 
-    playlist = "#EXTM3U \n"
-    playlist = playlist + "\n".join(channels)
 
-    # Update the cache
-    cached_playlist = playlist
-    logger.info(f"Playlist generated and cached with {len(channels)} channels.")
+# Guide channel id, shared by refresh_xmltv and the profile guide filter
+EPG_ID_EXPRESSION = "COALESCE(NULLIF(custom_epg_id, ''), NULLIF(custom_number, ''), number)"
+
+
+def build_portal_guide(portal, channels, epg, cutoff):
+    """Turn a portal's enabled channel rows and EPG into (programmes, dummies) rows for the guide."""
+    portal_epg_offset = int(portal["epg offset"])
+    
+    programmes = []
+    dummies = []
+    for channel in channels:
+        channelId = channel["channel_id"]
+        channelName = channel["effective_name"]
+        epgId = channel["epg_id"]
+        try:
+            if not epg.get(channelId):
+                logger.warning(f"No EPG data found for channel {channelName} (ID: {channelId}), Creating a Dummy EPG item.")
+                start_time = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+                stop_time = start_time + timedelta(hours=24)
+                start = start_time.strftime("%Y%m%d%H%M%S") + " +0000"
+                stop = stop_time.strftime("%Y%m%d%H%M%S") + " +0000"
+                dummies.append((epgId, start, stop, channelName, channelName))
+            else:
+                for p in epg.get(channelId):
+                    try:
+                        start_time = datetime.utcfromtimestamp(p.get("start_timestamp")) + timedelta(hours=portal_epg_offset)
+                        stop_time = datetime.utcfromtimestamp(p.get("stop_timestamp")) + timedelta(hours=portal_epg_offset)
+                        start = start_time.strftime("%Y%m%d%H%M%S") + " +0000"
+                        stop = stop_time.strftime("%Y%m%d%H%M%S") + " +0000"
+                        if start <= cutoff:
+                            continue
+                        programmes.append((epgId, start, stop, p.get("name"), p.get("descr")))
+                    except Exception as e:
+                        logger.error(f"Error processing programme for channel {channelName} (ID: {channelId}): {e}")
+                        pass
+        except Exception as e:
+            logger.error(f"| Channel:{epgId} | {channelName} | {e}")
+            pass
+    return programmes, dummies
+
+
+async def fetch_portal_guide(portal, channels, cutoff, period=24):
+    """A portal's guide rows, or None if its EPG could not be fetched within EPG_PORTAL_TIMEOUT."""
+    name = portal["name"]
+    logger.info(f"Fetching EPG | Portal: {name} | offset: {portal['epg offset']} | period: {period}h |")
+    try:
+        epg = await asyncio.wait_for(fetch_portal_epg(portal, period), EPG_PORTAL_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.error(f"Timed out fetching EPG for {name} after {EPG_PORTAL_TIMEOUT}s, skipping")
+        return None
     
+    if not epg:
+        logger.error(f"Error making XMLTV for {name}, skipping")
+        return None
+    return build_portal_guide(portal, channels, epg, cutoff)
+
+
+def epg_lookahead(settings):
+    """Hours of EPG to keep ahead of now, from the 'epg lookahead' setting."""
+    try:
+        lookahead = int(settings.get("epg lookahead", EPG_DEFAULT_LOOKAHEAD))
+    except ValueError:
+        return EPG_DEFAULT_LOOKAHEAD
+    return min(max(lookahead, 1), EPG_MAX_LOOKAHEAD)
+
+
+def epg_fetch_period(covered_until, lookahead, now):
+    """Hours of EPG to request from a portal whose stored EPG runs to covered_until.
+    
+    Portals only serve EPG from now onwards, so the far end of the guide is
+    topped up with a full lookahead fetch once the stored EPG runs short by
+    EPG_FAR_REFRESH_HOURS. Other refreshes only re-fetch the near term.
+    """
+    needed = (now + timedelta(hours=lookahead - EPG_FAR_REFRESH_HOURS)).strftime("%Y%m%d%H%M%S") + " +0000"
+    if covered_until is None or covered_until < needed:
+        return lookahead
+    return min(EPG_NEAR_TERM_HOURS, lookahead)
+
+
+def reset_epg_coverage(cursor, portals=None):
+    """Forget how far ahead the stored EPG of these portals (all when None) runs.
+    
+    Programmes are only stored for enabled channels under their guide ids, so
+    a portal whose enabled set or guide ids change needs a full lookahead fetch.
+    """
+    if portals is None:
+        cursor.execute("DELETE FROM epg_coverage")
+    else:
+        cursor.executemany("DELETE FROM epg_coverage WHERE portal = ?", [(portal,) for portal in set(portals)])
+
+
+XMLTV_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n<tv>\n'
+
+
+def xmltv_channel(channel_id, display_name, icon=None):
+    """A <channel> element as XMLTV text."""
+    icon_element = f'    <icon src={quoteattr(icon)} />\n' if icon else ""
+    return (
+        f'  <channel id={quoteattr(str(channel_id))}>\n'
+        f'    <display-name>{escape(display_name or "")}</display-name>\n'
+        f'{icon_element}'
+        f'  </channel>\n'
+    )
+
+
+def xmltv_programme(channel_id, start, stop, title, desc):
+    """A <programme> element as XMLTV text."""
+    return (
+        f'  <programme start={quoteattr(start)} stop={quoteattr(stop)} channel={quoteattr(str(channel_id))}>\n'
+        f'    <title>{escape(title or "")}</title>\n'
+        f'    <desc>{escape(desc or "")}</desc>\n'
+        f'  </programme>\n'
+    )
+
+
+class XMLTVWriter:
+    """Writes an XMLTV document to disk element by element.
+
+    XMLTV lists every channel before any programme, so callers write all
+    channels first. The finished document replaces `path` in one rename, so
+    readers never see a partial guide and a failed refresh leaves the
+    previous one in place.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path) or "."
+        os.makedirs(directory, exist_ok=True)
+        self.out = tempfile.NamedTemporaryFile(
+            "w", encoding="utf-8", dir=directory, suffix=".tmp", delete=False
+        )
+        self.out.write(XMLTV_HEADER)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def channel(self, channel_id, display_name, icon=None):
+        self.out.write(xmltv_channel(channel_id, display_name, icon))
+
+    def programme(self, channel_id, start, stop, title, desc):
+        self.out.write(xmltv_programme(channel_id, start, stop, title, desc))
+
+    def close(self):
+        self.out.write("</tv>\n")
+        self.out.close()
+        os.replace(self.out.name, self.path)
+
+    def abort(self):
+        self.out.close()
+        try:
+            os.remove(self.out.name)
+        except OSError:
+            pass
+
+
+def iter_xmltv_elements(path):
+    """Yield the top-level elements of an XMLTV file, releasing each one once consumed."""
+    root = None
+    depth = 0
+    for event, element in ET.iterparse(path, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = element
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 1:
+            yield element
+            root.remove(element)
+
+
 def refresh_xmltv():
+    """Rebuild the guide, coalescing concurrent requests into at most one more run.
+    
+    Callers that arrive while a refresh is running wait for the lock; the
+    first of them rebuilds once more so their changes are picked up, and the
+    rest find nothing pending and return.
+    """
+    global xmltv_refresh_pending
+    xmltv_refresh_pending = True
+    with xmltv_refresh_lock:
+        while xmltv_refresh_pending:
+            xmltv_refresh_pending = False
+            write_xmltv()
+
+
+def start_xmltv_refresh():
+    """Refresh the guide in a background thread unless a refresh is already running."""
+    if not xmltv_refresh_lock.locked():
+        threading.Thread(target=refresh_xmltv, daemon=True).start()
+
+
+def schedule_xmltv_refresh():
+    """Keep the guide fresh by rebuilding it XMLTV_REFRESH_AHEAD seconds before it expires.
+    
+    Failed rebuilds are retried with exponential backoff, so a portal that
+    stays broken doesn't cause a full rebuild every minute.
+    """
+    failures = 0
+    while True:
+        wait = last_updated + XMLTV_MAX_AGE - XMLTV_REFRESH_AHEAD - time.time()
+        if wait > 0:
+            time.sleep(wait)
+            continue
+        try:
+            refresh_xmltv()
+            failures = 0
+        except Exception as e:
+            failures += 1
+            delay = min(XMLTV_RETRY_DELAY * 2 ** (failures - 1), XMLTV_MAX_AGE)
+            logger.error(f"Scheduled XMLTV refresh failed ({failures} in a row), retrying in {delay}s: {e}")
+            time.sleep(delay)
+
+
+def write_xmltv():
     settings = getSettings()
     logger.info("Refreshing XMLTV...")
 
-    # Set up paths for XMLTV cache
-    user_dir = os.path.expanduser("~")
-    cache_dir = os.path.join(user_dir, "Evilvir.us")
-    os.makedirs(cache_dir, exist_ok=True)
-    cache_file = os.path.join(cache_dir, "MacReplayEPG.xml")
-
-    # Define date cutoff for programme filtering
+    # Define date cutoff for programme retention
     day_before_yesterday = datetime.utcnow() - timedelta(days=2)
     day_before_yesterday_str = day_before_yesterday.strftime("%Y%m%d%H%M%S") + " +0000"
 
-    # Load existing cache if it exists
-    cached_programmes = []
-    if os.path.exists(cache_file):
-        try:
-            tree = ET.parse(cache_file)
-            root = tree.getroot()
-            for programme in root.findall("programme"):
-                stop_attr = programme.get("stop")  # Get the 'stop' attribute
-                if stop_attr:
-                    try:
-                        # Parse the stop time and compare with the cutoff
-                        stop_time = datetime.strptime(stop_attr.split(" ")[0], "%Y%m%d%H%M%S")
-                        if stop_time >= day_before_yesterday:  # Keep only recent programmes
-                            cached_programmes.append(ET.tostring(programme, encoding="unicode"))
-                    except ValueError as e:
-                        logger.warning(f"Invalid stop time format in cached programme: {stop_attr}. Skipping.")
-            logger.info("Loaded existing programme data from cache.")
-        except Exception as e:
-            logger.error(f"Failed to load cache file: {e}")
-
-    # Initialize new XMLTV data
-    channels = ET.Element("tv")
-    programmes = ET.Element("tv")
     portals = getPortals()
+    lookahead = epg_lookahead(settings)
+    now = datetime.utcnow()
 
-    for portal in portals:
-        if portals[portal]["enabled"] == "true":
-            portal_name = portals[portal]["name"]
-            portal_epg_offset = int(portals[portal]["epg offset"])
-            logger.info(f"Fetching EPG | Portal: {portal_name} | offset: {portal_epg_offset} |")
-
-            enabledChannels = portals[portal].get("enabled channels", [])
-            if len(enabledChannels) != 0:
-                name = portals[portal]["name"]
-                url = portals[portal]["url"]
-                macs = list(portals[portal]["macs"].keys())
-                proxy = portals[portal]["proxy"]
-                customChannelNames = portals[portal].get("custom channel names", {})
-                customEpgIds = portals[portal].get("custom epg ids", {})
-                customChannelNumbers = portals[portal].get("custom channel numbers", {})
-
-                for mac in macs:
-                    try:
-                        token = stb.getToken(url, mac, proxy)
-                        stb.getProfile(url, mac, token, proxy)
-                        allChannels = stb.getAllChannels(url, mac, token, proxy)
-                        epg = stb.getEpg(url, mac, token, 24, proxy)
-                        break
-                    except Exception as e:
-                        allChannels = None
-                        epg = None
-                        logger.error(f"Error fetching data for MAC {mac}: {e}")
+    # The editor's channel table decides what is in the guide; portals only supply the EPG
+    enabled_channels = {}
+    conn = get_db_connection()
+    try:
+        for row in conn.execute(f'''
+            SELECT portal, channel_id, effective_name, logo, {EPG_ID_EXPRESSION} AS epg_id
+            FROM channels
+            WHERE enabled = 1 AND removed = 0
+            ORDER BY effective_number
+        '''):
+            enabled_channels.setdefault(row["portal"], []).append(row)
+        coverage = dict(conn.execute("SELECT portal, covered_until FROM epg_coverage").fetchall())
+    finally:
+        conn.close()
+
+    # Fetch and transform every portal's EPG concurrently, each with its own timeout
+    epg_portals = [
+        portal for portal in portals
+        if portals[portal]["enabled"] == "true" and portal in enabled_channels
+    ]
+    periods = {portal: epg_fetch_period(coverage.get(portal), lookahead, now) for portal in epg_portals}
+    loop = asyncio.new_event_loop()
+    try:
+        guides = loop.run_until_complete(stb.gatherLimited(
+            [
+                fetch_portal_guide(
+                    portals[portal], enabled_channels[portal], day_before_yesterday_str, periods[portal]
+                )
+                for portal in epg_portals
+            ],
+            portal_concurrency(settings),
+        ))
+    finally:
+        # Unlike asyncio.run, closing the loop does not wait for worker threads
+        # a timed out portal request may still be blocked in
+        loop.close()
+
+    # Placeholder programmes for channels without EPG data are not stored
+    dummies = []
+
+    conn = get_db_connection()
+    try:
+        with XMLTVWriter(xmltvPath) as writer:
+            # Every enabled channel is listed, also when its portal's EPG fetch
+            # failed and only stored programmes are left for it
+            for portal in epg_portals:
+                for channel in enabled_channels[portal]:
+                    writer.channel(channel["epg_id"], channel["effective_name"], channel["logo"])
+            
+            # Merge in portal order, so the guide doesn't depend on which portal answered first
+            for portal, guide in zip(epg_portals, guides):
+                if guide is None:
+                    continue
+                programmes, portal_dummies = guide
+                
+                # The fetch is authoritative for the span it covers, so programmes
+                # the portal has since moved or dropped are cleared before the upsert
+                fetched = {}
+                for channel, start, *_ in programmes:
+                    first, last = fetched.get(channel, (start, start))
+                    fetched[channel] = (min(first, start), max(last, start))
+                conn.executemany(
+                    "DELETE FROM epg_programmes WHERE channel = ? AND start BETWEEN ? AND ?",
+                    [(channel, first, last) for channel, (first, last) in fetched.items()],
+                )
+                conn.executemany('''
+                    INSERT INTO epg_programmes (channel, start, stop, title, description)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(channel, start) DO UPDATE SET
+                        stop = excluded.stop,
+                        title = excluded.title,
+                        description = excluded.description
+                ''', programmes)
+                dummies.extend(portal_dummies)
+                
+                covered_until = (now + timedelta(hours=periods[portal])).strftime("%Y%m%d%H%M%S") + " +0000"
+                conn.execute('''
+                    INSERT INTO epg_coverage (portal, covered_until, fetched_at) VALUES (?, ?, ?)
+                    ON CONFLICT(portal) DO UPDATE SET
+                        covered_until = MAX(covered_until, excluded.covered_until),
+                        fetched_at = excluded.fetched_at
+                ''', (portal, covered_until, now.strftime("%Y%m%d%H%M%S") + " +0000"))
+
+            # Keep two days of history for programmes no refresh replaced, and
+            # nothing past the lookahead (it may have been shortened)
+            conn.execute("DELETE FROM epg_programmes WHERE stop < ?", (day_before_yesterday_str,))
+            lookahead_end = (now + timedelta(hours=lookahead)).strftime("%Y%m%d%H%M%S") + " +0000"
+            conn.execute("DELETE FROM epg_programmes WHERE start > ?", (lookahead_end,))
+            conn.execute(
+                "UPDATE epg_coverage SET covered_until = ? WHERE covered_until > ?",
+                (lookahead_end, lookahead_end),
+            )
+            conn.commit()
+
+            # Programmes of channels that have since been disabled stay stored
+            # until they age out, but only the channels listed above are in the guide
+            cursor = conn.execute(f'''
+                SELECT channel, start, stop, title, description FROM epg_programmes
+                WHERE channel IN (
+                    SELECT {EPG_ID_EXPRESSION} FROM channels
+                    WHERE enabled = 1 AND removed = 0 AND portal IN ({", ".join("?" * len(epg_portals))})
+                )
+                ORDER BY channel, start
+            ''', epg_portals)
+            while True:
+                rows = cursor.fetchmany(500)
+                if not rows:
+                    break
+                for row in rows:
+                    writer.programme(*row)
+            for dummy in dummies:
+                writer.programme(*dummy)
+    finally:
+        conn.close()
 
-                if allChannels and epg:
-                    for channel in allChannels:
-                        try:
-                            channelId = str(channel.get("id"))
-                            if str(channelId) in enabledChannels:
-                                channelName = customChannelNames.get(channelId, channel.get("name"))
-                                channelNumber = customChannelNumbers.get(channelId, str(channel.get("number")))
-                                epgId = customEpgIds.get(channelId, channelNumber)
-
-                                channelEle = ET.SubElement(
-                                    channels, "channel", id=epgId
-                                )
-                                ET.SubElement(channelEle, "display-name").text = channelName
-                                ET.SubElement(channelEle, "icon", src=channel.get("logo"))
-
-                                if channelId not in epg or not epg.get(channelId):
-                                    logger.warning(f"No EPG data found for channel {channelName} (ID: {channelId}), Creating a Dummy EPG item.")
-                                    start_time = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
-                                    stop_time = start_time + timedelta(hours=24)
-                                    start = start_time.strftime("%Y%m%d%H%M%S") + " +0000"
-                                    stop = stop_time.strftime("%Y%m%d%H%M%S") + " +0000"
-                                    programmeEle = ET.SubElement(
-                                        programmes,
-                                        "programme",
-                                        start=start,
-                                        stop=stop,
-                                        channel=epgId,
-                                    )
-                                    ET.SubElement(programmeEle, "title").text = channelName
-                                    ET.SubElement(programmeEle, "desc").text = channelName
-                                else:
-                                    for p in epg.get(channelId):
-                                        try:
-                                            start_time = datetime.utcfromtimestamp(p.get("start_timestamp")) + timedelta(hours=portal_epg_offset)
-                                            stop_time = datetime.utcfromtimestamp(p.get("stop_timestamp")) + timedelta(hours=portal_epg_offset)
-                                            start = start_time.strftime("%Y%m%d%H%M%S") + " +0000"
-                                            stop = stop_time.strftime("%Y%m%d%H%M%S") + " +0000"
-                                            if start <= day_before_yesterday_str:
-                                                continue
-                                            programmeEle = ET.SubElement(
-                                                programmes,
-                                                "programme",
-                                                start=start,
-                                                stop=stop,
-                                                channel=epgId,
-                                            )
-                                            ET.SubElement(programmeEle, "title").text = p.get("name")
-                                            ET.SubElement(programmeEle, "desc").text = p.get("descr")
-                                        except Exception as e:
-                                            logger.error(f"Error processing programme for channel {channelName} (ID: {channelId}): {e}")
-                                            pass
-                        except Exception as e:
-                            logger.error(f"| Channel:{channelNumber} | {channelName} | {e}")
-                            pass
-                else:
-                    logger.error(f"Error making XMLTV for {name}, skipping")
-
-    # Combine channels and programmes into a single XML document
-    xmltv = channels
-    for programme in programmes.iter("programme"):
-        xmltv.append(programme)
-
-    # Add cached programmes, ensuring no duplicates
-    existing_programme_hashes = {ET.tostring(p, encoding="unicode") for p in xmltv.findall("programme")}
-    for cached in cached_programmes:
-        if cached not in existing_programme_hashes:
-            xmltv.append(ET.fromstring(cached))
-
-    # Pretty-print the XML with blank line removal
-    rough_string = ET.tostring(xmltv, encoding="unicode")
-    reparsed = minidom.parseString(rough_string)
-    formatted_xmltv = "\n".join([line for line in reparsed.toprettyxml(indent="  ").splitlines() if line.strip()])
-
-    # Save updated cache
-    with open(cache_file, "w", encoding="utf-8") as f:
-        f.write(formatted_xmltv)
     logger.info("XMLTV cache updated.")
 
     # Update global cache
     global cached_xmltv, last_updated
-    cached_xmltv = formatted_xmltv
+    cached_xmltv = xmltvPath
     last_updated = time.time()
-    logger.debug(f"Generated XMLTV: {formatted_xmltv}")
     
 # Endpoint to get the XMLTV data
 @app.route("/xmltv", methods=["GET"])
 @authorise
 def xmltv():
-    global cached_xmltv, last_updated
     logger.info("Guide Requested")
     
-    # Check if the cached XMLTV data is older than 15 minutes
-    if cached_xmltv is None or (time.time() - last_updated) > 900:  # 900 seconds = 15 minutes
+    # Windowed, per-channel and now/next guides are answered from the programme store
+    if any(arg in request.args for arg in GUIDE_QUERY_ARGS):
+        try:
+            start = parse_guide_time(request.args["start"]) if request.args.get("start") else None
+            end = parse_guide_time(request.args["end"]) if request.args.get("end") else None
+        except (ValueError, OverflowError, OSError):
+            return make_response("start and end must be unix seconds or YYYYmmddHHMMSS (UTC)", 400)
+        where, params = build_guide_filters(request.args)
+        get_xmltv()
+        return Response(
+            iter_guide(where, params, start, end, now_next=request.args.get("mode") == "nownext"),
+            mimetype="text/xml",
+        )
+    
+    guide = get_xmltv()
+    if guide is None:
+        return Response(XMLTV_HEADER + "</tv>\n", mimetype="text/xml")
+    response = flask.send_file(guide, mimetype="text/xml", conditional=True)
+    response.age = guide_age(guide)
+    return response
+
+
+def get_xmltv():
+    """Path of the last good XMLTV guide file.
+    
+    Only a missing guide is built during the request. A stale one is served
+    as is while a background refresh replaces it.
+    """
+    if not os.path.exists(xmltvPath):
         refresh_xmltv()
+    elif cached_xmltv is None or (time.time() - last_updated) > XMLTV_MAX_AGE:
+        start_xmltv_refresh()
+    if os.path.exists(xmltvPath):
+        return xmltvPath
+    return None
+
+
+# Query parameters that turn /xmltv into a query against the programme store
+GUIDE_QUERY_ARGS = ("start", "end", "mode", "tvg-id", "portal", "genre", "group")
+
+
+def parse_guide_time(value):
+    """A start/end parameter, unix seconds or YYYYmmddHHMMSS in UTC, in epg_programmes' format."""
+    value = value.strip().split(" ")[0]
+    if len(value) == 14 and value.isdigit():
+        moment = datetime.strptime(value, "%Y%m%d%H%M%S")
+    else:
+        moment = datetime.utcfromtimestamp(float(value))
+    return moment.strftime("%Y%m%d%H%M%S") + " +0000"
+
+
+def build_guide_filters(args):
+    """build_channel_filters plus tvg-id, the guide channel id, which may be given more than once."""
+    where, params = build_channel_filters(args)
+    epg_ids = [epg_id for epg_id in args.getlist("tvg-id") if epg_id]
+    if epg_ids:
+        where += f" AND {EPG_ID_EXPRESSION} IN ({', '.join('?' * len(epg_ids))})"
+        params = params + epg_ids
+    return where, params
+
+
+def iter_guide(where, params, start=None, end=None, now_next=False):
+    """Generate XMLTV for the channels matching where, with programmes from epg_programmes.
     
-    return Response(
-        cached_xmltv,
-        mimetype="text/xml",
-    )
+    Programmes overlapping start..end are included; either bound may be
+    omitted. In now/next mode each channel gets the programme airing at
+    start (default now) and the one after it.
+    """
+    yield XMLTV_HEADER
+    for rows in iter_channel_rows(f'''
+        SELECT {EPG_ID_EXPRESSION} AS epg_id, effective_name, logo
+        FROM channels
+        WHERE {where}
+        ORDER BY effective_number
+    ''', params):
+        yield "".join(xmltv_channel(row["epg_id"], row["effective_name"], row["logo"]) for row in rows)
+    
+    channels = f"SELECT {EPG_ID_EXPRESSION} FROM channels WHERE {where}"
+    if now_next:
+        now = start or datetime.utcnow().strftime("%Y%m%d%H%M%S") + " +0000"
+        query = f'''
+            SELECT channel, start, stop, title, description FROM (
+                SELECT *, ROW_NUMBER() OVER (PARTITION BY channel ORDER BY start) AS position
+                FROM epg_programmes
+                WHERE channel IN ({channels}) AND stop > ?
+            )
+            WHERE position <= 2
+            ORDER BY channel, start
+        '''
+        programme_params = list(params) + [now]
+    else:
+        clauses = [f"channel IN ({channels})"]
+        programme_params = list(params)
+        if start:
+            clauses.append("stop > ?")
+            programme_params.append(start)
+        if end:
+            clauses.append("start < ?")
+            programme_params.append(end)
+        query = f'''
+            SELECT channel, start, stop, title, description
+            FROM epg_programmes
+            WHERE {" AND ".join(clauses)}
+            ORDER BY channel, start
+        '''
+    
+    for rows in iter_channel_rows(query, programme_params):
+        yield "".join(xmltv_programme(*row) for row in rows)
+    yield "</tv>\n"
+
+
+def guide_age(guide):
+    """Seconds since the guide file was written, for the Age header."""
+    try:
+        return max(0, int(time.time() - os.path.getmtime(guide)))
+    except OSError:
+        return 0
 
 
 @app.route("/play/<portalId>/<channelId>", methods=["GET"])
@@ -1906,6 +3366,26 @@ def channel(portalId, channelId):
             else:
                 return False
 
+    def shareStream():
+        """Serve the stream through the channel's shared upstream, starting it on this MAC."""
+        def onError(returncode):
+            logger.info("Ffmpeg closed with error({}). Moving MAC({}) for Portal({})".format(str(returncode), mac, portalName))
+            moveMac(portalId, mac)
+        
+        occupancy = {
+            "mac": mac,
+            "channel id": channelId,
+            "channel name": channelName,
+            "client": ip,
+            "portal name": portalName,
+            "start time": datetime.now(timezone.utc).timestamp(),
+        }
+        subscriber = shared_streams.join(
+            (portalId, channelId),
+            lambda: SharedStream((portalId, channelId), ffmpegcmd, occupancy, onError),
+        )
+        return Response(subscriber, mimetype="application/octet-stream")
+
     def isMacFree():
         count = 0
         for i in occupied.get(portalId, []):
@@ -1926,40 +3406,49 @@ def channel(portalId, channelId):
     ip = request.remote_addr
     channelName = portal.get("custom channel names", {}).get(channelId)
 
+    # Resolve the channel from the cache so tuning doesn't download the full channel list
+    cachedCmd = None
+    cachedChannel = get_cached_channel(portalId, channelId)
+    if cachedChannel:
+        channelName = cachedChannel["custom_name"] or channelName or cachedChannel["name"]
+        cachedCmd = cachedChannel["cmd"]
+
     logger.info(
         "IP({}) requested Portal({}):Channel({})".format(ip, portalId, channelId)
     )
 
+    # Someone is already watching this channel, so share their upstream instead of tuning again
+    if not web and getSettings().get("stream method", "ffmpeg") == "ffmpeg":
+        subscriber = shared_streams.join((portalId, channelId))
+        if subscriber is not None:
+            logger.info("Sharing running stream for Portal({}):Channel({})".format(portalId, channelId))
+            return Response(subscriber, mimetype="application/octet-stream")
+
     freeMac = False
 
     for mac in macs:
-        channels = None
-        cmd = None
         link = None
         if streamsPerMac == 0 or isMacFree():
             logger.info(
                 "Trying Portal({}):MAC({}):Channel({})".format(portalId, mac, channelId)
             )
             freeMac = True
-            token = stb.getToken(url, mac, proxy)
-            if token:
-                stb.getProfile(url, mac, token, proxy)
-                channels = stb.getAllChannels(url, mac, token, proxy)
-
-        if channels:
-            for c in channels:
-                if str(c["id"]) == channelId:
-                    channelName = portal.get("custom channel names", {}).get(channelId)
-                    if channelName == None:
-                        channelName = c["name"]
-                    cmd = c["cmd"]
-                    break
-
-        if cmd:
-            if "http://localhost/" in cmd:
-                link = stb.getLink(url, mac, token, cmd, proxy)
-            else:
-                link = cmd.split(" ")[1]
+            link, portalChannelName = resolve_channel_link(
+                url, mac, proxy, channelId, cachedCmd, portal_id=portalId
+            )
+            if channelName == None:
+                channelName = portalChannelName
+
+        testStreams = getSettings().get("test streams", "true") != "false"
+        if link and cachedCmd and testStreams and not testStream():
+            # The cached cmd may be stale (e.g. an expired play token in a direct
+            # URL); look the channel up again before blaming the MAC
+            logger.info("Cached link failed for Portal({}):Channel({}), looking it up again".format(portalId, channelId))
+            link, portalChannelName = resolve_channel_link(
+                url, mac, proxy, channelId, portal_id=portalId
+            )
+            cachedChannel = get_cached_channel(portalId, channelId)
+            cachedCmd = cachedChannel["cmd"] if cachedChannel else None
 
         if link:
             if getSettings().get("test streams", "true") == "false" or testStream():
@@ -1998,9 +3487,7 @@ def channel(portalId, channelId):
                             ffmpegcmd = ffmpegcmd.replace("-http_proxy <proxy>", "")
                         " ".join(ffmpegcmd.split())  # cleans up multiple whitespaces
                         ffmpegcmd = ffmpegcmd.split()
-                        return Response(
-                            streamData(), mimetype="application/octet-stream"
-                        )
+                        return shareStream()
                     else:
                         logger.info("Redirect sent")
                         return redirect(link)
@@ -2009,6 +3496,7 @@ def channel(portalId, channelId):
             "Unable to connect to Portal({}) using MAC({})".format(portalId, mac)
         )
         logger.info("Moving MAC({}) for Portal({})".format(mac, portalName))
+        stb.invalidateToken(url, mac, proxy)
         moveMac(portalId, mac)
 
         if not getSettings().get("try all macs", "true") == "true":
@@ -2030,17 +3518,17 @@ def channel(portalId, channelId):
                     macs = list(portals[portal]["macs"].keys())
                     proxy = portals[portal].get("proxy")
                     for mac in macs:
-                        channels = None
-                        cmd = None
                         link = None
                         if streamsPerMac == 0 or isMacFree():
                             for k, v in fallbackChannels.items():
                                 if v == channelName:
+                                    fallbackCmd = None
+                                    fallbackChannel = get_cached_channel(portal, k)
+                                    if fallbackChannel:
+                                        fallbackCmd = fallbackChannel["cmd"]
                                     try:
-                                        token = stb.getToken(url, mac, proxy)
-                                        stb.getProfile(url, mac, token, proxy)
-                                        channels = stb.getAllChannels(
-                                            url, mac, token, proxy
+                                        link, _ = resolve_channel_link(
+                                            url, mac, proxy, k, fallbackCmd
                                         )
                                     except:
                                         logger.info(
@@ -2048,73 +3536,57 @@ def channel(portalId, channelId):
                                                 portalId, mac
                                             )
                                         )
-                                    if channels:
-                                        fChannelId = k
-                                        for c in channels:
-                                            if str(c["id"]) == fChannelId:
-                                                cmd = c["cmd"]
-                                                break
-                                        if cmd:
-                                            if "http://localhost/" in cmd:
-                                                link = stb.getLink(
-                                                    url, mac, token, cmd, proxy
+                                    if link:
+                                        if testStream():
+                                            logger.info(
+                                                "Fallback found for Portal({}):Channel({})".format(
+                                                    portalId, channelId
                                                 )
-                                            else:
-                                                link = cmd.split(" ")[1]
-                                            if link:
-                                                if testStream():
-                                                    logger.info(
-                                                        "Fallback found for Portal({}):Channel({})".format(
-                                                            portalId, channelId
-                                                        )
-                                                    )
-                                                    if (
-                                                        getSettings().get(
-                                                            "stream method", "ffmpeg"
-                                                        )
-                                                        == "ffmpeg"
-                                                    ):
-                                                        ffmpegcmd = str(
+                                            )
+                                            if (
+                                                getSettings().get(
+                                                    "stream method", "ffmpeg"
+                                                )
+                                                == "ffmpeg"
+                                            ):
+                                                ffmpegcmd = str(
+                                                    getSettings()[
+                                                        "ffmpeg command"
+                                                    ]
+                                                )
+                                                ffmpegcmd = ffmpegcmd.replace(
+                                                    "<url>", link
+                                                )
+                                                ffmpegcmd = ffmpegcmd.replace(
+                                                    "<timeout>",
+                                                    str(
+                                                        int(
                                                             getSettings()[
-                                                                "ffmpeg command"
+                                                                "ffmpeg timeout"
                                                             ]
                                                         )
-                                                        ffmpegcmd = ffmpegcmd.replace(
-                                                            "<url>", link
-                                                        )
-                                                        ffmpegcmd = ffmpegcmd.replace(
-                                                            "<timeout>",
-                                                            str(
-                                                                int(
-                                                                    getSettings()[
-                                                                        "ffmpeg timeout"
-                                                                    ]
-                                                                )
-                                                                * int(1000000)
-                                                            ),
-                                                        )
-                                                        if proxy:
-                                                            ffmpegcmd = (
-                                                                ffmpegcmd.replace(
-                                                                    "<proxy>", proxy
-                                                                )
-                                                            )
-                                                        else:
-                                                            ffmpegcmd = ffmpegcmd.replace(
-                                                                "-http_proxy <proxy>",
-                                                                "",
-                                                            )
-                                                        " ".join(
-                                                            ffmpegcmd.split()
-                                                        )  # cleans up multiple whitespaces
-                                                        ffmpegcmd = ffmpegcmd.split()
-                                                        return Response(
-                                                            streamData(),
-                                                            mimetype="application/octet-stream",
+                                                        * int(1000000)
+                                                    ),
+                                                )
+                                                if proxy:
+                                                    ffmpegcmd = (
+                                                        ffmpegcmd.replace(
+                                                            "<proxy>", proxy
                                                         )
-                                                    else:
-                                                        logger.info("Redirect sent")
-                                                        return redirect(link)
+                                                    )
+                                                else:
+                                                    ffmpegcmd = ffmpegcmd.replace(
+                                                        "-http_proxy <proxy>",
+                                                        "",
+                                                    )
+                                                " ".join(
+                                                    ffmpegcmd.split()
+                                                )  # cleans up multiple whitespaces
+                                                ffmpegcmd = ffmpegcmd.split()
+                                                return shareStream()
+                                            else:
+                                                logger.info("Redirect sent")
+                                                return redirect(link)
 
     if freeMac:
         logger.info(
@@ -2180,27 +3652,17 @@ def hls_stream(portalId, channelId, filename):
         # Get the stream URL
         logger.debug(f"Fetching stream URL for channel {channelId} from portal {portalName}")
         link = None
+        cachedCmd = None
+        cachedChannel = get_cached_channel(portalId, channelId)
+        if cachedChannel:
+            cachedCmd = cachedChannel["cmd"]
         for mac in macs:
             try:
                 logger.debug(f"Trying MAC: {mac}")
-                token = stb.getToken(url, mac, proxy)
-                if token:
-                    stb.getProfile(url, mac, token, proxy)
-                    channels = stb.getAllChannels(url, mac, token, proxy)
-                    
-                    if channels:
-                        for c in channels:
-                            if str(c["id"]) == channelId:
-                                cmd = c["cmd"]
-                                if "http://localhost/" in cmd:
-                                    link = stb.getLink(url, mac, token, cmd, proxy)
-                                else:
-                                    link = cmd.split(" ")[1]
-                                logger.debug(f"Found stream URL for channel {channelId}")
-                                break
-                    
-                    if link:
-                        break
+                link, _ = resolve_channel_link(url, mac, proxy, channelId, cachedCmd)
+                if link:
+                    logger.debug(f"Found stream URL for channel {channelId}")
+                    break
             except Exception as e:
                 logger.error(f"Error getting stream URL for HLS with MAC {mac}: {e}")
                 continue
@@ -2397,47 +3859,66 @@ def status():
     return flask.jsonify(data)
 
 
-# Function to refresh the lineup
-def refresh_lineup():
-    global cached_lineup
-    logger.info("Refreshing Lineup from database...")
-    lineup = []
-    
-    # Read enabled channels from database
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('''
+def lineup_key(settings):
+    """Everything the lineup depends on: channel data, host and output format."""
+    return (channels_version, host, settings.get("output format"))
+
+
+def iter_lineup(settings, where="enabled = 1 AND removed = 0", params=()):
+    """Generate the HDHomeRun lineup JSON array in chunks for the channels matching where."""
+    use_hls = settings.get("output format", "mpegts") == "hls"
+    query = f'''
         SELECT 
             portal, channel_id, name, number,
             custom_name, custom_number
         FROM channels
-        WHERE enabled = 1
-        ORDER BY CAST(COALESCE(NULLIF(custom_number, ''), number) AS INTEGER)
-    ''')
+        WHERE {where}
+        ORDER BY effective_number
+    '''
     
-    for row in cursor.fetchall():
-        portal = row['portal']
-        channel_id = row['channel_id']
-        channel_name = row['custom_name'] if row['custom_name'] else row['name']
-        channel_number = row['custom_number'] if row['custom_number'] else row['number']
-        
-        # Use HLS URL if output format is set to HLS, otherwise use MPEG-TS
-        if getSettings().get("output format", "mpegts") == "hls":
-            url = f"http://{host}/hls/{portal}/{channel_id}/master.m3u8"
-        else:
-            url = f"http://{host}/play/{portal}/{channel_id}"
+    yield "["
+    separator = ""
+    for rows in iter_channel_rows(query, params):
+        entries = []
+        for row in rows:
+            portal = row['portal']
+            channel_id = row['channel_id']
+            channel_name = row['custom_name'] if row['custom_name'] else row['name']
+            channel_number = row['custom_number'] if row['custom_number'] else row['number']
+            
+            # Use HLS URL if output format is set to HLS, otherwise use MPEG-TS
+            if use_hls:
+                url = f"http://{host}/hls/{portal}/{channel_id}/master.m3u8"
+            else:
+                url = f"http://{host}/play/{portal}/{channel_id}"
+            
+            entries.append(json.dumps({
+                "GuideNumber": str(channel_number),
+                "GuideName": channel_name,
+                "URL": url
+            }))
         
-        lineup.append({
-            "GuideNumber": str(channel_number),
-            "GuideName": channel_name,
-            "URL": url
-        })
-    
-    conn.close()
+        yield separator + ",".join(entries)
+        separator = ","
+    yield "]"
 
-    cached_lineup = lineup
-    logger.info(f"Lineup refreshed with {len(lineup)} channels.")
+
+# Function to refresh the lineup
+def refresh_lineup():
+    global lineup_artifact
+    logger.info("Refreshing Lineup from database...")
+    
+    with lineup_lock:
+        settings = getSettings()
+        key = lineup_key(settings)
+        artifact = CachedArtifact(key, "".join(iter_lineup(settings)))
+        previous = lineup_artifact
+        if previous is not None and previous.etag == artifact.etag:
+            artifact.last_modified = previous.last_modified
+        lineup_artifact = artifact
+    
+    logger.info("Lineup refreshed.")
+    return artifact
     
     
 # Endpoint to get the current lineup
@@ -2446,10 +3927,18 @@ def refresh_lineup():
 @hdhr
 def lineup():
     logger.info("Lineup Requested")
-    if not cached_lineup:  # Refresh lineup if cache is empty
-        refresh_lineup()
+    settings = getSettings()
+    
+    # Filtered lineups are streamed straight from the database
+    where, params = build_channel_filters(request.args)
+    if params:
+        return Response(iter_lineup(settings, where, params), mimetype="application/json")
+    
+    artifact = lineup_artifact
+    if artifact is None or artifact.key != lineup_key(settings):
+        artifact = refresh_lineup()
     logger.info("Lineup Delivered")
-    return jsonify(cached_lineup)
+    return send_artifact(artifact, "application/json")
 
 # Endpoint to manually refresh the lineup
 @app.route("/refresh_lineup", methods=["POST"])
@@ -2457,6 +3946,191 @@ def refresh_lineup_endpoint():
     refresh_lineup()
     return jsonify({"status": "Lineup refreshed successfully"})
 
+PROFILE_NAME = re.compile(r"^[A-Za-z0-9_-]+$")
+profile_artifacts = {}
+profile_artifacts_lock = threading.Lock()
+
+
+def get_profile(profile):
+    """A profile's saved filters as the MultiDict build_channel_filters expects, or None."""
+    filters = getProfiles().get(profile)
+    if filters is None:
+        return None
+    return MultiDict([(field, value) for field in ("portal", "genre") for value in filters.get(field, [])])
+
+
+def get_profile_artifact(kind, profile, key, build):
+    """A profile's cached playlist, lineup or guide, rebuilt when its key changes."""
+    key = (key, json.dumps(getProfiles().get(profile), sort_keys=True))
+    artifact = profile_artifacts.get((kind, profile))
+    if artifact is not None and artifact.key == key:
+        return artifact
+    
+    with profile_artifacts_lock:
+        previous = profile_artifacts.get((kind, profile))
+        if previous is not None and previous.key == key:
+            return previous
+        artifact = CachedArtifact(key, build())
+        if previous is not None and previous.etag == artifact.etag:
+            artifact.last_modified = previous.last_modified
+        profile_artifacts[(kind, profile)] = artifact
+    logger.info(f"Built {kind} for profile {profile}")
+    return artifact
+
+
+def build_profile_xmltv(where, params):
+    """The full guide cut down to the channels a profile includes."""
+    guide = get_xmltv()
+    conn = get_db_connection()
+    try:
+        epg_ids = {
+            row[0] for row in conn.execute(f"SELECT DISTINCT {EPG_ID_EXPRESSION} FROM channels WHERE {where}", params)
+        }
+    finally:
+        conn.close()
+    
+    parts = [XMLTV_HEADER]
+    if guide:
+        for element in iter_xmltv_elements(guide):
+            channel_id = element.get("id") if element.tag == "channel" else element.get("channel")
+            if channel_id in epg_ids:
+                element.tail = None
+                parts.append("  " + ET.tostring(element, encoding="unicode") + "\n")
+    parts.append("</tv>\n")
+    return "".join(parts)
+
+
+@app.route("/api/profiles", methods=["GET"])
+@authorise
+def profiles_list():
+    return flask.jsonify({"profiles": getProfiles()})
+
+
+@app.route("/api/profiles/<profile>", methods=["PUT", "POST"])
+@authorise
+def profiles_save(profile):
+    """Create or replace a profile from {"portal": [...], "genre": [...]}."""
+    if not PROFILE_NAME.match(profile):
+        return flask.jsonify({"success": False, "error": "Profile names may only use letters, digits, - and _"}), 400
+    
+    data = request.get_json(silent=True) or {}
+    filters = {}
+    for field in ("portal", "genre"):
+        values = data.get(field, [])
+        if isinstance(values, str):
+            values = [values]
+        if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+            return flask.jsonify({"success": False, "error": f"{field} must be a list of strings"}), 400
+        filters[field] = values
+    
+    profiles = getProfiles()
+    profiles[profile] = filters
+    saveProfiles(profiles)
+    logger.info(f"Saved channel profile {profile}: {filters}")
+    return flask.jsonify({"success": True, "profile": profile, "filters": filters})
+
+
+@app.route("/api/profiles/<profile>", methods=["DELETE"])
+@authorise
+def profiles_delete(profile):
+    profiles = getProfiles()
+    if profiles.pop(profile, None) is None:
+        return flask.jsonify({"success": False, "error": "Profile not found"}), 404
+    saveProfiles(profiles)
+    with profile_artifacts_lock:
+        for kind in ("playlist", "lineup", "xmltv"):
+            profile_artifacts.pop((kind, profile), None)
+    return flask.jsonify({"success": True})
+
+
+@app.route("/playlist/<profile>.m3u", methods=["GET"])
+@authorise
+def profile_playlist(profile):
+    filters = get_profile(profile)
+    if filters is None:
+        return make_response("Profile not found", 404)
+    
+    logger.info(f"Playlist Requested for profile {profile}")
+    settings = getSettings()
+    where, params = build_channel_filters(filters)
+    artifact = get_profile_artifact(
+        "playlist", profile, playlist_key(settings),
+        lambda: "".join(iter_playlist(settings, where, params)),
+    )
+    return send_artifact(artifact, "text/plain")
+
+
+@app.route("/xmltv/<profile>", methods=["GET"])
+@authorise
+def profile_xmltv(profile):
+    filters = get_profile(profile)
+    if filters is None:
+        return make_response("Profile not found", 404)
+    
+    logger.info(f"Guide Requested for profile {profile}")
+    where, params = build_channel_filters(filters)
+    guide = get_xmltv()
+    artifact = get_profile_artifact(
+        "xmltv", profile, (channels_version, last_updated),
+        lambda: build_profile_xmltv(where, params),
+    )
+    response = send_artifact(artifact, "text/xml")
+    if guide is not None:
+        response.age = guide_age(guide)
+    return response
+
+
+# Each profile is also its own HDHomeRun tuner, rooted at /hdhr/<profile>
+@app.route("/hdhr/<profile>/discover.json", methods=["GET"])
+@hdhr
+def profile_discover(profile):
+    if get_profile(profile) is None:
+        return make_response("Profile not found", 404)
+    
+    settings = getSettings()
+    name = f"{settings['hdhr name']} {profile}"
+    id = hashlib.sha1(f"{settings['hdhr id']}:{profile}".encode()).hexdigest()[:8].upper()
+    data = {
+        "BaseURL": f"{host}/hdhr/{profile}",
+        "DeviceAuth": name,
+        "DeviceID": id,
+        "FirmwareName": "MacReplay",
+        "FirmwareVersion": "666",
+        "FriendlyName": name,
+        "LineupURL": f"{host}/hdhr/{profile}/lineup.json",
+        "Manufacturer": "Evilvirus",
+        "ModelNumber": "666",
+        "TunerCount": int(settings["hdhr tuners"]),
+    }
+    return flask.jsonify(data)
+
+
+@app.route("/hdhr/<profile>/lineup_status.json", methods=["GET"])
+@hdhr
+def profile_status(profile):
+    if get_profile(profile) is None:
+        return make_response("Profile not found", 404)
+    return status()
+
+
+@app.route("/hdhr/<profile>/lineup.json", methods=["GET"])
+@app.route("/hdhr/<profile>/lineup.post", methods=["POST"])
+@hdhr
+def profile_lineup(profile):
+    filters = get_profile(profile)
+    if filters is None:
+        return make_response("Profile not found", 404)
+    
+    logger.info(f"Lineup Requested for profile {profile}")
+    settings = getSettings()
+    where, params = build_channel_filters(filters)
+    artifact = get_profile_artifact(
+        "lineup", profile, lineup_key(settings),
+        lambda: "".join(iter_lineup(settings, where, params)),
+    )
+    return send_artifact(artifact, "application/json")
+
+
 @app.route("/", methods=["GET"])
 def home():
     """Serve React app"""
@@ -2506,9 +4180,9 @@ def start_refresh():
             logger.info("No channels in database, fetching from portals...")
             refresh_channels_cache()
         
-        # Then refresh lineup and xmltv
+        # Then refresh lineup, and keep xmltv refreshed from here on
         refresh_lineup()
-        refresh_xmltv()
+        schedule_xmltv_refresh()
     
     threading.Thread(target=refresh_all, daemon=True).start()
     
@@ -2528,8 +4202,15 @@ if __name__ == "__main__":
     # Register cleanup handler for HLS streams
     atexit.register(hls_manager.cleanup_all)
 
+    atexit.register(db_pool.close_all)
+
+    # One portal connection per server thread, so concurrent tunes don't churn connections
+    threads = 24
+    stb.s.configure(poolSize=threads)
+    atexit.register(stb.s.close)
+
     # Start the server
     if "TERM_PROGRAM" in os.environ.keys() and os.environ["TERM_PROGRAM"] == "vscode":
         app.run(host="0.0.0.0", port=13681, debug=True)
     else:
-        waitress.serve(app, port=13681, _quiet=True, threads=24)
\ No newline at end of file
+        waitress.serve(app, port=13681, _quiet=True, threads=threads)
\ No newline at end of file
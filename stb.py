@@ -3,13 +3,153 @@ from requests.adapters import HTTPAdapter, Retry
 from urllib.parse import urlparse
 import re
 import logging
+import threading
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger("MacReplay.stb")
 logger.setLevel(logging.DEBUG)
 
-s = requests.Session()
 retries = Retry(total=3, backoff_factor=0.1, status_forcelist=[500, 502, 503, 504])
-s.mount("http://", HTTPAdapter(max_retries=retries))
+
+
+class SessionPool:
+    """Keeps one requests.Session per (scheme, host, proxy).
+
+    Each session has its own connection pool and retry policy mounted for
+    both http and https, so busy portals and proxies don't compete for
+    connections in one shared pool.
+    """
+
+    def __init__(self, poolSize=10, maxRetries=retries):
+        self.poolSize = poolSize
+        self.maxRetries = maxRetries
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def configure(self, poolSize):
+        """Resize the pools. Existing sessions are rebuilt on next use."""
+        with self.lock:
+            self.poolSize = poolSize
+            sessions = list(self.sessions.values())
+            self.sessions = {}
+        for session in sessions:
+            session.close()
+        logger.debug(f"Connection pools sized to {poolSize}")
+
+    def session(self, url, proxy=None):
+        parsed = urlparse(url)
+        key = (parsed.scheme, parsed.netloc, proxy or None)
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                session.headers["Connection"] = "keep-alive"
+                adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=self.poolSize,
+                    max_retries=self.maxRetries,
+                )
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self.sessions[key] = session
+        return session
+
+    def get(self, url, proxies=None, **kwargs):
+        proxy = (proxies or {}).get("http")
+        return self.session(url, proxy).get(url, proxies=proxies, **kwargs)
+
+    def close(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions = {}
+        for session in sessions:
+            session.close()
+
+
+s = SessionPool()
+
+# Tokens are reused for this many seconds before a new handshake is made
+TOKEN_TTL = 1800
+
+_tokenCache = {}
+_tokenLocks = {}
+_tokenCacheLock = threading.Lock()
+
+
+def _tokenKey(url, mac, proxy):
+    return (url, mac, proxy or None)
+
+
+def _authFailed(response):
+    # Portals answer expired or revoked tokens with 401/403 or a plain-text body
+    if response.status_code in (401, 403):
+        return True
+    return isinstance(response.text, str) and response.text.startswith(
+        "Authorization failed"
+    )
+
+
+def getSessionToken(url, mac, proxy=None):
+    """Return an authenticated token for (url, mac, proxy), reusing a cached one.
+
+    A handshake and profile request are only made when there is no cached
+    token, it is older than TOKEN_TTL, or it was invalidated after an auth
+    failure. Concurrent callers for the same key share one handshake.
+    """
+    key = _tokenKey(url, mac, proxy)
+    with _tokenCacheLock:
+        keyLock = _tokenLocks.setdefault(key, threading.Lock())
+
+    with keyLock:
+        with _tokenCacheLock:
+            cached = _tokenCache.get(key)
+        if cached and time.monotonic() - cached[1] < TOKEN_TTL:
+            return cached[0]
+
+        token = getToken(url, mac, proxy)
+        if token:
+            getProfile(url, mac, token, proxy)
+            with _tokenCacheLock:
+                _tokenCache[key] = (token, time.monotonic())
+        return token
+
+
+def withSessionToken(url, mac, proxy, request):
+    """Return request(token) for a session token, retrying once with a fresh handshake.
+
+    Portals can drop a token before TOKEN_TTL is up and some answer it with
+    an empty result rather than an auth failure, so when a cached token
+    gives a falsy result it is invalidated and the request made again.
+    """
+    with _tokenCacheLock:
+        cached = _tokenCache.get(_tokenKey(url, mac, proxy))
+    reused = cached is not None and time.monotonic() - cached[1] < TOKEN_TTL
+    token = getSessionToken(url, mac, proxy)
+    if not token:
+        return None
+    result = request(token)
+    if result or not reused:
+        return result
+
+    logger.debug(f"Request with cached token failed for MAC {mac}, retrying with a new one")
+    invalidateToken(url, mac, proxy)
+    token = getSessionToken(url, mac, proxy)
+    if not token:
+        return None
+    return request(token)
+
+
+def invalidateToken(url, mac, proxy=None):
+    with _tokenCacheLock:
+        if _tokenCache.pop(_tokenKey(url, mac, proxy), None):
+            logger.debug(f"Invalidated cached token for MAC {mac}")
+
+
+def clearTokenCache():
+    with _tokenCacheLock:
+        _tokenCache.clear()
 
 
 def getUrl(url, proxy=None):
@@ -108,6 +248,8 @@ def getProfile(url, mac, token, proxy=None):
             proxies=proxies,
             timeout=10,
         )
+        if _authFailed(response):
+            invalidateToken(url, mac, proxy)
         profile = response.json()["js"]
         if profile:
             return profile
@@ -131,6 +273,8 @@ def getExpires(url, mac, token, proxy=None):
             proxies=proxies,
             timeout=15,
         )
+        if _authFailed(response):
+            invalidateToken(url, mac, proxy)
         logger.debug(f"Expiry request status: {response.status_code}")
         expires = response.json()["js"]["phone"]
         if expires:
@@ -161,6 +305,8 @@ def getAllChannels(url, mac, token, proxy=None):
             proxies=proxies,
             timeout=30,
         )
+        if _authFailed(response):
+            invalidateToken(url, mac, proxy)
         logger.debug(f"Channels request status: {response.status_code}")
         channels = response.json()["js"]["data"]
         if channels:
@@ -189,6 +335,8 @@ def getGenres(url, mac, token, proxy=None):
             proxies=proxies,
             timeout=10,
         )
+        if _authFailed(response):
+            invalidateToken(url, mac, proxy)
         genreData = response.json()["js"]
         if genreData:
             return genreData
@@ -228,6 +376,8 @@ def getLink(url, mac, token, cmd, proxy=None):
             proxies=proxies,
             timeout=10,
         )
+        if _authFailed(response):
+            invalidateToken(url, mac, proxy)
         data = response.json()
         link = data["js"]["cmd"].split()[-1]
         if link:
@@ -254,8 +404,36 @@ def getEpg(url, mac, token, period, proxy=None):
             proxies=proxies,
             timeout=30,
         )
+        if _authFailed(response):
+            invalidateToken(url, mac, proxy)
         data = response.json()["js"]["data"]
         if data:
             return data
     except:
         pass
+
+
+# Async helpers. requests is blocking, so portal calls run on a worker
+# thread against the pooled sessions; callers bound the fan-out with
+# gatherLimited() so portals can be processed concurrently.
+
+
+async def gatherLimited(coros, limit):
+    """Await coros with at most `limit` running at once, keeping result order.
+
+    The loop's default executor is sized to `limit`, so the coros' blocking
+    calls are neither queued behind its few default workers nor run on more
+    threads than the limit allows.
+    """
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=limit))
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(coro):
+        async with semaphore:
+            return await coro
+
+    return await asyncio.gather(*(run(coro) for coro in coros))
+
+
+async def withSessionTokenAsync(url, mac, proxy, request):
+    return await asyncio.to_thread(withSessionToken, url, mac, proxy, request)
@@ -6,8 +6,34 @@ from unittest.mock import MagicMock
 # Add the project root to the path so we can import app
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+import app as app_module
+import stb
 from app import app
 
+@pytest.fixture(autouse=True)
+def clear_token_cache():
+    """Keep cached portal tokens from leaking between tests."""
+    stb.clearTokenCache()
+    yield
+    stb.clearTokenCache()
+
+@pytest.fixture(autouse=True)
+def isolated_db(tmp_path, monkeypatch):
+    """Point the channel cache at a throwaway database file."""
+    monkeypatch.setattr(app_module, 'dbPath', str(tmp_path / 'channels.db'))
+    monkeypatch.setattr(app_module, 'xmltvPath', str(tmp_path / 'MacReplayEPG.xml'))
+    # Artifacts built from another test's database must not be served
+    monkeypatch.setattr(app_module, 'playlist_artifact', None)
+    monkeypatch.setattr(app_module, 'lineup_artifact', None)
+    monkeypatch.setattr(app_module, 'profile_artifacts', {})
+    return app_module.dbPath
+
+@pytest.fixture
+def channels_db(isolated_db):
+    """An initialized, empty channels database."""
+    app_module.init_db()
+    return isolated_db
+
 @pytest.fixture
 def client():
     app.config['TESTING'] = True
@@ -0,0 +1,30 @@
+"""Database helpers shared by the test modules."""
+import app
+
+
+def insert_channels(rows):
+    """Add rows, each a dict of channels columns, to the test database."""
+    conn = app.get_db_connection()
+    for row in rows:
+        conn.execute(
+            f"INSERT INTO channels ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})",
+            tuple(row.values()),
+        )
+    conn.commit()
+    conn.close()
+
+
+def execute(query, params=()):
+    """Run and commit a write against the test database."""
+    conn = app.get_db_connection()
+    conn.execute(query, params)
+    conn.commit()
+    conn.close()
+
+
+def fetch_rows(query, params=()):
+    """The rows of a query against the test database, as dicts."""
+    conn = app.get_db_connection()
+    rows = [dict(row) for row in conn.execute(query, params).fetchall()]
+    conn.close()
+    return rows
@@ -1,6 +1,9 @@
+import json
 import pytest
 from unittest.mock import MagicMock, patch
 import app
+import stb
+from tests.helpers import fetch_rows, insert_channels
 
 def test_home_redirect(client, mock_config):
     """Test that the home page redirects to /portals"""
@@ -129,14 +132,13 @@ def test_fallback_logic_works(client, mock_config, mocker):
     assert response.status_code == 200
     assert b"fallback_data" in response.get_data()
 
-def test_editor_save_resets_playlist_host(client, mock_config, mocker):
+def test_editor_save_invalidates_playlist(client, mock_config, mocker):
     """
-    Regression test for global variable bug:
-    Verify that editorSave() properly resets the global last_playlist_host variable
-    to None, forcing playlist regeneration on the next request.
+    Regression test for stale playlists:
+    Verify that editorSave() bumps the channels version, so the cached
+    playlist is rebuilt on the next request.
     """
-    # Set the global variable to a non-None value
-    app.last_playlist_host = "example.com:8080"
+    version = app.channels_version
     
     # Mock database operations
     mock_conn = MagicMock()
@@ -165,6 +167,171 @@ def test_editor_save_resets_playlist_host(client, mock_config, mocker):
     assert response.status_code == 302
     assert '/editor' in response.location
     
-    # Verify the global variable was reset to None
-    assert app.last_playlist_host is None, "last_playlist_host should be reset to None after editorSave()"
+    # Verify the playlist's channels version moved on
+    assert app.channels_version == version + 1, "editorSave() should invalidate the cached playlist"
 
+
+def test_editor_save_applies_all_edits_in_one_transaction(client, mock_config, channels_db, mocker):
+    """Repeated edits collapse to the last value and every field is saved together."""
+    insert_cached_channel("portal1", "1", "CNN", "ffmpeg http://a")
+    insert_cached_channel("portal1", "2", "BBC", "ffmpeg http://b")
+    mocker.patch('app.threading.Thread')
+    mocker.patch('app.Thread')
+    edit = lambda channel_id, **values: {"portal": "portal1", "channel id": channel_id, **values}
+
+    response = client.post('/editor/save', data={
+        'enabledEdits': json.dumps([edit("1", enabled=False), edit("2", enabled=False), edit("1", enabled=True)]),
+        'numberEdits': json.dumps([edit("2", **{"custom number": "7"})]),
+        'nameEdits': json.dumps([edit("1", **{"custom name": "CNN HD"})]),
+        'genreEdits': json.dumps([edit("2", **{"custom genre": "News"})]),
+        'epgEdits': json.dumps([edit("1", **{"custom epg id": "cnn.us"})]),
+        'fallbackEdits': json.dumps([edit("2", **{"channel name": "CNN HD"})]),
+    })
+
+    assert response.status_code == 302
+    rows = {row["channel_id"]: row for row in fetch_rows("SELECT * FROM channels")}
+    assert rows["1"]["enabled"] == 1
+    assert rows["1"]["custom_name"] == "CNN HD"
+    assert rows["1"]["custom_epg_id"] == "cnn.us"
+    assert rows["2"]["enabled"] == 0
+    assert rows["2"]["custom_number"] == "7"
+    assert rows["2"]["custom_genre"] == "News"
+    assert rows["2"]["fallback_channel"] == "CNN HD"
+
+
+def test_editor_save_is_atomic(client, mock_config, channels_db, mocker):
+    """A bad edit rolls back the whole save."""
+    insert_cached_channel("portal1", "1", "CNN", "ffmpeg http://a")
+    mocker.patch('app.threading.Thread')
+    mocker.patch('app.Thread')
+
+    client.post('/editor/save', data={
+        'enabledEdits': json.dumps([{"portal": "portal1", "channel id": "1", "enabled": False}]),
+        'numberEdits': '[]',
+        'nameEdits': json.dumps([{"portal": "portal1", "channel id": "1"}]),
+        'genreEdits': '[]',
+        'epgEdits': '[]',
+        'fallbackEdits': '[]',
+    })
+
+    assert fetch_rows("SELECT enabled FROM channels") == [{"enabled": 1}]
+
+
+def insert_cached_channel(portal, channel_id, name, cmd):
+    insert_channels([{
+        "portal": portal, "channel_id": channel_id, "portal_name": "Test Portal",
+        "name": name, "enabled": 1, "cmd": cmd,
+    }])
+
+def mock_ffmpeg(mocker, data):
+    mock_process = MagicMock()
+    mock_process.__enter__.return_value = mock_process
+    mock_process.__exit__.return_value = None
+    mock_process.stdout.read.side_effect = [data, b""]
+    mock_process.poll.return_value = 0
+    return mocker.patch('subprocess.Popen', return_value=mock_process)
+
+def test_channel_uses_cached_direct_cmd(client, mock_config, channels_db, mocker):
+    """A cached direct cmd is played without any portal round-trips."""
+    insert_cached_channel("portal1", "123", "Test Channel", "ffmpeg http://cached.url")
+    get_token = mocker.patch('stb.getToken')
+    get_all_channels = mocker.patch('stb.getAllChannels')
+    popen = mock_ffmpeg(mocker, b"cached_data")
+
+    response = client.get('/play/portal1/123')
+
+    assert response.status_code == 200
+    assert b"cached_data" in response.get_data()
+    get_token.assert_not_called()
+    get_all_channels.assert_not_called()
+    assert "http://cached.url" in popen.call_args[0][0]
+
+def test_channel_cached_localhost_cmd_only_creates_link(client, mock_config, channels_db, mocker):
+    """A cached localhost cmd needs create_link but not the full channel list."""
+    insert_cached_channel("portal1", "123", "Test Channel", "ffrt http://localhost/ch/123")
+    mocker.patch('stb.getToken', return_value="mock_token")
+    mocker.patch('stb.getProfile')
+    get_all_channels = mocker.patch('stb.getAllChannels')
+    get_link = mocker.patch('stb.getLink', return_value="http://resolved.url")
+    mock_ffmpeg(mocker, b"linked_data")
+
+    response = client.get('/play/portal1/123')
+
+    assert response.status_code == 200
+    assert b"linked_data" in response.get_data()
+    get_all_channels.assert_not_called()
+    get_link.assert_called_once()
+
+def cached_cmd(portal, channel_id):
+    return fetch_rows("SELECT cmd FROM channels WHERE portal = ? AND channel_id = ?", (portal, channel_id))[0]["cmd"]
+
+def test_channel_stale_localhost_cmd_is_looked_up_again(client, mock_config, channels_db, mocker):
+    """A cached cmd the portal no longer links is refreshed instead of moving the MAC."""
+    insert_cached_channel("portal1", "123", "Test Channel", "ffrt http://localhost/ch/old")
+    mocker.patch('stb.getToken', return_value="mock_token")
+    mocker.patch('stb.getProfile')
+    mocker.patch('stb.getAllChannels', return_value=[
+        {"id": "123", "name": "Test Channel", "cmd": "ffrt http://localhost/ch/new"}
+    ])
+    get_link = mocker.patch('stb.getLink', side_effect=lambda url, mac, token, cmd, proxy: (
+        "http://resolved.url" if cmd.endswith("/new") else None
+    ))
+    move_mac = mocker.patch('app.moveMac')
+    mock_ffmpeg(mocker, b"fresh_data")
+
+    response = client.get('/play/portal1/123')
+
+    assert response.status_code == 200
+    assert b"fresh_data" in response.get_data()
+    assert get_link.call_count == 2
+    move_mac.assert_not_called()
+    assert cached_cmd("portal1", "123") == "ffrt http://localhost/ch/new"
+
+def test_channel_rejected_cached_token_is_replaced(client, mock_config, channels_db, mocker):
+    """A cached token the portal has dropped is renewed instead of moving a working MAC."""
+    insert_cached_channel("portal1", "123", "Test Channel", "ffrt http://localhost/ch/123")
+    get_token = mocker.patch('stb.getToken', side_effect=["expired_token", "fresh_token"])
+    mocker.patch('stb.getProfile')
+    stb.getSessionToken("http://example.com", "00:00:00:00:00:00")
+    # The portal answers the dropped token with an empty result
+    mocker.patch('stb.getAllChannels', return_value=None)
+    mocker.patch('stb.getLink', side_effect=lambda url, mac, token, cmd, proxy: (
+        "http://resolved.url" if token == "fresh_token" else None
+    ))
+    move_mac = mocker.patch('app.moveMac')
+    mock_ffmpeg(mocker, b"linked_data")
+
+    response = client.get('/play/portal1/123')
+
+    assert response.status_code == 200
+    assert b"linked_data" in response.get_data()
+    assert get_token.call_count == 2
+    move_mac.assert_not_called()
+
+def test_channel_stale_direct_cmd_is_looked_up_again(client, mock_config, channels_db, mocker):
+    """A cached direct link that fails the stream test is refreshed before blaming the MAC."""
+    _, settings = mock_config
+    settings["test streams"] = "true"
+    insert_cached_channel("portal1", "123", "Test Channel", "ffmpeg http://expired.url")
+    mocker.patch('stb.getToken', return_value="mock_token")
+    mocker.patch('stb.getProfile')
+    mocker.patch('stb.getAllChannels', return_value=[
+        {"id": "123", "name": "Test Channel", "cmd": "ffmpeg http://fresh.url"}
+    ])
+    move_mac = mocker.patch('app.moveMac')
+    popen = mock_ffmpeg(mocker, b"fresh_data")
+    process = popen.return_value
+
+    def probe(cmd, **kwargs):
+        if cmd[0] == "ffprobe":
+            process.returncode = 0 if "http://fresh.url" in cmd else 1
+        return process
+    popen.side_effect = probe
+
+    response = client.get('/play/portal1/123')
+
+    assert response.status_code == 200
+    assert b"fresh_data" in response.get_data()
+    assert "http://fresh.url" in popen.call_args[0][0]
+    move_mac.assert_not_called()
+    assert cached_cmd("portal1", "123") == "ffmpeg http://fresh.url"
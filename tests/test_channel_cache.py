@@ -0,0 +1,299 @@
+"""Tests for the SQLite channel cache refresh."""
+import threading
+
+import pytest
+import app
+import stb
+from tests.helpers import fetch_rows
+
+
+def make_portal(name, macs):
+    return {
+        "enabled": "true",
+        "name": name,
+        "url": f"http://{name}.example.com/portal.php",
+        "macs": {mac: "2030-01-01" for mac in macs},
+        "streams per mac": "1",
+        "proxy": "",
+    }
+
+
+@pytest.fixture
+def portal_stubs(mocker):
+    """Stub the portal calls so each portal returns its own channel list."""
+    channels_by_url = {}
+
+    mocker.patch('app.getSettings', return_value={})
+    mocker.patch('stb.getSessionToken', return_value="token")
+    mocker.patch('stb.getGenreNames', return_value={"1": "News"})
+    mocker.patch('stb.getAllChannels', side_effect=lambda url, mac, token, proxy=None: channels_by_url.get(url))
+    return channels_by_url
+
+
+class TestRefreshChannelsCache:
+
+    def test_refreshes_all_enabled_portals(self, channels_db, portal_stubs, mocker):
+        portals = {
+            "p1": make_portal("one", ["00:00:00:00:00:01"]),
+            "p2": make_portal("two", ["00:00:00:00:00:02"]),
+            "p3": dict(make_portal("three", ["00:00:00:00:00:03"]), enabled="false"),
+        }
+        mocker.patch('app.getPortals', return_value=portals)
+        portal_stubs["http://one.example.com/portal.php"] = [
+            {"id": 1, "name": "One News", "number": 1, "tv_genre_id": "1", "cmd": "ffmpeg http://one/1"},
+        ]
+        portal_stubs["http://two.example.com/portal.php"] = [
+            {"id": 2, "name": "Two News", "number": 2, "tv_genre_id": "1", "cmd": "ffmpeg http://two/2"},
+            {"id": 3, "name": "Two Sport", "number": 3, "tv_genre_id": "9", "cmd": "ffmpeg http://two/3"},
+        ]
+        portal_stubs["http://three.example.com/portal.php"] = [
+            {"id": 4, "name": "Never", "number": 4, "tv_genre_id": "1", "cmd": "ffmpeg http://three/4"},
+        ]
+
+        summary = app.refresh_channels_cache()
+
+        assert summary["total"] == 3
+        assert summary["added"] == 3
+        rows = fetch_rows("SELECT portal, channel_id, genre, cmd FROM channels ORDER BY portal, channel_id")
+        assert [(r["portal"], r["channel_id"]) for r in rows] == [("p1", "1"), ("p2", "2"), ("p2", "3")]
+        assert rows[0]["cmd"] == "ffmpeg http://one/1"
+        assert rows[2]["genre"] == ""
+
+    def test_failed_portal_does_not_block_others(self, channels_db, portal_stubs, mocker):
+        portals = {
+            "p1": make_portal("one", ["00:00:00:00:00:01"]),
+            "p2": make_portal("down", ["00:00:00:00:00:02"]),
+        }
+        mocker.patch('app.getPortals', return_value=portals)
+        portal_stubs["http://one.example.com/portal.php"] = [
+            {"id": 1, "name": "One News", "number": 1, "tv_genre_id": "1", "cmd": "ffmpeg http://one/1"},
+        ]
+
+        assert app.refresh_channels_cache()["total"] == 1
+
+    def test_portal_concurrency_is_capped(self, channels_db, portal_stubs, mocker):
+        portals = {f"p{i}": make_portal(f"portal{i}", [f"00:00:00:00:00:0{i}"]) for i in range(6)}
+        mocker.patch('app.getPortals', return_value=portals)
+        mocker.patch('app.getSettings', return_value={"portal concurrency": "3"})
+        # The limit is reached, but never exceeded
+        barrier = threading.Barrier(3, timeout=5)
+        lock = threading.Lock()
+        running = [0]
+        peak = [0]
+
+        def get_all_channels(url, mac, token, proxy=None):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            barrier.wait()
+            with lock:
+                running[0] -= 1
+            return [{"id": 1, "name": url, "number": 1, "tv_genre_id": "1", "cmd": "ffmpeg http://x/1"}]
+        stb.getAllChannels.side_effect = get_all_channels
+
+        assert app.refresh_channels_cache()["total"] == len(portals)
+        assert peak[0] == 3
+
+    def test_portal_concurrency_setting(self):
+        assert app.portal_concurrency({"portal concurrency": "8"}) == 8
+        assert app.portal_concurrency({"portal concurrency": "0"}) == 1
+        assert app.portal_concurrency({"portal concurrency": "999"}) == app.PORTAL_MAX_CONCURRENCY
+        assert app.portal_concurrency({}) == app.PORTAL_CONCURRENCY
+
+
+class TestChannelCacheWriter:
+
+    def test_writer_stores_each_portal_in_one_batch(self, channels_db, mocker):
+        portals = {"p1": make_portal("one", []), "p2": make_portal("two", [])}
+        write_queue = app.queue.Queue()
+        write_queue.put(("p1", [{"id": 1, "name": "A", "number": 1, "cmd": "x y"}], {"": ""}))
+        write_queue.put(("p2", None, None))
+        write_queue.put(("p2", [{"id": 2, "name": "B", "number": 2, "cmd": "x y"}, {"id": 3, "name": "C", "number": 3, "cmd": "x y"}], {"": ""}))
+        write_queue.put(None)
+        connect = mocker.spy(app, 'get_db_connection')
+        stats = {}
+
+        app.write_channel_cache(write_queue, portals, stats)
+
+        assert stats["p1"]["total"] == 1
+        assert stats["p2"]["added"] == 2
+        assert connect.call_count == 1
+        assert len(fetch_rows("SELECT * FROM channels")) == 3
+
+
+class TestIncrementalRefresh:
+
+    @pytest.fixture
+    def one_portal(self, channels_db, portal_stubs, mocker):
+        mocker.patch('app.getPortals', return_value={"p1": make_portal("one", ["00:00:00:00:00:01"])})
+        return portal_stubs
+
+    def set_channels(self, stubs, channels):
+        stubs["http://one.example.com/portal.php"] = channels
+
+    def test_unchanged_rows_are_skipped(self, one_portal):
+        channels = [
+            {"id": 1, "name": "A", "number": 1, "tv_genre_id": "1", "cmd": "ffmpeg http://a"},
+            {"id": 2, "name": "B", "number": 2, "tv_genre_id": "1", "cmd": "ffmpeg http://b"},
+        ]
+        self.set_channels(one_portal, channels)
+        app.refresh_channels_cache()
+
+        summary = app.refresh_channels_cache()
+
+        assert summary == {"total": 2, "added": 0, "changed": 0, "removed": 0}
+
+    def test_changed_and_removed_channels(self, one_portal):
+        self.set_channels(one_portal, [
+            {"id": 1, "name": "A", "number": 1, "tv_genre_id": "1", "cmd": "ffmpeg http://a"},
+            {"id": 2, "name": "B", "number": 2, "tv_genre_id": "1", "cmd": "ffmpeg http://b"},
+        ])
+        app.refresh_channels_cache()
+        conn = app.get_db_connection()
+        conn.execute("UPDATE channels SET enabled = 1, custom_name = 'Mine' WHERE channel_id = '1'")
+        conn.commit()
+        conn.close()
+
+        self.set_channels(one_portal, [
+            {"id": 1, "name": "A2", "number": 1, "tv_genre_id": "1", "cmd": "ffmpeg http://a"},
+            {"id": 3, "name": "C", "number": 3, "tv_genre_id": "1", "cmd": "ffmpeg http://c"},
+        ])
+        summary = app.refresh_channels_cache()
+
+        assert summary == {"total": 2, "added": 1, "changed": 1, "removed": 1}
+        rows = {r["channel_id"]: r for r in fetch_rows("SELECT * FROM channels")}
+        assert rows["1"]["name"] == "A2"
+        assert rows["1"]["custom_name"] == "Mine"
+        assert rows["1"]["enabled"] == 1
+        assert rows["2"]["removed"] == 1
+        assert rows["3"]["removed"] == 0
+
+    def test_tombstoned_channel_comes_back(self, one_portal):
+        channel = {"id": 1, "name": "A", "number": 1, "tv_genre_id": "1", "cmd": "ffmpeg http://a"}
+        other = {"id": 2, "name": "B", "number": 2, "tv_genre_id": "1", "cmd": "ffmpeg http://b"}
+        self.set_channels(one_portal, [channel, other])
+        app.refresh_channels_cache()
+        self.set_channels(one_portal, [other])
+        app.refresh_channels_cache()
+
+        self.set_channels(one_portal, [channel, other])
+        summary = app.refresh_channels_cache()
+
+        assert summary["changed"] == 1
+        assert fetch_rows("SELECT removed FROM channels WHERE channel_id = '1'") == [{"removed": 0}]
+
+    def test_removed_channels_not_in_playlist(self, mock_config, one_portal):
+        self.set_channels(one_portal, [
+            {"id": 1, "name": "A", "number": 1, "tv_genre_id": "1", "cmd": "ffmpeg http://a"},
+            {"id": 2, "name": "B", "number": 2, "tv_genre_id": "1", "cmd": "ffmpeg http://b"},
+        ])
+        app.refresh_channels_cache()
+        conn = app.get_db_connection()
+        conn.execute("UPDATE channels SET enabled = 1")
+        conn.commit()
+        conn.close()
+        self.set_channels(one_portal, [
+            {"id": 1, "name": "A", "number": 1, "tv_genre_id": "1", "cmd": "ffmpeg http://a"},
+        ])
+        app.refresh_channels_cache()
+
+        app.generate_playlist()
+
+        assert "/play/p1/1" in app.cached_playlist
+        assert "/play/p1/2" not in app.cached_playlist
+
+
+class TestConnectionPool:
+
+    def test_connections_use_wal_and_tuned_pragmas(self, channels_db):
+        conn = app.get_db_connection()
+        try:
+            assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+            assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+            assert conn.execute("PRAGMA busy_timeout").fetchone()[0] > 0
+        finally:
+            conn.close()
+
+    def test_closed_connection_is_reused(self, channels_db):
+        conn = app.get_db_connection()
+        conn.close()
+
+        assert app.get_db_connection() is conn
+
+    def test_uncommitted_work_is_rolled_back_on_close(self, channels_db):
+        conn = app.get_db_connection()
+        conn.execute("INSERT INTO channels (portal, channel_id) VALUES ('p', '1')")
+        conn.close()
+
+        assert fetch_rows("SELECT * FROM channels") == []
+
+    def test_pool_follows_db_path(self, channels_db, tmp_path, monkeypatch):
+        conn = app.get_db_connection()
+        conn.close()
+        monkeypatch.setattr(app, 'dbPath', str(tmp_path / 'other.db'))
+
+        other = app.get_db_connection()
+
+        assert other is not conn
+        assert other.db_path == app.dbPath
+        other.close()
+
+    def test_reader_not_blocked_by_open_write(self, channels_db):
+        writer = app.get_db_connection()
+        writer.execute("INSERT INTO channels (portal, channel_id) VALUES ('p', '1')")
+        reader = app.db_pool._connect(app.dbPath)
+        try:
+            assert reader.execute("SELECT COUNT(*) FROM channels").fetchone()[0] == 0
+        finally:
+            writer.rollback()
+            writer.close()
+            app.sqlite3.Connection.close(reader)
+
+
+class TestSchemaMigrations:
+
+    def test_init_db_is_idempotent(self, channels_db):
+        app.init_db()
+
+        conn = app.get_db_connection()
+        try:
+            assert conn.execute("PRAGMA user_version").fetchone()[0] == len(app.SCHEMA_MIGRATIONS)
+        finally:
+            conn.close()
+
+    def test_legacy_table_is_migrated(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(app, 'dbPath', str(tmp_path / 'legacy.db'))
+        conn = app.get_db_connection()
+        conn.execute('''
+            CREATE TABLE channels (
+                portal TEXT NOT NULL, channel_id TEXT NOT NULL, portal_name TEXT,
+                name TEXT, number TEXT, genre TEXT, logo TEXT, enabled INTEGER DEFAULT 0,
+                custom_name TEXT, custom_number TEXT, custom_genre TEXT,
+                custom_epg_id TEXT, fallback_channel TEXT,
+                PRIMARY KEY (portal, channel_id)
+            )
+        ''')
+        conn.execute(
+            "INSERT INTO channels (portal, channel_id, name, number, genre, custom_name, enabled) "
+            "VALUES ('p', '1', 'CNN', '7', 'News', 'CNN HD', 1)"
+        )
+        conn.commit()
+        conn.close()
+
+        app.init_db()
+
+        assert fetch_rows(
+            "SELECT effective_name, effective_number, effective_genre, removed FROM channels"
+        ) == [{"effective_name": "CNN HD", "effective_number": 7, "effective_genre": "News", "removed": 0}]
+
+    def test_playlist_order_uses_index(self, channels_db):
+        plan = fetch_rows('''
+            EXPLAIN QUERY PLAN
+            SELECT * FROM channels
+            WHERE enabled = 1 AND removed = 0
+            ORDER BY effective_number
+        ''')
+        details = " ".join(row["detail"] for row in plan)
+
+        assert "idx_channels_enabled_number" in details
+        assert "TEMP B-TREE" not in details
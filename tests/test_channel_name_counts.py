@@ -0,0 +1,81 @@
+"""Tests for the trigger-maintained channel_name_counts table."""
+import json
+import pytest
+import app
+from tests.helpers import execute, fetch_rows, insert_channels
+
+
+def stored_counts():
+    return {row["name"]: row["count"] for row in fetch_rows("SELECT name, count FROM channel_name_counts")}
+
+
+def recomputed_counts():
+    rows = fetch_rows('''
+        SELECT effective_name, COUNT(*) AS count FROM channels
+        WHERE enabled = 1 AND removed = 0 GROUP BY effective_name
+    ''')
+    return {row["effective_name"]: row["count"] for row in rows}
+
+
+@pytest.fixture
+def channels(channels_db, mock_config):
+    columns = ("portal", "channel_id", "portal_name", "name", "enabled")
+    insert_channels(dict(zip(columns, row)) for row in [
+        ("p1", "1", "One", "CNN", 1),
+        ("p1", "2", "One", "CNN", 1),
+        ("p2", "3", "Two", "CNN", 1),
+        ("p1", "4", "One", "ESPN", 1),
+        ("p2", "5", "Two", "ESPN", 0),
+    ])
+
+
+class TestChannelNameCounts:
+
+    def test_counts_follow_inserts(self, channels):
+        assert stored_counts() == {"CNN": 3, "ESPN": 1}
+
+    @pytest.mark.parametrize("query", [
+        "UPDATE channels SET enabled = 1 WHERE channel_id = '5'",
+        "UPDATE channels SET enabled = 0 WHERE channel_id = '1'",
+        "UPDATE channels SET custom_name = 'ESPN' WHERE channel_id = '2'",
+        "UPDATE channels SET custom_name = '' WHERE channel_id = '2'",
+        "UPDATE channels SET name = 'CNN Intl' WHERE channel_id = '3'",
+        "UPDATE channels SET removed = 1 WHERE channel_id = '4'",
+        "DELETE FROM channels WHERE portal = 'p1'",
+        "UPDATE channels SET enabled = 0",
+    ])
+    def test_counts_follow_writes(self, channels, query):
+        execute(query)
+
+        assert stored_counts() == recomputed_counts()
+
+    def test_migration_seeds_existing_channels(self, channels):
+        execute("DELETE FROM channel_name_counts")
+        conn = app.get_db_connection()
+        app.migrate_channel_name_counts(conn.cursor())
+        conn.commit()
+        conn.close()
+
+        assert stored_counts() == {"CNN": 3, "ESPN": 1}
+
+
+class TestEditorReadsNameCounts:
+
+    def test_page_duplicate_counts(self, client, channels):
+        data = json.loads(client.get('/editor_data?draw=1&start=0&length=10').data)
+
+        counts = {row["channelId"]: row["duplicateCount"] for row in data["data"]}
+        assert counts == {"1": 3, "2": 3, "3": 3, "4": 0, "5": 0}
+
+    def test_duplicate_filters(self, client, channels):
+        enabled = json.loads(client.get('/editor_data?draw=1&start=0&length=10&duplicates=enabled_only').data)
+        unique = json.loads(client.get('/editor_data?draw=1&start=0&length=10&duplicates=unique_only').data)
+
+        assert sorted(row["channelId"] for row in enabled["data"]) == ["1", "2", "3"]
+        assert sorted(row["channelId"] for row in unique["data"]) == ["4", "5"]
+
+    def test_deactivate_keeps_first_of_each_name(self, client, channels):
+        data = json.loads(client.post('/editor/deactivate-duplicates').data)
+
+        assert data["deactivated"] == 2
+        assert stored_counts() == {"CNN": 1, "ESPN": 1}
@@ -0,0 +1,92 @@
+"""Tests for filter-scoped bulk editor actions."""
+import json
+import pytest
+import app
+from tests.helpers import fetch_rows, insert_channels
+
+
+def fetch(query):
+    return {row["channel_id"]: row for row in fetch_rows(query)}
+
+
+@pytest.fixture
+def channels(channels_db, mock_config, mocker):
+    mocker.patch('app.threading.Thread')
+    mocker.patch('app.Thread')
+    columns = ("portal", "channel_id", "portal_name", "name", "number", "genre", "enabled")
+    insert_channels(dict(zip(columns, row)) for row in [
+        ("p1", "1", "One", "BBC One", "5", "Entertainment", 0),
+        ("p1", "2", "One", "BBC News", "3", "News", 0),
+        ("p1", "3", "One", "Sky News", "9", "News", 1),
+        ("p2", "4", "Two", "CNN", "1", "News", 0),
+    ])
+
+
+def bulk(client, **data):
+    response = client.post('/editor/bulk', data=data)
+    return response.status_code, json.loads(response.data)
+
+
+class TestEditorBulk:
+
+    def test_enable_filtered_by_portal_and_genre(self, client, channels):
+        status, data = bulk(client, action="enable", portal="One", genre="News")
+
+        assert status == 200
+        assert data["updated"] == 2
+        enabled = fetch("SELECT channel_id, enabled FROM channels")
+        assert {cid: row["enabled"] for cid, row in enabled.items()} == {"1": 0, "2": 1, "3": 1, "4": 0}
+
+    def test_disable_by_search(self, client, channels):
+        bulk(client, action="enable")
+
+        status, data = bulk(client, action="disable", **{"search[value]": "bbc"})
+
+        assert data["updated"] == 2
+        assert fetch("SELECT channel_id FROM channels WHERE enabled = 1").keys() == {"3", "4"}
+
+    def test_set_genre_moves_channels(self, client, channels):
+        status, data = bulk(client, action="set_genre", value="UK", portal="One")
+
+        assert data["updated"] == 3
+        rows = fetch("SELECT channel_id, effective_genre FROM channels")
+        assert [rows[cid]["effective_genre"] for cid in "1234"] == ["UK", "UK", "UK", "News"]
+
+    def test_renumber_in_sort_order(self, client, channels):
+        status, data = bulk(client, action="renumber", start="100", genre="News", **{
+            "order[0][column]": "2", "order[0][dir]": "desc",
+        })
+
+        assert data["updated"] == 3
+        rows = fetch("SELECT channel_id, custom_number, effective_number FROM channels")
+        # Sky News, CNN, BBC News by name descending
+        assert {cid: rows[cid]["custom_number"] for cid in "234"} == {"3": "100", "4": "101", "2": "102"}
+        assert rows["1"]["effective_number"] == 5
+
+    def test_unknown_action_is_rejected(self, client, channels):
+        status, data = bulk(client, action="drop")
+
+        assert status == 400
+        assert data["success"] is False
+
+    def test_changes_invalidate_editor_counts(self, client, channels):
+        before = app.channels_version
+
+        bulk(client, action="enable")
+
+        assert app.channels_version == before + 1
+
+    def test_guide_changes_reset_epg_coverage(self, client, channels):
+        conn = app.get_db_connection()
+        conn.executemany(
+            "INSERT INTO epg_coverage (portal, covered_until, fetched_at) VALUES (?, '20300101000000 +0000', '')",
+            [("p1",), ("p2",)],
+        )
+        conn.commit()
+        conn.close()
+
+        bulk(client, action="set_genre", value="UK")
+        assert fetch_rows("SELECT portal FROM epg_coverage ORDER BY portal") == [{"portal": "p1"}, {"portal": "p2"}]
+
+        bulk(client, action="renumber", portal="Two")
+        assert fetch_rows("SELECT portal FROM epg_coverage") == [{"portal": "p1"}]
@@ -192,10 +192,10 @@ class TestDeactivateDuplicates:
         # Should deactivate 2 channels (keeps first portal1/101, deactivates 2nd and 3rd)
         assert data['deactivated'] == 2
         
-        # Verify UPDATE queries were called to disable the duplicate channels
+        # Verify the duplicates were disabled by a single set-based UPDATE
         update_calls = [call for call in mock_cursor.execute.call_args_list 
                        if 'UPDATE' in str(call).upper()]
-        assert len(update_calls) == 2, "Should update 2 duplicate channels"
+        assert len(update_calls) == 1, "Should disable all duplicates in one statement"
         
     def test_deactivate_duplicates_respects_custom_names(self, client, mock_config, mock_db_with_channels):
         """Test that deactivate uses custom_name if available."""
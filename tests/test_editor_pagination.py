@@ -0,0 +1,97 @@
+"""Tests for keyset pagination and cached counts in the channel editor."""
+import json
+import pytest
+import app
+
+
+def get_page(client, start=0, length=4, after=None, extra=""):
+    url = f'/editor_data?draw=1&start={start}&length={length}{extra}'
+    if after:
+        url += f'&after={after}'
+    return json.loads(client.get(url).data)
+
+
+def ids(page):
+    return [(row["portal"], row["channelId"]) for row in page["data"]]
+
+
+@pytest.fixture
+def channels(channels_db, mock_config):
+    conn = app.get_db_connection()
+    conn.executemany(
+        "INSERT INTO channels (portal, channel_id, portal_name, name, number, enabled, fallback_channel) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [
+            (f"p{n % 2}", str(n), f"Portal {n % 2}", f"Channel {n % 5}", str(n), n % 3 == 0,
+             None if n % 4 else f"Fallback {n % 3}")
+            for n in range(23)
+        ],
+    )
+    conn.commit()
+    conn.close()
+
+
+SORTS = [
+    "",
+    "&order[0][column]=0&order[0][dir]=desc&order[1][column]=2&order[1][dir]=asc",
+    "&order[0][column]=6&order[0][dir]=desc",
+    "&order[0][column]=6&order[0][dir]=asc&order[1][column]=4&order[1][dir]=desc",
+]
+
+
+class TestKeysetPagination:
+
+    @pytest.mark.parametrize("sort", SORTS)
+    def test_cursor_pages_match_offset_pages(self, client, channels, sort):
+        by_offset = []
+        for start in range(0, 23, 4):
+            by_offset.extend(ids(get_page(client, start=start, extra=sort)))
+
+        by_cursor = []
+        page = get_page(client, extra=sort)
+        while True:
+            by_cursor.extend(ids(page))
+            if not page["nextCursor"]:
+                break
+            page = get_page(client, start=len(by_cursor), after=page["nextCursor"], extra=sort)
+
+        assert len(by_offset) == 23
+        assert by_cursor == by_offset
+
+    def test_cursor_from_another_view_is_ignored(self, client, channels):
+        first = get_page(client, extra=SORTS[1])
+
+        page = get_page(client, start=0, after=first["nextCursor"], extra=SORTS[2])
+
+        assert ids(page) == ids(get_page(client, start=0, extra=SORTS[2]))
+
+    def test_garbage_cursor_falls_back_to_offset(self, client, channels):
+        page = get_page(client, start=4, after="not-a-cursor")
+
+        assert ids(page) == ids(get_page(client, start=4))
+
+    def test_last_partial_page_has_no_cursor(self, client, channels):
+        assert get_page(client, start=20)["nextCursor"] is None
+
+
+class TestCachedCounts:
+
+    def test_counts_are_cached_until_channels_change(self, client, channels, mocker):
+        assert get_page(client)["recordsTotal"] == 23
+        count = mocker.spy(app.editor_counts, 'count')
+        conn = app.get_db_connection()
+        conn.execute("UPDATE channels SET removed = 1 WHERE channel_id = '0'")
+        conn.commit()
+        conn.close()
+
+        # Not yet told about the write, so the cached count is served
+        assert get_page(client)["recordsTotal"] == 23
+
+        app.mark_channels_changed()
+
+        assert get_page(client)["recordsTotal"] == 22
+        assert count.call_count == 2
+
+    def test_filtered_count_is_per_filter(self, client, channels):
+        assert get_page(client, extra="&portal=Portal 0")["recordsFiltered"] == 12
+        assert get_page(client, extra="&portal=Portal 1")["recordsFiltered"] == 11
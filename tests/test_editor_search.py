@@ -0,0 +1,78 @@
+"""Tests for the FTS5-backed channel editor search."""
+import json
+import pytest
+import app
+from tests.helpers import insert_channels
+
+COLUMNS = ("portal", "channel_id", "portal_name", "name", "number", "genre", "custom_name", "enabled")
+
+
+def search(client, term, order=None):
+    url = f'/editor_data?draw=1&start=0&length=50&search[value]={term}'
+    if order:
+        url += order
+    data = json.loads(client.get(url).data)
+    return [row["channelId"] for row in data["data"]], data["recordsFiltered"]
+
+
+@pytest.fixture
+def channels(channels_db, mock_config):
+    insert_channels(dict(zip(COLUMNS, row)) for row in [
+        ("p1", "1", "UK Portal", "BBC One", "101", "Entertainment", None, 1),
+        ("p1", "2", "UK Portal", "BBC News", "102", "News", None, 1),
+        ("p1", "3", "UK Portal", "Sky News", "103", "News", "Sky News HD", 1),
+        ("p2", "4", "Télé Portal", "Canal Plus", "201", "Cinéma", None, 0),
+    ])
+
+
+class TestEditorSearch:
+
+    def test_build_search_query(self):
+        assert app.build_search_query("bbc on") == '"bbc"* "on"*'
+        assert app.build_search_query('"; DROP') == '"DROP"*'
+        assert app.build_search_query("  -- ") is None
+
+    def test_prefix_match_on_all_words(self, client, channels):
+        ids, filtered = search(client, "bbc on")
+
+        assert ids == ["1"]
+        assert filtered == 1
+
+    def test_matches_custom_name_genre_number_and_portal(self, client, channels):
+        assert search(client, "hd")[0] == ["3"]
+        assert sorted(search(client, "news")[0]) == ["2", "3"]
+        assert search(client, "20")[0] == ["4"]
+        assert search(client, "tele")[0] == ["4"]
+
+    def test_name_matches_rank_above_genre_matches(self, client, channels):
+        insert_channels([dict(zip(COLUMNS, ("p1", "5", "UK Portal", "Euronews", "104", "News", None, 1)))])
+        conn = app.get_db_connection()
+        conn.execute("UPDATE channels SET genre = 'General' WHERE channel_id = '2'")
+        conn.commit()
+        conn.close()
+
+        ids, _ = search(client, "news")
+
+        # Sky News matches on name and genre, BBC News on name only, Euronews on genre only
+        assert ids == ["3", "2", "5"]
+
+    def test_explicit_sort_wins_over_rank(self, client, channels):
+        ids, _ = search(client, "news", order="&order[0][column]=4&order[0][dir]=desc")
+
+        assert ids == ["3", "2"]
+
+    def test_removed_channels_are_not_found(self, client, channels):
+        conn = app.get_db_connection()
+        conn.execute("UPDATE channels SET removed = 1 WHERE channel_id = '1'")
+        conn.commit()
+        conn.close()
+
+        assert search(client, "bbc")[0] == ["2"]
+
+    def test_index_follows_deletes(self, client, channels):
+        conn = app.get_db_connection()
+        conn.execute("DELETE FROM channels WHERE channel_id = '2'")
+        conn.commit()
+        conn.close()
+
+        assert search(client, "bbc")[0] == ["1"]
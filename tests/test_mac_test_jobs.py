@@ -0,0 +1,120 @@
+"""Tests for background MAC validation jobs."""
+import threading
+import time
+import pytest
+import app
+from app import MacTestJobs
+
+
+def wait_for_job(jobs, job_id, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = jobs.get(job_id)
+        if job["status"] == "done":
+            return job
+        time.sleep(0.01)
+    raise AssertionError("job did not finish")
+
+
+class TestMacTestJobs:
+
+    def test_results_and_completion(self, mocker):
+        mocker.patch('app.check_mac', side_effect=lambda url, mac, proxy, name: "2030-01-01" if mac != "bad" else None)
+        jobs = MacTestJobs(max_workers=4, per_portal=2)
+        completed = {}
+
+        def on_complete(expiries):
+            completed.update(expiries)
+            return "saved"
+
+        job_id = jobs.start("Test", "http://example.com/portal.php", ["a", "bad", "c"], None, on_complete)
+        job = wait_for_job(jobs, job_id)
+
+        assert job["message"] == "saved"
+        assert job["total"] == 3
+        assert sorted(r["mac"] for r in job["results"]) == ["a", "bad", "c"]
+        assert completed == {"a": "2030-01-01", "bad": None, "c": "2030-01-01"}
+
+    def test_per_portal_concurrency_cap(self, mocker):
+        running = [0]
+        peak = [0]
+        lock = threading.Lock()
+
+        def slow_check(url, mac, proxy, name):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.02)
+            with lock:
+                running[0] -= 1
+            return "2030-01-01"
+
+        mocker.patch('app.check_mac', side_effect=slow_check)
+        jobs = MacTestJobs(max_workers=8, per_portal=2)
+
+        job_id = jobs.start("Test", "http://example.com/portal.php", [str(i) for i in range(6)], None)
+        wait_for_job(jobs, job_id)
+
+        assert peak[0] == 2
+
+    def test_failing_check_counts_as_dead_mac(self, mocker):
+        mocker.patch('app.check_mac', side_effect=RuntimeError("boom"))
+        jobs = MacTestJobs(max_workers=2, per_portal=2)
+
+        job = wait_for_job(jobs, jobs.start("Test", "http://example.com/portal.php", ["a"], None))
+
+        assert job["results"] == [{"mac": "a", "expiry": None, "ok": False}]
+
+    def test_unknown_job(self):
+        assert MacTestJobs().get("missing") is None
+
+
+def test_portal_add_returns_job(client, mock_config, mocker):
+    """Adding a portal answers straight away with a job that saves the portal."""
+    mocker.patch('app.check_mac', return_value="2030-01-01")
+    saved = []
+    mocker.patch('app.savePortals', side_effect=lambda portals: saved.append(dict(portals)))
+
+    response = client.post('/portal/add', data={
+        "name": "New Portal",
+        "url": "http://new.example.com/portal.php",
+        "macs": "00:1A:79:00:00:01",
+        "streams per mac": "1",
+        "epg offset": "0",
+        "proxy": "",
+    }, headers={"Accept": "application/json"})
+
+    assert response.status_code == 202
+    job_id = response.get_json()["job"]
+
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        status = client.get(f'/api/portal/jobs/{job_id}').get_json()
+        if status["status"] == "done":
+            break
+        time.sleep(0.01)
+
+    assert status["message"] == "Portal(New Portal) added!"
+    assert status["results"] == [{"mac": "00:1A:79:00:00:01", "expiry": "2030-01-01", "ok": True}]
+    assert saved
+
+
+def test_portal_add_invalidates_guide_once_saved(client, mock_config, mocker):
+    """The guide is only rebuilt once the new portal has been saved."""
+    tested = threading.Event()
+    mocker.patch('app.check_mac', side_effect=lambda *args: tested.wait(5) and "2030-01-01")
+    mocker.patch('app.cached_xmltv', "guide.xml")
+
+    response = client.post('/portal/add', data={
+        "name": "New Portal",
+        "url": "http://new.example.com/portal.php",
+        "macs": "00:1A:79:00:00:01",
+        "streams per mac": "1",
+        "epg offset": "0",
+        "proxy": "",
+    }, headers={"Accept": "application/json"})
+
+    assert app.cached_xmltv == "guide.xml"
+    tested.set()
+    wait_for_job(app.mac_test_jobs, response.get_json()["job"])
+    assert app.cached_xmltv is None
@@ -0,0 +1,165 @@
+"""Tests for the versioned, pre-compressed playlist.m3u."""
+import gzip
+import pytest
+import app
+
+
+@pytest.fixture
+def channels(channels_db, mock_config):
+    conn = app.get_db_connection()
+    conn.executemany(
+        "INSERT INTO channels (portal, channel_id, portal_name, name, number, genre, enabled) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [
+            ("p1", "1", "One", "BBC One", "1", "UK", 1),
+            ("p1", "2", "One", "CNN", "2", "News", 1),
+            ("p1", "3", "One", "Hidden", "3", "News", 0),
+        ],
+    )
+    conn.commit()
+    conn.close()
+
+
+class TestPlaylistArtifact:
+
+    def test_playlist_contents(self, client, channels):
+        response = client.get('/playlist.m3u')
+
+        body = response.get_data(as_text=True)
+        assert response.status_code == 200
+        assert body.startswith("#EXTM3U")
+        assert "/play/p1/1" in body
+        assert "/play/p1/3" not in body
+        assert response.headers["ETag"]
+        assert response.headers["Last-Modified"]
+
+    def test_if_none_match_returns_304(self, client, channels):
+        etag = client.get('/playlist.m3u').headers["ETag"]
+
+        response = client.get('/playlist.m3u', headers={"If-None-Match": etag})
+
+        assert response.status_code == 304
+        assert response.get_data() == b""
+
+    def test_if_modified_since_returns_304(self, client, channels):
+        last_modified = client.get('/playlist.m3u').headers["Last-Modified"]
+
+        response = client.get('/playlist.m3u', headers={"If-Modified-Since": last_modified})
+
+        assert response.status_code == 304
+
+    def test_gzip_body_when_accepted(self, client, channels):
+        plain = client.get('/playlist.m3u')
+
+        response = client.get('/playlist.m3u', headers={"Accept-Encoding": "gzip"})
+
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert response.headers["ETag"] != plain.headers["ETag"]
+        assert gzip.decompress(response.get_data()) == plain.get_data()
+
+    def test_not_rebuilt_while_nothing_changes(self, client, channels, mocker):
+        client.get('/playlist.m3u')
+        generate = mocker.spy(app, 'generate_playlist')
+
+        client.get('/playlist.m3u')
+        client.get('/playlist.m3u')
+
+        generate.assert_not_called()
+
+    def test_rebuilt_after_channel_write(self, client, channels):
+        etag = client.get('/playlist.m3u').headers["ETag"]
+        conn = app.get_db_connection()
+        conn.execute("UPDATE channels SET enabled = 1 WHERE channel_id = '3'")
+        conn.commit()
+        conn.close()
+        app.mark_channels_changed()
+
+        response = client.get('/playlist.m3u', headers={"If-None-Match": etag})
+
+        assert response.status_code == 200
+        assert "/play/p1/3" in response.get_data(as_text=True)
+
+    def test_rebuilt_after_settings_change(self, client, channels, mocker):
+        client.get('/playlist.m3u')
+        settings = dict(app.getSettings(), **{"output format": "hls"})
+        mocker.patch('app.getSettings', return_value=settings)
+
+        body = client.get('/playlist.m3u').get_data(as_text=True)
+
+        assert "/hls/p1/1/master.m3u8" in body
+
+    def test_unchanged_rebuild_keeps_validators(self, client, channels):
+        first = client.get('/playlist.m3u')
+        app.mark_channels_changed()
+
+        response = client.get('/playlist.m3u', headers={"If-None-Match": first.headers["ETag"]})
+
+        assert response.status_code == 304
+        assert app.playlist_artifact.last_modified.strftime("%a, %d %b %Y %H:%M:%S GMT") == first.headers["Last-Modified"]
+
+
+class TestFilteredStreaming:
+
+    @pytest.fixture
+    def more_channels(self, channels):
+        conn = app.get_db_connection()
+        conn.execute(
+            "INSERT INTO channels (portal, channel_id, portal_name, name, number, genre, enabled) "
+            "VALUES ('p2', '9', 'Two', 'Sky News', '9', 'News', 1)"
+        )
+        conn.commit()
+        conn.close()
+
+    def test_playlist_filtered_by_portal_is_streamed(self, client, more_channels):
+        response = client.get('/playlist.m3u?portal=Two')
+
+        assert response.is_streamed
+        body = response.get_data(as_text=True)
+        assert body.startswith("#EXTM3U")
+        assert "/play/p2/9" in body
+        assert "/play/p1/" not in body
+
+    def test_playlist_filtered_by_group(self, client, more_channels):
+        body = client.get('/playlist.m3u?group=News').get_data(as_text=True)
+
+        assert "/play/p1/2" in body
+        assert "/play/p2/9" in body
+        assert "/play/p1/1" not in body
+        assert "/play/p1/3" not in body
+
+    def test_streamed_playlist_matches_cached_one(self, client, more_channels):
+        streamed = "".join(app.iter_playlist(app.getSettings()))
+
+        assert streamed == client.get('/playlist.m3u').get_data(as_text=True)
+
+    def test_playlist_streams_in_batches(self, channels, mocker):
+        mocker.patch('app.iter_channel_rows', side_effect=lambda query, params: iter([[], []]))
+
+        chunks = list(app.iter_playlist(app.getSettings()))
+
+        assert len(chunks) == 3
+
+
+class TestLineup:
+
+    @pytest.fixture(autouse=True)
+    def hdhr_enabled(self, mock_config, mocker):
+        mocker.patch('app.getSettings', return_value=dict(app.getSettings(), **{"enable hdhr": "true"}))
+
+    def test_lineup_is_json_with_validators(self, client, channels):
+        response = client.get('/lineup.json')
+
+        assert response.get_json() == [
+            {"GuideNumber": "1", "GuideName": "BBC One", "URL": f"http://{app.host}/play/p1/1"},
+            {"GuideNumber": "2", "GuideName": "CNN", "URL": f"http://{app.host}/play/p1/2"},
+        ]
+        assert client.get('/lineup.json', headers={"If-None-Match": response.headers["ETag"]}).status_code == 304
+
+    def test_lineup_filtered_by_genre_is_streamed(self, client, channels):
+        response = client.get('/lineup.json?genre=News')
+
+        assert response.is_streamed
+        assert [entry["GuideName"] for entry in response.get_json()] == ["CNN"]
+
+    def test_empty_lineup_is_valid_json(self, client, channels):
+        assert client.get('/lineup.json?portal=nope').get_json() == []
@@ -0,0 +1,113 @@
+"""Tests for named channel profiles."""
+import pytest
+import app
+
+
+GUIDE = """<?xml version="1.0" ?>
+<tv>
+  <channel id="1"><display-name>BBC One</display-name></channel>
+  <channel id="2"><display-name>CNN</display-name></channel>
+  <channel id="cnn.us"><display-name>Sky News</display-name></channel>
+  <programme start="20300101000000 +0000" stop="20300101010000 +0000" channel="1"><title>A</title></programme>
+  <programme start="20300101000000 +0000" stop="20300101010000 +0000" channel="2"><title>B</title></programme>
+  <programme start="20300101000000 +0000" stop="20300101010000 +0000" channel="cnn.us"><title>C</title></programme>
+</tv>"""
+
+
+@pytest.fixture
+def profiles(channels_db, mock_config, mocker):
+    saved = {"news": {"portal": [], "genre": ["News"]}}
+    mocker.patch('app.getProfiles', return_value=saved)
+    mocker.patch('app.saveProfiles')
+    mocker.patch('app.getSettings', return_value=dict(app.getSettings(), **{
+        "enable hdhr": "true", "hdhr name": "MacReplay", "hdhr id": "abc", "hdhr tuners": "2",
+    }))
+    with open(app.xmltvPath, 'w', encoding='utf-8') as f:
+        f.write(GUIDE)
+    mocker.patch('app.cached_xmltv', app.xmltvPath)
+    mocker.patch('app.last_updated', 10**12)
+
+    conn = app.get_db_connection()
+    conn.executemany(
+        "INSERT INTO channels (portal, channel_id, portal_name, name, number, genre, custom_epg_id, enabled) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        [
+            ("p1", "1", "One", "BBC One", "1", "UK", None, 1),
+            ("p1", "2", "One", "CNN", "2", "News", None, 1),
+            ("p2", "3", "Two", "Sky News", "3", "News", "cnn.us", 1),
+        ],
+    )
+    conn.commit()
+    conn.close()
+    return saved
+
+
+class TestProfileManagement:
+
+    def test_save_and_list(self, client, profiles):
+        response = client.put('/api/profiles/kids', json={"portal": ["p1"], "genre": "Kids"})
+
+        assert response.status_code == 200
+        assert profiles["kids"] == {"portal": ["p1"], "genre": ["Kids"]}
+        assert "kids" in client.get('/api/profiles').get_json()["profiles"]
+        app.saveProfiles.assert_called_once()
+
+    @pytest.mark.parametrize("name, body", [
+        ("bad name", {}),
+        ("ok", {"portal": [1, 2]}),
+    ])
+    def test_invalid_profiles_are_rejected(self, client, profiles, name, body):
+        assert client.put(f'/api/profiles/{name}', json=body).status_code == 400
+
+    def test_delete(self, client, profiles):
+        assert client.delete('/api/profiles/news').status_code == 200
+        assert "news" not in profiles
+        assert client.delete('/api/profiles/news').status_code == 404
+
+
+class TestProfileOutputs:
+
+    def test_playlist_only_has_profile_channels(self, client, profiles):
+        body = client.get('/playlist/news.m3u').get_data(as_text=True)
+
+        assert "/play/p1/2" in body
+        assert "/play/p2/3" in body
+        assert "/play/p1/1" not in body
+
+    def test_unknown_profile_is_404(self, client, profiles):
+        assert client.get('/playlist/nope.m3u').status_code == 404
+        assert client.get('/xmltv/nope').status_code == 404
+        assert client.get('/hdhr/nope/lineup.json').status_code == 404
+
+    def test_playlist_is_cached_per_profile(self, client, profiles, mocker):
+        etag = client.get('/playlist/news.m3u').headers["ETag"]
+        build = mocker.spy(app, 'iter_playlist')
+
+        response = client.get('/playlist/news.m3u', headers={"If-None-Match": etag})
+
+        assert response.status_code == 304
+        build.assert_not_called()
+
+    def test_profile_change_rebuilds(self, client, profiles):
+        client.get('/playlist/news.m3u')
+        profiles["news"] = {"portal": ["Two"], "genre": []}
+
+        body = client.get('/playlist/news.m3u').get_data(as_text=True)
+
+        assert "/play/p2/3" in body
+        assert "/play/p1/2" not in body
+
+    def test_xmltv_only_has_profile_channels(self, client, profiles):
+        body = client.get('/xmltv/news').get_data(as_text=True)
+
+        assert 'id="2"' in body and 'channel="2"' in body
+        assert 'id="cnn.us"' in body and 'channel="cnn.us"' in body
+        assert 'id="1"' not in body and 'channel="1"' not in body
+
+    def test_hdhr_device_per_profile(self, client, profiles):
+        discover = client.get('/hdhr/news/discover.json').get_json()
+        lineup = client.get('/hdhr/news/lineup.json').get_json()
+
+        assert discover["LineupURL"].endswith("/hdhr/news/lineup.json")
+        assert discover["DeviceID"] != client.get('/discover.json').get_json()["DeviceID"]
+        assert [entry["GuideName"] for entry in lineup] == ["CNN", "Sky News"]
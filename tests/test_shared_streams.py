@@ -0,0 +1,187 @@
+"""Tests for the shared MPEG-TS fan-out behind /play."""
+import queue
+import time
+
+import pytest
+import app
+from tests.helpers import insert_channels
+
+
+def ts_packet(pid, pusi=False, random_access=False, stream_id=None):
+    packet = bytearray(app.TS_PACKET_SIZE)
+    packet[0] = 0x47
+    packet[1] = (0x40 if pusi else 0) | ((pid >> 8) & 0x1F)
+    packet[2] = pid & 0xFF
+    payload = 4
+    if random_access:
+        packet[3], packet[4], packet[5] = 0x30, 1, 0x40
+        payload = 6
+    else:
+        packet[3] = 0x10
+    if stream_id is not None:
+        packet[payload:payload + 4] = bytes([0, 0, 1, stream_id])
+    return bytes(packet)
+
+
+PAT = ts_packet(0, pusi=True)
+VIDEO = ts_packet(256)
+KEYFRAME = ts_packet(256, pusi=True, random_access=True, stream_id=0xE0)
+AUDIO_FRAME = ts_packet(257, pusi=True, random_access=True, stream_id=0xC0)
+
+
+class FakeFfmpeg:
+    """A Popen stand-in whose output the test feeds chunk by chunk."""
+
+    def __init__(self):
+        self.output = queue.Queue()
+        self.stdout = self
+        self.killed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return None
+
+    def read(self, size):
+        return self.output.get(timeout=5)
+
+    def poll(self):
+        return -9 if self.killed else 0
+
+    def kill(self):
+        self.killed = True
+        self.output.put(b"")
+
+
+def wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+class TestSharedStream:
+    def make_stream(self):
+        return app.SharedStream(("p1", "1"), [], {"mac": "00"}, lambda returncode: None)
+
+    def test_late_joiner_starts_at_pat_before_keyframe(self):
+        stream = self.make_stream()
+        first = stream.subscribe()
+        stream._publish(VIDEO + VIDEO)
+        stream._publish(VIDEO + PAT + KEYFRAME)
+        stream._publish(VIDEO + VIDEO)
+
+        late = stream.subscribe()
+
+        assert stream.read(first.position)[0] == [VIDEO + VIDEO, VIDEO + PAT + KEYFRAME, VIDEO + VIDEO]
+        assert stream.read(late.position)[0] == [PAT + KEYFRAME, VIDEO + VIDEO]
+
+    def test_audio_random_access_is_not_a_join_point(self):
+        stream = self.make_stream()
+        stream._publish(VIDEO + PAT + AUDIO_FRAME)
+        stream._publish(VIDEO + KEYFRAME)
+        stream._publish(PAT + AUDIO_FRAME + VIDEO)
+
+        late = stream.subscribe()
+
+        assert late.position == (0, app.TS_PACKET_SIZE)
+        assert stream.read(late.position)[0][0] == PAT + AUDIO_FRAME
+
+    def test_pat_without_keyframe_is_not_a_join_point(self):
+        stream = self.make_stream()
+        stream._publish(PAT + VIDEO)
+
+        late = stream.subscribe()
+
+        assert late.position == (stream.next_seq, 0)
+
+    def test_lagging_subscriber_skips_to_join_point(self, mocker):
+        mocker.patch('app.SHARED_STREAM_BUFFER_CHUNKS', 2)
+        stream = self.make_stream()
+        slow = stream.subscribe()
+        stream._publish(VIDEO)
+        stream._publish(PAT + KEYFRAME)
+        stream._publish(VIDEO)
+
+        assert stream.read(slow.position)[0] == [PAT + KEYFRAME, VIDEO]
+
+    def test_last_subscriber_leaving_stops_upstream(self):
+        stream = self.make_stream()
+        stream.process = FakeFfmpeg()
+        a, b = stream.subscribe(), stream.subscribe()
+
+        a.close()
+        assert not stream.process.killed
+        b.close()
+        b.close()
+
+        assert stream.process.killed
+        assert stream.subscribe() is None
+
+
+class TestPlayFanOut:
+    @pytest.fixture
+    def ffmpeg(self, client, mock_config, channels_db, mocker):
+        insert_channels([{
+            "portal": "portal1", "channel_id": "123", "portal_name": "Test Portal",
+            "name": "Test Channel", "enabled": 1, "cmd": "ffmpeg http://cached.url",
+        }])
+        mocker.patch('app.occupied', {})
+        process = FakeFfmpeg()
+        popen = mocker.patch('subprocess.Popen', return_value=process)
+        yield process, popen
+        process.kill()
+        wait_for(lambda: not app.shared_streams.streams)
+
+    def test_viewers_of_one_channel_share_an_upstream(self, client, ffmpeg, mocker):
+        process, popen = ffmpeg
+        move_mac = mocker.patch('app.moveMac')
+        # The test client reads the first chunk before returning the response
+        process.output.put(VIDEO + PAT + KEYFRAME)
+
+        first = client.get('/play/portal1/123')
+        first_body = iter(first.response)
+        assert next(first_body) == VIDEO + PAT + KEYFRAME
+
+        second = client.get('/play/portal1/123')
+        second_body = iter(second.response)
+        assert next(second_body) == PAT + KEYFRAME
+
+        process.output.put(VIDEO)
+        assert next(first_body) == VIDEO
+        assert next(second_body) == VIDEO
+        assert popen.call_count == 1
+        assert len(app.occupied["portal1"]) == 1
+
+        first.close()
+        assert not process.killed
+        second.close()
+
+        wait_for(lambda: not app.occupied["portal1"])
+        assert process.killed
+        move_mac.assert_not_called()
+
+    def test_new_upstream_after_the_last_viewer_left(self, client, ffmpeg):
+        process, popen = ffmpeg
+        process.output.put(VIDEO)
+        client.get('/play/portal1/123').close()
+        wait_for(lambda: not app.shared_streams.streams)
+
+        popen.return_value = FakeFfmpeg()
+        popen.return_value.output.put(VIDEO)
+        response = client.get('/play/portal1/123')
+        response.close()
+
+        assert popen.call_count == 2
+
+    def test_failed_upstream_moves_mac(self, client, ffmpeg, mocker):
+        process, popen = ffmpeg
+        move_mac = mocker.patch('app.moveMac')
+        process.poll = lambda: 1
+        process.output.put(b"")
+
+        assert client.get('/play/portal1/123').get_data() == b""
+
+        wait_for(lambda: move_mac.called)
+        move_mac.assert_called_once_with("portal1", "00:00:00:00:00:00")
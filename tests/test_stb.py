@@ -257,3 +257,174 @@ class TestMACAddressHandling:
         assert 'cookies' in call_kwargs
         assert call_kwargs['cookies']['mac'] == test_mac
 
+
+
+class TestSessionTokenCache:
+    """Test the per-portal/MAC token cache."""
+
+    def setup_method(self):
+        stb.clearTokenCache()
+
+    def teardown_method(self):
+        stb.clearTokenCache()
+
+    def test_token_reused_until_ttl(self, mocker):
+        """A second call reuses the cached token without a new handshake."""
+        get_token = mocker.patch('stb.getToken', return_value="token1")
+        get_profile = mocker.patch('stb.getProfile')
+
+        first = stb.getSessionToken("http://example.com/portal.php", "00:1A:79:00:00:00")
+        second = stb.getSessionToken("http://example.com/portal.php", "00:1A:79:00:00:00")
+
+        assert first == second == "token1"
+        get_token.assert_called_once()
+        get_profile.assert_called_once()
+
+    def test_token_cache_keyed_by_mac_and_proxy(self, mocker):
+        """Different MACs and proxies get their own handshake."""
+        get_token = mocker.patch('stb.getToken', return_value="token")
+        mocker.patch('stb.getProfile')
+
+        stb.getSessionToken("http://example.com/portal.php", "00:1A:79:00:00:00")
+        stb.getSessionToken("http://example.com/portal.php", "00:1A:79:00:00:01")
+        stb.getSessionToken("http://example.com/portal.php", "00:1A:79:00:00:00", "http://proxy:8080")
+
+        assert get_token.call_count == 3
+
+    def test_token_expires_after_ttl(self, mocker):
+        """An expired token triggers a new handshake."""
+        get_token = mocker.patch('stb.getToken', side_effect=["token1", "token2"])
+        mocker.patch('stb.getProfile')
+        mocker.patch.object(stb, 'TOKEN_TTL', 0)
+
+        assert stb.getSessionToken("http://example.com/portal.php", "00:1A:79:00:00:00") == "token1"
+        assert stb.getSessionToken("http://example.com/portal.php", "00:1A:79:00:00:00") == "token2"
+        assert get_token.call_count == 2
+
+    def test_failed_handshake_not_cached(self, mocker):
+        """A failed handshake is retried on the next call."""
+        get_token = mocker.patch('stb.getToken', side_effect=[None, "token"])
+        mocker.patch('stb.getProfile')
+
+        assert stb.getSessionToken("http://example.com/portal.php", "00:1A:79:00:00:00") is None
+        assert stb.getSessionToken("http://example.com/portal.php", "00:1A:79:00:00:00") == "token"
+
+    def test_auth_failure_invalidates_token(self, mocker):
+        """An auth failure on a portal call drops the cached token."""
+        get_token = mocker.patch('stb.getToken', side_effect=["token1", "token2"])
+        mocker.patch('stb.getProfile')
+        stb.getSessionToken("http://example.com/portal.php", "00:1A:79:00:00:00")
+
+        mock_response = Mock()
+        mock_response.status_code = 200
+        mock_response.text = "Authorization failed."
+        mock_response.json.side_effect = ValueError("not json")
+        mocker.patch.object(stb.s, 'get', return_value=mock_response)
+
+        assert stb.getAllChannels("http://example.com/portal.php", "00:1A:79:00:00:00", "token1") is None
+        assert stb.getSessionToken("http://example.com/portal.php", "00:1A:79:00:00:00") == "token2"
+        assert get_token.call_count == 2
+
+
+    def test_failed_request_with_cached_token_retried_once(self, mocker):
+        """A cached token the portal no longer accepts is replaced and the request repeated."""
+        get_token = mocker.patch('stb.getToken', side_effect=["token1", "token2"])
+        mocker.patch('stb.getProfile')
+        stb.getSessionToken("http://example.com/portal.php", "00:1A:79:00:00:00")
+        request = Mock(side_effect=lambda token: "data" if token == "token2" else None)
+
+        assert stb.withSessionToken("http://example.com/portal.php", "00:1A:79:00:00:00", None, request) == "data"
+        assert [call.args[0] for call in request.call_args_list] == ["token1", "token2"]
+        assert get_token.call_count == 2
+
+    def test_failed_request_with_new_token_not_retried(self, mocker):
+        """A request that fails right after a handshake is not the token's fault."""
+        get_token = mocker.patch('stb.getToken', return_value="token")
+        mocker.patch('stb.getProfile')
+        request = Mock(return_value=None)
+
+        assert stb.withSessionToken("http://example.com/portal.php", "00:1A:79:00:00:00", None, request) is None
+        request.assert_called_once_with("token")
+        get_token.assert_called_once()
+
+
+class TestSessionPool:
+    """Test the per-host/proxy connection pools."""
+
+    def test_session_per_host_and_proxy(self):
+        """Sessions are shared per (scheme, host, proxy) and kept apart otherwise."""
+        pool = stb.SessionPool()
+        a = pool.session("http://example.com/portal.php")
+        b = pool.session("http://example.com/other.php")
+        c = pool.session("https://example.com/portal.php")
+        d = pool.session("http://example.com/portal.php", "http://proxy:8080")
+
+        assert a is b
+        assert len({id(a), id(c), id(d)}) == 3
+        pool.close()
+
+    def test_https_gets_retry_adapter(self):
+        """Both schemes use a pooled adapter with retries."""
+        pool = stb.SessionPool(poolSize=24)
+        session = pool.session("https://example.com/portal.php")
+        adapter = session.get_adapter("https://example.com/portal.php")
+
+        assert adapter._pool_maxsize == 24
+        assert adapter.max_retries.total == 3
+        pool.close()
+
+    def test_configure_rebuilds_sessions(self):
+        """Resizing drops existing sessions so new ones use the new size."""
+        pool = stb.SessionPool(poolSize=4)
+        before = pool.session("http://example.com/portal.php")
+        pool.configure(poolSize=16)
+        after = pool.session("http://example.com/portal.php")
+
+        assert before is not after
+        assert after.get_adapter("http://example.com")._pool_maxsize == 16
+        pool.close()
+
+    def test_get_routes_by_proxy(self, mocker):
+        """get() picks the session matching the request's proxy."""
+        pool = stb.SessionPool()
+        session = pool.session("http://example.com/portal.php", "http://proxy:8080")
+        mock_get = mocker.patch.object(session, 'get')
+
+        pool.get("http://example.com/portal.php", proxies={"http": "http://proxy:8080", "https": "http://proxy:8080"}, timeout=5)
+
+        mock_get.assert_called_once()
+        pool.close()
+
+
+class TestAsyncClient:
+    """Test the async portal helpers."""
+
+    def test_gather_limited_preserves_order_and_bound(self):
+        """Results come back in input order with at most `limit` running."""
+        import asyncio
+        running = [0]
+        peak = [0]
+
+        async def job(i):
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+            await asyncio.sleep(0.01 * (5 - i))
+            running[0] -= 1
+            return i
+
+        results = asyncio.run(stb.gatherLimited([job(i) for i in range(5)], 2))
+
+        assert results == [0, 1, 2, 3, 4]
+        assert peak[0] == 2
+
+    def test_async_wrapper_calls_sync_function(self, mocker):
+        """The async session token helper delegates to the sync one."""
+        import asyncio
+        mocker.patch('stb.getToken', return_value="token")
+        mocker.patch('stb.getProfile')
+        request = Mock(return_value=[{"id": "1"}])
+
+        result = asyncio.run(stb.withSessionTokenAsync("http://example.com/portal.php", "00:1A:79:00:00:00", None, request))
+
+        assert result == [{"id": "1"}]
+        request.assert_called_once_with("token")
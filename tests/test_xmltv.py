@@ -0,0 +1,429 @@
+"""Tests for the streamed XMLTV guide."""
+import asyncio
+import threading
+import time
+import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta
+
+import pytest
+import app
+from tests.helpers import insert_channels
+
+
+def stamp(moment):
+    return moment.strftime("%Y%m%d%H%M%S") + " +0000"
+
+
+def add_channel(portal, channel_id, name, number, enabled=1, custom_epg_id=None):
+    insert_channels([{
+        "portal": portal, "channel_id": channel_id, "name": name, "number": number,
+        "logo": "http://logo/" + channel_id + ".png", "enabled": enabled, "custom_epg_id": custom_epg_id,
+    }])
+
+
+@pytest.fixture
+def portal_epg(channels_db, mock_config, mocker):
+    portals, _ = mock_config
+    portals["portal1"]["epg offset"] = "0"
+    add_channel("portal1", "123", "Test Channel", "7")
+    start = datetime.utcnow().replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+    programmes = [{
+        "start_timestamp": (start - datetime(1970, 1, 1)).total_seconds(),
+        "stop_timestamp": (start + timedelta(hours=1) - datetime(1970, 1, 1)).total_seconds(),
+        "name": "News & Weather",
+        "descr": "<live>",
+    }]
+
+    async def fetch(portal, period=24):
+        return {"123": programmes}
+
+    mocker.patch('app.fetch_portal_epg', side_effect=fetch)
+    return start
+
+
+class TestXMLTVWriter:
+    def test_escapes_text_and_attributes(self, tmp_path):
+        path = str(tmp_path / "guide.xml")
+        with app.XMLTVWriter(path) as writer:
+            writer.channel('a"b', "Tom & Jerry", "http://x/?a=1&b=2")
+            writer.programme('a"b', "20300101000000 +0000", "20300101010000 +0000", "<Title>", None)
+
+        root = ET.parse(path).getroot()
+        assert root.find("channel").get("id") == 'a"b'
+        assert root.find("channel/display-name").text == "Tom & Jerry"
+        assert root.find("channel/icon").get("src") == "http://x/?a=1&b=2"
+        assert root.find("programme/title").text == "<Title>"
+
+    def test_failure_keeps_previous_guide(self, tmp_path):
+        path = tmp_path / "guide.xml"
+        path.write_text("<tv />")
+        with pytest.raises(RuntimeError):
+            with app.XMLTVWriter(str(path)) as writer:
+                writer.channel("1", "One")
+                raise RuntimeError("portal went away")
+
+        assert path.read_text() == "<tv />"
+        assert [p.name for p in tmp_path.iterdir()] == ["guide.xml"]
+
+
+class TestRefreshXMLTV:
+    def test_writes_guide_file(self, portal_epg):
+        app.refresh_xmltv()
+
+        root = ET.parse(app.xmltvPath).getroot()
+        assert root.find("channel").get("id") == "7"
+        assert root.find("channel/display-name").text == "Test Channel"
+        programme = root.find("programme")
+        assert programme.get("start") == stamp(portal_epg)
+        assert programme.find("title").text == "News & Weather"
+        assert programme.find("desc").text == "<live>"
+        assert app.cached_xmltv == app.xmltvPath
+
+    def test_guide_follows_channel_table(self, portal_epg):
+        add_channel("portal1", "124", "Disabled", "8", enabled=0)
+        add_channel("portal1", "125", "Custom Id", "9", custom_epg_id="custom.9")
+
+        app.refresh_xmltv()
+
+        root = ET.parse(app.xmltvPath).getroot()
+        assert [c.get("id") for c in root.iter("channel")] == ["7", "custom.9"]
+        # Channels the portal has no EPG for still get a placeholder programme
+        assert [p.find("title").text for p in root.iter("programme") if p.get("channel") == "custom.9"] == ["Custom Id"]
+
+    def test_disabled_channels_programmes_are_not_rendered(self, portal_epg):
+        app.refresh_xmltv()
+        conn = app.get_db_connection()
+        conn.execute("UPDATE channels SET enabled = 0")
+        conn.commit()
+        conn.close()
+        add_channel("portal1", "126", "Other", "10")
+
+        app.refresh_xmltv()
+
+        root = ET.parse(app.xmltvPath).getroot()
+        assert {p.get("channel") for p in root.iter("programme")} == {"10"}
+
+    def test_failed_fetch_keeps_channels_and_stored_programmes(self, portal_epg):
+        app.refresh_xmltv()
+
+        async def fetch(portal, period=24):
+            return None
+        app.fetch_portal_epg.side_effect = fetch
+        app.refresh_xmltv()
+
+        root = ET.parse(app.xmltvPath).getroot()
+        assert [c.get("id") for c in root.iter("channel")] == ["7"]
+        assert [p.find("title").text for p in root.iter("programme")] == ["News & Weather"]
+
+    def test_keeps_recent_programmes_between_refreshes(self, portal_epg):
+        recent = datetime.utcnow() - timedelta(hours=3)
+        expired = datetime.utcnow() - timedelta(days=3)
+        conn = app.get_db_connection()
+        conn.executemany(
+            "INSERT INTO epg_programmes (channel, start, stop, title) VALUES ('7', ?, ?, ?)",
+            [
+                (stamp(recent), stamp(recent + timedelta(hours=1)), "Earlier"),
+                (stamp(expired), stamp(expired + timedelta(hours=1)), "Old"),
+                (stamp(portal_epg), stamp(portal_epg + timedelta(hours=1)), "Stale"),
+            ],
+        )
+        conn.commit()
+        conn.close()
+
+        app.refresh_xmltv()
+
+        titles = [p.find("title").text for p in ET.parse(app.xmltvPath).getroot().iter("programme")]
+        assert titles == ["Earlier", "News & Weather"]
+
+    def test_refresh_does_not_duplicate_programmes(self, portal_epg):
+        app.refresh_xmltv()
+        app.refresh_xmltv()
+
+        conn = app.get_db_connection()
+        try:
+            assert conn.execute("SELECT COUNT(*) FROM epg_programmes").fetchone()[0] == 1
+        finally:
+            conn.close()
+        assert len(ET.parse(app.xmltvPath).getroot().findall("programme")) == 1
+
+    def test_route_serves_guide_file(self, client, portal_epg, mocker):
+        mocker.patch('app.cached_xmltv', None)
+
+        response = client.get('/xmltv')
+
+        assert response.status_code == 200
+        assert response.mimetype == "text/xml"
+        assert b"News &amp; Weather" in response.data
+
+        cached = client.get('/xmltv', headers={"If-None-Match": response.headers["ETag"]})
+        assert cached.status_code == 304
+
+
+class TestPortalFetching:
+    @pytest.fixture
+    def two_portals(self, portal_epg, mock_config, mocker):
+        portals, _ = mock_config
+        portals["portal2"] = dict(portals["portal1"], name="Slow Portal")
+        add_channel("portal2", "123", "Other Channel", "7", custom_epg_id="slow.1")
+        return portals
+
+    def test_slow_portal_times_out_without_blocking_others(self, two_portals, mocker):
+        mocker.patch('app.EPG_PORTAL_TIMEOUT', 0.2)
+        fast = app.fetch_portal_epg.side_effect
+
+        async def fetch(portal, period=24):
+            if portal["name"] == "Slow Portal":
+                await asyncio.sleep(10)
+            return await fast(portal, period)
+
+        app.fetch_portal_epg.side_effect = fetch
+        started = time.monotonic()
+
+        app.refresh_xmltv()
+
+        assert time.monotonic() - started < 5
+        ids = [c.get("id") for c in ET.parse(app.xmltvPath).getroot().iter("channel")]
+        assert ids == ["7", "slow.1"]
+
+    def test_timed_out_portal_keeps_its_channels(self, two_portals, mocker):
+        app.refresh_xmltv()
+        mocker.patch('app.EPG_PORTAL_TIMEOUT', 0.2)
+        fast = app.fetch_portal_epg.side_effect
+
+        async def fetch(portal, period=24):
+            if portal["name"] == "Slow Portal":
+                await asyncio.sleep(10)
+            return await fast(portal, period)
+
+        app.fetch_portal_epg.side_effect = fetch
+
+        app.refresh_xmltv()
+
+        root = ET.parse(app.xmltvPath).getroot()
+        channel_ids = [c.get("id") for c in root.iter("channel")]
+        assert channel_ids == ["7", "slow.1"]
+        programme_channels = [p.get("channel") for p in root.iter("programme")]
+        assert "slow.1" in programme_channels
+        assert set(programme_channels) <= set(channel_ids)
+
+    def test_merge_follows_portal_order(self, two_portals, mocker):
+        fast = app.fetch_portal_epg.side_effect
+
+        async def fetch(portal, period=24):
+            # The first portal answers last
+            if portal["name"] == "Test Portal":
+                await asyncio.sleep(0.1)
+            return await fast(portal, period)
+
+        app.fetch_portal_epg.side_effect = fetch
+
+        app.refresh_xmltv()
+
+        ids = [c.get("id") for c in ET.parse(app.xmltvPath).getroot().iter("channel")]
+        assert ids == ["7", "slow.1"]
+
+
+class TestScheduledRefresh:
+    def test_failures_back_off_up_to_max_age(self, mocker):
+        mocker.patch('app.last_updated', 0)
+        mocker.patch('app.refresh_xmltv', side_effect=RuntimeError("portal down"))
+        delays = []
+
+        def sleep(seconds):
+            delays.append(seconds)
+            if len(delays) == 6:
+                raise KeyboardInterrupt
+        mocker.patch('app.time.sleep', side_effect=sleep)
+
+        with pytest.raises(KeyboardInterrupt):
+            app.schedule_xmltv_refresh()
+
+        assert delays == [60, 120, 240, 480, app.XMLTV_MAX_AGE, app.XMLTV_MAX_AGE]
+
+
+class TestXMLTVServing:
+    def test_stale_guide_served_while_refreshing_in_background(self, client, portal_epg, mocker):
+        with open(app.xmltvPath, "w", encoding="utf-8") as f:
+            f.write("<tv><channel id=\"old\" /></tv>")
+        mocker.patch('app.last_updated', 0)
+        start = mocker.patch('app.start_xmltv_refresh')
+        refresh = mocker.patch('app.write_xmltv')
+
+        response = client.get('/xmltv')
+
+        assert b'id="old"' in response.data
+        start.assert_called_once()
+        refresh.assert_not_called()
+        assert "Last-Modified" in response.headers
+        assert int(response.headers["Age"]) >= 0
+
+    def test_missing_guide_is_built_in_request(self, client, portal_epg):
+        response = client.get('/xmltv')
+
+        assert b'channel id="7"' in response.data
+
+    def test_concurrent_refreshes_are_coalesced(self, mocker):
+        running = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def write():
+            calls.append(1)
+            if len(calls) == 1:
+                running.set()
+                release.wait(5)
+
+        mocker.patch('app.write_xmltv', side_effect=write)
+        first = threading.Thread(target=app.refresh_xmltv)
+        first.start()
+        running.wait(5)
+        waiters = [threading.Thread(target=app.refresh_xmltv) for _ in range(3)]
+        for waiter in waiters:
+            # Wait until each one has queued its request before starting the next
+            app.xmltv_refresh_pending = False
+            waiter.start()
+            while not app.xmltv_refresh_pending:
+                time.sleep(0.01)
+        release.set()
+        for thread in [first] + waiters:
+            thread.join(5)
+
+        # The running refresh plus one more for everything that arrived meanwhile
+        assert len(calls) == 2
+
+
+class TestGuideQueries:
+    @pytest.fixture
+    def store(self, channels_db, mock_config, mocker):
+        add_channel("portal1", "1", "News One", "1")
+        add_channel("portal2", "2", "Sport Two", "2")
+        conn = app.get_db_connection()
+        conn.execute("UPDATE channels SET genre = 'Sports' WHERE channel_id = '2'")
+        conn.executemany(
+            "INSERT INTO epg_programmes (channel, start, stop, title) VALUES (?, ?, ?, ?)",
+            [
+                ("1", "20300101000000 +0000", "20300101010000 +0000", "Early"),
+                ("1", "20300101010000 +0000", "20300101020000 +0000", "Middle"),
+                ("1", "20300101020000 +0000", "20300101030000 +0000", "Late"),
+                ("2", "20300101000000 +0000", "20300101030000 +0000", "Match"),
+            ],
+        )
+        conn.commit()
+        conn.close()
+        # A guide file exists, so queries don't trigger a rebuild
+        with open(app.xmltvPath, "w") as f:
+            f.write("<tv />")
+        mocker.patch('app.cached_xmltv', app.xmltvPath)
+        mocker.patch('app.last_updated', 10**12)
+
+    def query(self, client, **args):
+        root = ET.fromstring(client.get('/xmltv', query_string=args).data)
+        return (
+            [c.get("id") for c in root.iter("channel")],
+            [(p.get("channel"), p.find("title").text) for p in root.iter("programme")],
+        )
+
+    def test_time_window_keeps_overlapping_programmes(self, client, store):
+        channels, programmes = self.query(client, start="20300101013000", end="20300101020000")
+
+        assert channels == ["1", "2"]
+        assert programmes == [("1", "Middle"), ("2", "Match")]
+
+    def test_unix_seconds_bounds(self, client, store):
+        start = int((datetime(2030, 1, 1, 2, 30) - datetime(1970, 1, 1)).total_seconds())
+
+        _, programmes = self.query(client, start=start)
+
+        assert programmes == [("1", "Late"), ("2", "Match")]
+
+    def test_channel_selection(self, client, store):
+        assert self.query(client, **{"tvg-id": "2"})[0] == ["2"]
+        assert self.query(client, genre="Sports")[1] == [("2", "Match")]
+        assert self.query(client, portal="portal1")[0] == ["1"]
+
+    def test_now_next(self, client, store):
+        _, programmes = self.query(client, mode="nownext", start="20300101003000")
+
+        assert programmes == [("1", "Early"), ("1", "Middle"), ("2", "Match")]
+
+    def test_invalid_time_is_rejected(self, client, store):
+        assert client.get('/xmltv?start=tomorrow').status_code == 400
+
+
+class TestEPGLookahead:
+    def test_fetch_period(self):
+        now = datetime(2030, 1, 1)
+
+        assert app.epg_fetch_period(None, 72, now) == 72
+        # Plenty stored: only the near term is re-fetched
+        assert app.epg_fetch_period(stamp(now + timedelta(hours=70)), 72, now) == app.EPG_NEAR_TERM_HOURS
+        # Stored EPG has run short, or the lookahead was raised
+        assert app.epg_fetch_period(stamp(now + timedelta(hours=60)), 72, now) == 72
+        assert app.epg_fetch_period(stamp(now + timedelta(hours=24)), 168, now) == 168
+
+    def test_lookahead_setting(self):
+        assert app.epg_lookahead({"epg lookahead": "72"}) == 72
+        assert app.epg_lookahead({"epg lookahead": "9999"}) == app.EPG_MAX_LOOKAHEAD
+        assert app.epg_lookahead({"epg lookahead": ""}) == app.EPG_DEFAULT_LOOKAHEAD
+        assert app.epg_lookahead({}) == app.EPG_DEFAULT_LOOKAHEAD
+
+    def test_refreshes_fetch_incrementally(self, portal_epg, mock_config):
+        _, settings = mock_config
+        settings["epg lookahead"] = "72"
+
+        app.refresh_xmltv()
+        app.refresh_xmltv()
+
+        periods = [call.args[1] for call in app.fetch_portal_epg.call_args_list]
+        assert periods == [72, app.EPG_NEAR_TERM_HOURS]
+
+    def test_fetched_span_replaces_moved_programmes(self, portal_epg):
+        epoch = datetime(1970, 1, 1)
+
+        async def fetch(portal, period=24):
+            return {"123": [
+                {"start_timestamp": (begin - epoch).total_seconds(),
+                 "stop_timestamp": (begin + timedelta(hours=1) - epoch).total_seconds(), "name": title}
+                for begin, title in ((portal_epg, "First"), (portal_epg + timedelta(hours=2), "Third"))
+            ]}
+
+        app.fetch_portal_epg.side_effect = fetch
+        later = portal_epg + timedelta(hours=5)
+        conn = app.get_db_connection()
+        conn.executemany(
+            "INSERT INTO epg_programmes (channel, start, stop, title) VALUES ('7', ?, ?, ?)",
+            [
+                (stamp(portal_epg + timedelta(hours=1)), stamp(portal_epg + timedelta(hours=2)), "Moved"),
+                (stamp(later), stamp(later + timedelta(hours=1)), "Beyond"),
+            ],
+        )
+        conn.commit()
+        conn.close()
+
+        app.refresh_xmltv()
+
+        titles = [p.find("title").text for p in ET.parse(app.xmltvPath).getroot().iter("programme")]
+        assert titles == ["First", "Third", "Beyond"]
+
+    def test_programmes_past_the_lookahead_are_dropped(self, portal_epg, mock_config):
+        _, settings = mock_config
+        settings["epg lookahead"] = "72"
+        far = portal_epg + timedelta(hours=48)
+        conn = app.get_db_connection()
+        conn.execute(
+            "INSERT INTO epg_programmes (channel, start, stop, title) VALUES ('7', ?, ?, 'Far')",
+            (stamp(far), stamp(far + timedelta(hours=1))),
+        )
+        conn.commit()
+        conn.close()
+        app.refresh_xmltv()
+
+        settings["epg lookahead"] = "24"
+        app.refresh_xmltv()
+
+        titles = [p.find("title").text for p in ET.parse(app.xmltvPath).getroot().iter("programme")]
+        assert titles == ["News & Weather"]
+        conn = app.get_db_connection()
+        covered_until = conn.execute("SELECT covered_until FROM epg_coverage").fetchone()[0]
+        conn.close()
+        assert covered_until <= stamp(datetime.utcnow() + timedelta(hours=24))